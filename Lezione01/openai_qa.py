@@ -1,20 +1,42 @@
 # Importiamo i moduli necessari
+import argparse  # Per leggere le opzioni della riga di comando (modalità batch)
+import csv
+import io
+import json
+import os
+import sys
+import time
 from decouple import config  # Per gestire le variabili d'ambiente in modo sicuro
 from langchain_openai import ChatOpenAI  # Interfaccia LangChain per i modelli ChatGPT
+from openai import APITimeoutError, RateLimitError  # Errori dell'API: timeout e superamento dei limiti di richieste
 
 # Recuperiamo la chiave API dalle variabili d'ambiente
 OPENAI_KEY = config("OPENAI_KEY")
 
-# Inizializziamo il modello di linguaggio
-# Parametri:
-# - model: specifica quale modello di OpenAI utilizzare
-# - api_key: la chiave di autenticazione per le API OpenAI
-# - temperature: controlla la casualità delle risposte (0.0 = deterministico, 1.0 = massima creatività)
-llm = ChatOpenAI(
-    model="gpt-4o-mini",  # Utilizziamo GPT-4o, attualmente uno dei modelli più avanzati
-    api_key=OPENAI_KEY,
-    temperature=0.2  # Impostiamo una temperatura bassa per risposte più coerenti e precise
-)
+# Modello usato se non ne viene indicato un altro con --model
+DEFAULT_MODEL = "gpt-4o-mini"
+
+def build_llm(model_name=DEFAULT_MODEL, fallback_model=None, timeout=60):
+    """
+    Inizializza il modello di linguaggio.
+    
+    Parametri:
+    - model_name: specifica quale modello di OpenAI utilizzare
+    - fallback_model: un secondo modello da usare se il primo va in timeout o risponde con un errore 429
+    - timeout: secondi di attesa massima per ogni richiesta
+    """
+    llm = ChatOpenAI(
+        model=model_name,
+        api_key=OPENAI_KEY,  # la chiave di autenticazione per le API OpenAI
+        temperature=0.2,  # Impostiamo una temperatura bassa per risposte più coerenti e precise
+        timeout=timeout
+    )
+    if fallback_model:
+        # with_fallbacks() restituisce un modello con la stessa interfaccia (invoke, batch, ...)
+        # che, solo per gli errori indicati, ripete la richiesta con il modello di riserva
+        fallback = ChatOpenAI(model=fallback_model, api_key=OPENAI_KEY, temperature=0.2, timeout=timeout)
+        llm = llm.with_fallbacks([fallback], exceptions_to_handle=(RateLimitError, APITimeoutError))
+    return llm
 
 def ask_question(question, model):
     """
@@ -73,6 +95,214 @@ def interactive_qa(model):
             print(f"\nSi è verificato un errore: {str(e)}")
             print("Riprova con una domanda diversa.\n")
 
-# Modifichiamo la sezione principale per utilizzare l'interfaccia interattiva
+def read_questions(input_path, input_format=None):
+    """
+    Legge le domande da un file JSONL o CSV, oppure dallo standard input se il percorso è '-'.
+    
+    Ogni riga JSONL è un oggetto con il campo 'question' (e opzionalmente 'id');
+    un CSV deve avere una colonna 'question' (e opzionalmente 'id').
+    Se l'id manca, viene usato il numero progressivo della domanda.
+    Le righe non valide (JSON malformato, 'question' mancante o vuota) vengono segnalate
+    su stderr con il loro numero di riga e saltate, senza fermare le altre domande.
+    
+    Args:
+        input_path (str): Il percorso del file, oppure '-' per lo standard input
+        input_format (str): 'jsonl' o 'csv'; se manca si deduce dall'estensione del file
+            (lo standard input è JSONL, salvo indicazione contraria)
+        
+    Returns:
+        list: Una lista di dizionari {'id', 'question'} nell'ordine di input
+    """
+    if input_format is None:
+        input_format = "csv" if input_path.lower().endswith(".csv") else "jsonl"
+    source_name = "stdin" if input_path == "-" else input_path
+    
+    # newline="": il modulo csv gestisce da sé gli a capo, anche quelli dentro i campi tra virgolette
+    if input_path == "-":
+        source = io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    else:
+        source = open(input_path, encoding="utf-8", newline="")
+    
+    # coppie (numero di riga, record); un record CSV può occupare più righe: conta la prima.
+    # Un JSON malformato resta nella lista (come None), così non sposta gli id di default
+    rows = []
+    with source:
+        if input_format == "csv":
+            reader = csv.DictReader(source)
+            first_line = reader.line_num + 1
+            for row in reader:
+                rows.append((first_line, row))
+                first_line = reader.line_num + 1
+        else:
+            for line_number, line in enumerate(source, start=1):
+                if line.strip():
+                    try:
+                        rows.append((line_number, json.loads(line)))
+                    except json.JSONDecodeError:
+                        rows.append((line_number, None))
+    
+    questions = []
+    for index, (line_number, row) in enumerate(rows):
+        question = row.get("question") if isinstance(row, dict) else None
+        if not isinstance(question, str) or not question.strip():
+            problem = "JSON non valido" if row is None else "manca il campo 'question'"
+            print(f"{source_name}, riga {line_number}: {problem}, riga saltata", file=sys.stderr)
+            continue
+        # l'id di default è la posizione del record, così non cambia se una riga viene corretta
+        questions.append({"id": str(row["id"]) if row.get("id") not in (None, "") else str(index), "question": question})
+    return questions
+
+def compact_output(output_path, questions):
+    """
+    Riscrive il file di output con un solo record per domanda, nell'ordine di input, e
+    restituisce gli id delle domande che hanno già una risposta. Serve a riprendere
+    un'esecuzione interrotta senza ripetere (e ripagare) le domande già fatte.
+    
+    Viene chiamata all'avvio e alla fine della modalità batch: una riga troncata da un crash
+    viene scartata (così la risposta successiva non le si attacca), e per ogni domanda resta
+    la risposta, oppure l'ultimo errore. Le domande in errore vengono rifatte.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    
+    records = {}
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Una riga troncata da un crash viene ignorata: la domanda verrà rifatta
+                continue
+            if not isinstance(record, dict) or "id" not in record:
+                continue
+            previous = records.get(record["id"])
+            # una risposta non viene sostituita da un errore arrivato dopo
+            if previous is None or "answer" in record or "answer" not in previous:
+                records[record["id"]] = record
+    
+    # ordine di input; i record di domande non più presenti restano in fondo
+    position = {q["id"]: index for index, q in enumerate(questions)}
+    ordered = sorted(records.values(), key=lambda record: position.get(record["id"], len(position)))
+    
+    # file temporaneo e rename: un crash durante la riscrittura non perde le risposte
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        for record in ordered:
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, output_path)
+    return {record["id"] for record in ordered if "answer" in record}
+
+def answer_batch(questions, model, concurrency, max_retries):
+    """
+    Risponde a un blocco di domande con il metodo batch() del modello, che invia
+    le richieste in parallelo rispettando il limite di concorrenza.
+    Le domande rifiutate per superamento dei limiti (errore 429) vengono ripetute
+    con un'attesa esponenziale tra un tentativo e l'altro.
+    
+    Returns:
+        list: Per ogni domanda, la risposta (str) oppure l'eccezione che l'ha fatta fallire
+    """
+    results = [None] * len(questions)
+    pending = list(range(len(questions)))
+    
+    for attempt in range(max_retries + 1):
+        # return_exceptions=True: un errore su una domanda non interrompe le altre
+        responses = model.batch(
+            [questions[i] for i in pending],
+            config={"max_concurrency": concurrency},
+            return_exceptions=True
+        )
+        
+        retry = []
+        for index, response in zip(pending, responses):
+            if isinstance(response, RateLimitError) and attempt < max_retries:
+                retry.append(index)
+            elif isinstance(response, Exception):
+                results[index] = response
+            else:
+                results[index] = response.content
+        
+        if not retry:
+            break
+        
+        # Backoff esponenziale: 1s, 2s, 4s, ... (massimo 60s) prima di ripetere le domande rifiutate
+        wait = min(2 ** attempt, 60)
+        print(f"Limite di richieste raggiunto per {len(retry)} domande, nuovo tentativo tra {wait}s...", file=sys.stderr)
+        time.sleep(wait)
+        pending = retry
+    
+    return results
+
+def batch_qa(model, input_path, output_path, concurrency=8, max_retries=5, input_format=None):
+    """
+    Modalità batch: risponde a tutte le domande di un file e scrive le risposte in un file JSONL.
+    
+    Le domande vengono elaborate a blocchi; le risposte di ogni blocco sono scritte
+    subito, così un'interruzione perde al massimo il blocco in corso. Rilanciando il comando
+    con lo stesso file di output, le domande già risposte vengono saltate. A fine elaborazione
+    il file contiene un record per domanda, nell'ordine di input (vedi compact_output).
+    
+    Args:
+        model: L'istanza del modello linguistico da utilizzare
+        input_path (str): Il file di domande (JSONL o CSV), oppure '-' per lo standard input
+        output_path (str): Il file JSONL in cui aggiungere le risposte
+        concurrency (int): Il numero massimo di richieste contemporanee al modello
+        max_retries (int): Il numero massimo di nuovi tentativi dopo un errore 429
+        input_format (str): Il formato delle domande, 'jsonl' o 'csv' (vedi read_questions)
+    """
+    questions = read_questions(input_path, input_format)
+    answered = compact_output(output_path, questions)
+    todo = [q for q in questions if q["id"] not in answered]
+    print(f"{len(questions)} domande, {len(questions) - len(todo)} già risposte, {len(todo)} da elaborare.", file=sys.stderr)
+    
+    # Ogni blocco contiene qualche richiesta per ogni slot di concorrenza
+    chunk_size = concurrency * 4
+    
+    with open(output_path, "a", encoding="utf-8") as out:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            results = answer_batch([q["question"] for q in chunk], model, concurrency, max_retries)
+            
+            for item, result in zip(chunk, results):
+                record = {"id": item["id"], "question": item["question"]}
+                if isinstance(result, Exception):
+                    record["error"] = str(result)
+                else:
+                    record["answer"] = result
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            
+            # Scriviamo su disco al termine di ogni blocco, per poter riprendere dopo un crash
+            out.flush()
+            print(f"Elaborate {min(start + chunk_size, len(todo))}/{len(todo)} domande", file=sys.stderr)
+    
+    # Le risposte ai tentativi ripetuti sono state aggiunte in fondo: si riordina il file
+    compact_output(output_path, questions)
+
+def parse_args():
+    """Legge le opzioni della riga di comando."""
+    parser = argparse.ArgumentParser(description="Assistente AI con LangChain e OpenAI")
+    parser.add_argument("--model", default=DEFAULT_MODEL,
+                        help=f"Modello di OpenAI da utilizzare (default: {DEFAULT_MODEL})")
+    parser.add_argument("--fallback-model",
+                        help="Modello di riserva da usare in caso di timeout o errore 429 del modello principale")
+    parser.add_argument("--batch", metavar="INPUT",
+                        help="File di domande (JSONL o CSV) da elaborare in batch; '-' per lo standard input")
+    parser.add_argument("--format", choices=["jsonl", "csv"],
+                        help="Formato del file di domande (default: dall'estensione; JSONL per lo standard input)")
+    parser.add_argument("--output", default="answers.jsonl",
+                        help="File JSONL in cui scrivere le risposte (default: answers.jsonl)")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="Numero massimo di richieste contemporanee (default: 8)")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="Tentativi dopo un errore di rate limit (default: 5)")
+    return parser.parse_args()
+
+# Modifichiamo la sezione principale per utilizzare l'interfaccia interattiva,
+# oppure la modalità batch se viene indicato un file di domande
 if __name__ == "__main__":
-    interactive_qa(llm)
\ No newline at end of file
+    args = parse_args()
+    llm = build_llm(args.model, args.fallback_model)
+    if args.batch:
+        batch_qa(llm, args.batch, args.output, args.concurrency, args.max_retries, args.format)
+    else:
+        interactive_qa(llm)
\ No newline at end of file
@@ -0,0 +1,226 @@
+"""
+API HTTP del chatbot, senza interfaccia grafica, eseguibile con più worker.
+
+Lo stato di ogni sessione (cronologia recente, totali di token e costi) non resta nella
+memoria del worker ma in un backend condiviso (vedi session_backend.py): ogni richiesta
+prende il lock della sessione, ricostruisce chatbot e monitor dei token dallo stato salvato,
+risponde e salva il nuovo stato. Così due richieste della stessa sessione possono arrivare
+a worker diversi. Restano invece per processo le risorse costose da creare: client HTTP
+e router dei modelli, cache delle risposte e archivio delle conversazioni.
+
+    uvicorn api:app --workers 4
+    gunicorn api:app -w 4 -k uvicorn.workers.UvicornWorker
+
+Endpoint:
+    POST   /sessions                 crea una sessione e ne restituisce l'ID
+    POST   /sessions/{id}/chat       {"message": "...", "user": "..."} -> risposta, token e costo
+    GET    /sessions/{id}            cronologia recente e riepilogo di token e costi
+    POST   /sessions/{id}/save       salva la conversazione nell'archivio
+    DELETE /sessions/{id}            elimina la sessione
+
+Configurazione con variabili d'ambiente: OPENAI_KEY, SESSION_BACKEND ('sqlite' o 'redis'),
+SESSION_DB, REDIS_URL e CONVERSATIONS_DB. I limiti di traffico CHAT_REQUESTS_PER_MINUTE e
+CHAT_TOKENS_PER_MINUTE valgono per ogni worker: con N worker vanno impostati a 1/N dei limiti
+dell'account. Il budget giornaliero per utente CHAT_USER_TOKEN_BUDGET è invece contato nel
+backend delle sessioni, quindi vale per tutti i worker insieme e sopravvive ai riavvii.
+Con il budget attivo il campo "user" della richiesta è obbligatorio e l'API lo accetta così
+com'è: deve arrivare da un livello autenticato a monte (es. il proxy o il servizio che
+chiama l'API), altrimenti chiunque potrebbe cambiare utente e ottenere un budget nuovo.
+Le richieste rifiutate ricevono 429 con Retry-After.
+"""
+import math
+import os
+import threading
+import uuid
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.exceptions import HTTPException
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+
+from conversation_memory import ContextualChatBot
+from rate_limiter import AdmissionRejected, get_shared_rate_limiter, get_shared_usage_quotas
+from session_backend import SessionBackend, SessionLockTimeout, get_session_backend, restore_session, session_state
+from single_flight import get_shared_single_flight
+from token_monitor import TokenMonitor
+
+load_dotenv()
+
+MODELS = ("gpt-4o-mini", "gpt-4o")
+CONVERSATIONS_DB = os.getenv("CONVERSATIONS_DB", "./memory/conversations.db")
+REQUESTS_PER_MINUTE = int(os.getenv("CHAT_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("CHAT_TOKENS_PER_MINUTE", "200000"))
+USER_TOKEN_BUDGET = int(os.getenv("CHAT_USER_TOKEN_BUDGET", "0")) or None
+
+
+class ChatService:
+    """
+    Logica delle richieste, indipendente da HTTP. Chatbot e monitor dei token vengono
+    ricreati a ogni richiesta dallo stato della sessione: sono oggetti leggeri, perché
+    LLM, cache delle risposte e archivio sono condivisi dal processo.
+    """
+
+    def __init__(self, backend: SessionBackend, llm=None, response_cache=None, conversation_store=None):
+        self.backend = backend
+        # domande identiche contemporanee (anche di sessioni diverse) condividono una sola chiamata
+        self.single_flight = get_shared_single_flight()
+        self.rate_limiter = get_shared_rate_limiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        # i consumi del budget stanno nel backend, condivisi da tutti i worker
+        self.usage_quotas = get_shared_usage_quotas(USER_TOKEN_BUDGET, counters=backend) if USER_TOKEN_BUDGET else None
+        self._llm = llm
+        self._response_cache = response_cache
+        self._conversation_store = conversation_store
+        self._lock = threading.Lock()
+
+    def _resources(self):
+        # create alla prima richiesta, non all'avvio del worker
+        with self._lock:
+            if self._llm is None:
+                from model_router import get_shared_router
+                self._llm = get_shared_router(api_key=os.getenv("OPENAI_KEY"), models=MODELS, temperature=0.7)
+            if self._response_cache is None:
+                from response_cache import HashingEmbeddings, get_shared_response_cache
+                self._response_cache = get_shared_response_cache(embeddings=HashingEmbeddings())
+            if self._conversation_store is None:
+                from conversation_store import get_shared_conversation_store
+                self._conversation_store = get_shared_conversation_store(CONVERSATIONS_DB)
+            return self._llm, self._response_cache, self._conversation_store
+
+    def _new_session(self, session_id: str, user: Optional[str] = None) -> Tuple[ContextualChatBot, TokenMonitor]:
+        llm, response_cache, conversation_store = self._resources()
+        chatbot = ContextualChatBot(
+            llm,
+            memory_window_size=10,
+            response_cache=response_cache,
+            conversation_store=conversation_store,
+            structured_messages=True,
+            single_flight=self.single_flight,
+            rate_limiter=self.rate_limiter,
+            usage_quotas=self.usage_quotas,
+            quota_key=user or session_id
+        )
+        token_monitor = TokenMonitor(response_cache=response_cache)
+        token_monitor.session_data["session_id"] = session_id
+        return chatbot, token_monitor
+
+    def _load(self, session_id: str, user: Optional[str] = None) -> Tuple[ContextualChatBot, TokenMonitor]:
+        state = self.backend.load(session_id)
+        if state is None:
+            raise HTTPException(404, f"Sessione {session_id} non trovata")
+        chatbot, token_monitor = self._new_session(session_id, user)
+        restore_session(state, chatbot, token_monitor)
+        return chatbot, token_monitor
+
+    def create_session(self) -> str:
+        session_id = uuid.uuid4().hex
+        chatbot, token_monitor = self._new_session(session_id)
+        self.backend.save(session_id, session_state(chatbot, token_monitor))
+        return session_id
+
+    def chat(self, session_id: str, message: str, user: Optional[str] = None) -> dict:
+        if self.usage_quotas is not None and not user:
+            # un budget per sessione si aggirerebbe creando sessioni nuove
+            raise HTTPException(400, "Il campo 'user' è obbligatorio quando è attivo il budget per utente")
+        with self.backend.lock(session_id):
+            chatbot, token_monitor = self._load(session_id, user)
+            response, usage = chatbot.chat(message, return_usage=True)
+            interaction = token_monitor.log_interaction(
+                message, response, usage, cache_hit=chatbot.last_cache_hit
+            )
+            self.backend.save(session_id, session_state(chatbot, token_monitor))
+        return {
+            "response": response,
+            "model": interaction["model"],
+            "input_tokens": interaction["input_tokens"],
+            "output_tokens": interaction["output_tokens"],
+            "cost_usd": interaction["cost_usd"],
+            "cache_hit": chatbot.last_cache_hit
+        }
+
+    def get_session(self, session_id: str) -> dict:
+        chatbot, token_monitor = self._load(session_id)
+        return {
+            "session_id": session_id,
+            "conversation_id": chatbot.conversation_manager.conversation_id,
+            "messages": chatbot.conversation_manager.get_conversation_history(),
+            "summary": token_monitor.get_session_summary()
+        }
+
+    def save_conversation(self, session_id: str) -> str:
+        with self.backend.lock(session_id):
+            chatbot, token_monitor = self._load(session_id)
+            conversation_id = chatbot.save_conversation()
+            # lo stato ricorda quali messaggi sono già nell'archivio
+            self.backend.save(session_id, session_state(chatbot, token_monitor))
+        return conversation_id
+
+    def delete_session(self, session_id: str):
+        with self.backend.lock(session_id):
+            self.backend.delete(session_id)
+
+
+def create_app(backend: Optional[SessionBackend] = None, llm=None, response_cache=None,
+               conversation_store=None) -> Starlette:
+    """Crea l'applicazione ASGI; i parametri permettono di sostituire backend e risorse (es. nelle prove)."""
+    service = ChatService(backend or get_session_backend(), llm, response_cache, conversation_store)
+
+    # gli endpoint sono asincroni solo per leggere il corpo della richiesta: il lavoro
+    # (lock, LLM, backend) è bloccante e gira nel pool di thread del worker
+    async def create_session(request: Request):
+        session_id = await run_in_threadpool(service.create_session)
+        return JSONResponse({"session_id": session_id}, status_code=201)
+
+    async def chat(request: Request):
+        try:
+            body = await request.json()
+        except ValueError:
+            raise HTTPException(400, "Il corpo della richiesta non è un JSON valido")
+        message = body.get("message") if isinstance(body, dict) else None
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPException(400, "Il campo 'message' è obbligatorio")
+        user = body.get("user")
+        result = await run_in_threadpool(service.chat, request.path_params["session_id"], message, user)
+        return JSONResponse(result)
+
+    async def get_session(request: Request):
+        return JSONResponse(await run_in_threadpool(service.get_session, request.path_params["session_id"]))
+
+    async def save_conversation(request: Request):
+        conversation_id = await run_in_threadpool(service.save_conversation, request.path_params["session_id"])
+        return JSONResponse({"conversation_id": conversation_id})
+
+    async def delete_session(request: Request):
+        await run_in_threadpool(service.delete_session, request.path_params["session_id"])
+        return JSONResponse({"deleted": True})
+
+    async def session_busy(request: Request, exc: SessionLockTimeout):
+        # un'altra richiesta della stessa sessione è ancora in corso
+        return JSONResponse({"detail": str(exc)}, status_code=409)
+
+    async def rejected(request: Request, exc: AdmissionRejected):
+        # rifiutata prima di chiamare l'LLM: limite di traffico del worker o budget esaurito
+        headers = {"Retry-After": str(math.ceil(exc.retry_after))} if exc.retry_after else None
+        return JSONResponse({"detail": str(exc)}, status_code=429, headers=headers)
+
+    async def http_error(request: Request, exc: HTTPException):
+        return JSONResponse({"detail": exc.detail}, status_code=exc.status_code)
+
+    app = Starlette(
+        routes=[
+            Route("/sessions", create_session, methods=["POST"]),
+            Route("/sessions/{session_id}", get_session, methods=["GET"]),
+            Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+            Route("/sessions/{session_id}/chat", chat, methods=["POST"]),
+            Route("/sessions/{session_id}/save", save_conversation, methods=["POST"]),
+        ],
+        exception_handlers={SessionLockTimeout: session_busy, AdmissionRejected: rejected, HTTPException: http_error}
+    )
+    app.state.service = service
+    return app
+
+
+app = create_app()
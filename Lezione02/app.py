@@ -1,14 +1,34 @@
+import time
+# Streamlit riesegue l'intero script a ogni interazione: da qui si misura la durata di ogni rerun
+RERUN_START = time.time_ns()
+
 import os
 from dotenv import load_dotenv
 import streamlit as st
-from langchain_openai import ChatOpenAI
-from conversation_memory import ContextualChatBot
-from token_monitor import TokenMonitor
+# i moduli pesanti (LangChain, OpenAI, NumPy) vengono importati solo quando servono,
+# dentro le funzioni qui sotto: al primo avvio la pagina compare prima
 
 # carica le variabili d'ambiente dal file .env
 load_dotenv()
 OPENAI_KEY = os.getenv("OPENAI_KEY")
 
+# modelli a disposizione del router, dal più economico al più capace
+MODELS = ("gpt-4o-mini", "gpt-4o")
+CONVERSATIONS_DB = "./memory/conversations.db"
+
+# limiti di traffico verso il provider condivisi da tutte le sessioni del processo
+# e budget di token di ogni sessione per giorno (nessun budget se non impostato)
+REQUESTS_PER_MINUTE = int(os.getenv("CHAT_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = int(os.getenv("CHAT_TOKENS_PER_MINUTE", "200000"))
+SESSION_TOKEN_BUDGET = int(os.getenv("CHAT_SESSION_TOKEN_BUDGET", "0")) or None
+
+# memoria del chatbot: 'window' (gli ultimi scambi) o 'retrieval' (gli ultimi scambi
+# più quelli passati più pertinenti alla domanda, da un indice di tutta la conversazione)
+MEMORY_MODE = os.getenv("CHAT_MEMORY_MODE", "window")
+
+# messaggi della chat renderizzati a ogni rerun: solo l'ultima pagina, le precedenti su richiesta
+MESSAGES_PER_PAGE = int(os.getenv("CHAT_MESSAGES_PER_PAGE", "20"))
+
 # configurazione iniziale della pagina Streamlit. Va chiamata come prima cosa.
 st.set_page_config(
     page_title="Assistente AI con LangChain",
@@ -17,13 +37,156 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+
+# Risorse condivise dal processo: 'st.cache_resource' le crea una sola volta e le restituisce
+# a tutte le sessioni e a tutti i rerun, invece di ricostruirle per ogni utente.
+
+@st.cache_resource(show_spinner=False)
+def get_llm():
+    """
+    Router dei modelli condiviso da tutte le sessioni del processo:
+    i turni brevi e semplici vanno al modello economico, quelli impegnativi al più capace,
+    con passaggio al modello di riserva in caso di timeout o errore 429.
+    Ogni modello ha il proprio client con pool di connessioni e limite di concorrenza.
+    """
+    from model_router import get_shared_router
+    return get_shared_router(api_key=OPENAI_KEY, models=MODELS, temperature=0.7)
+
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    """Cache delle risposte condivisa: livello esatto + livello semantico con embedding locali."""
+    from response_cache import HashingEmbeddings, get_shared_response_cache
+    return get_shared_response_cache(embeddings=HashingEmbeddings())
+
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight():
+    """Registro delle chiamate in corso: le domande identiche contemporanee condividono una sola chiamata."""
+    from single_flight import get_shared_single_flight
+    return get_shared_single_flight()
+
+
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    """Limite di richieste e token al minuto del processo, con coda per priorità."""
+    from rate_limiter import get_shared_rate_limiter
+    return get_shared_rate_limiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+@st.cache_resource(show_spinner=False)
+def get_usage_quotas():
+    """Budget giornaliero di token di ogni sessione, controllato prima di chiamare l'LLM."""
+    if SESSION_TOKEN_BUDGET is None:
+        return None
+    from rate_limiter import get_shared_usage_quotas
+    return get_shared_usage_quotas(SESSION_TOKEN_BUDGET)
+
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_store():
+    """Archivio SQLite delle conversazioni salvate, condiviso da tutte le sessioni."""
+    from conversation_store import get_shared_conversation_store
+    return get_shared_conversation_store(CONVERSATIONS_DB)
+
+
+@st.cache_resource(show_spinner=False)
+def get_conversation_search():
+    """Indice di ricerca (full-text + similarità) sulle conversazioni salvate."""
+    from conversation_search import get_shared_conversation_search
+    from response_cache import HashingEmbeddings
+    return get_shared_conversation_search(get_conversation_store(), embeddings=HashingEmbeddings())
+
+
+@st.cache_resource(show_spinner=False)
+def get_ui_timings():
+    """Misure dell'interfaccia: durata del primo avvio del processo e istogramma dei rerun."""
+    from instrumentation import HistogramSink, Instrumentation
+    return {"cold_start_ms": None, "instrumentation": Instrumentation([HistogramSink()])}
+
+
+# Dati della sidebar memorizzati con 'st.cache_data': vengono ricalcolati solo
+# quando la cache è invalidata (salvataggio) o scaduta, non a ogni rerun.
+
+@st.cache_data(ttl=30, show_spinner=False)
+def list_saved_conversations():
+    """
+    Elenco delle conversazioni salvate per il menu a tendina: invalidato a ogni salvataggio
+    di questa sessione e ricalcolato al massimo ogni 30 secondi, per mostrare anche quelle
+    salvate da altre sessioni, da altri worker o dall'API.
+    """
+    return get_conversation_store().list_conversations()
+
+
+@st.cache_data(ttl=5, show_spinner=False)
+def get_latency_percentiles(_histogram):
+    """Percentili di latenza del processo, ricalcolati al massimo ogni 5 secondi."""
+    return _histogram.get_percentiles(), _histogram.requests, _histogram.cache_hits
+
+
+def render_message(message):
+    """Renderizza un messaggio della chat (con costo e token per quelli dell'assistente)."""
+    # 'st.chat_message' gestisce automaticamente l'icona e l'allineamento
+    with st.chat_message(message["role"]):
+        st.write(message["content"])
+        
+        # mostra metadati (costo/token) solo per i messaggi dell'assistente
+        if message["role"] == "assistant" and "metadata" in message:
+            metadata = message["metadata"]
+            st.caption(f"Modello: {metadata.get('model', '-')} | Token: {metadata.get('tokens', 0)} | " f"Costo: ${metadata.get('cost', 0):.6f}")
+
+
+def to_ui_message(message_type: str, content: str):
+    """Messaggio della UI da un messaggio della cronologia: il tipo ('human'/'ai') diventa il ruolo ('user'/'assistant')."""
+    return {"role": "user" if message_type == "human" else "assistant", "content": content}
+
+
+def show_older_page():
+    """
+    Mostra una pagina in più di messaggi precedenti: prima quelli già in 'messages',
+    poi quelli letti dall'archivio, solo quando servono.
+    """
+    state = st.session_state
+    state.older_shown += MESSAGES_PER_PAGE
+    in_memory = max(len(state.messages) - MESSAGES_PER_PAGE, 0)
+    missing = state.older_shown - in_memory
+    if missing > 0 and state.history_start > 0:
+        conversation_id = state.chatbot.conversation_manager.conversation_id
+        records = state.conversation_store.load_messages(conversation_id, last_n=missing, before=state.history_start)
+        state.messages[:0] = [to_ui_message(record["type"], record["content"]) for record in records]
+        state.history_start = records[0]["position"] if records else 0
+
+
+@st.fragment
+def show_older_messages():
+    """
+    Messaggi precedenti all'ultima pagina, mostrati a pagine su richiesta. È un fragment:
+    il pulsante riesegue solo questa parte della pagina, senza ridisegnare sidebar e chat recente.
+    """
+    state = st.session_state
+    older = state.messages[:-MESSAGES_PER_PAGE] if len(state.messages) > MESSAGES_PER_PAGE else []
+    if len(older) > state.older_shown or state.history_start > 0:
+        st.button("⬆️ Messaggi precedenti", on_click=show_older_page)
+    for message in older[max(len(older) - state.older_shown, 0):]:
+        render_message(message)
+
+
 class StreamlitChatApp:
     """Classe principale che orchestra l'intera applicazione Streamlit."""
     
-    def __init__(self):
-        """Costruttore: inizializza lo stato e costruisce la UI."""
-        self.initialize_session_state()
-        self.setup_sidebar()
+    def __init__(self, trace):
+        """
+        Costruttore: inizializza lo stato e costruisce la UI.
+        'trace' misura la durata delle fasi di questo rerun.
+        """
+        self.trace = trace
+        # l'intestazione viene disegnata subito, prima dell'eventuale inizializzazione lenta
+        st.title("🤖 Assistente AI con LangChain")
+        st.markdown("*Conversazioni intelligenti con memoria e monitoraggio costi*")
+        with trace.stage("init_session"):
+            self.initialize_session_state()
+        with trace.stage("sidebar"):
+            self.setup_sidebar()
     
     def initialize_session_state(self):
         """
@@ -33,17 +196,38 @@ class StreamlitChatApp:
         """
         if 'chatbot' not in st.session_state:
             try:
-                # inizializza l'LLM di OpenAI
-                llm = ChatOpenAI(
-                    model="gpt-4o-mini",
-                    api_key=OPENAI_KEY,
-                    temperature=0.7
-                )
+                from conversation_memory import ContextualChatBot
+                from rate_limiter import PRIORITY_HIGH
+                from token_monitor import TokenMonitor
+                
+                # risorse condivise dal processo (create solo dalla prima sessione)
+                llm = get_llm()
+                response_cache = get_response_cache()
+                st.session_state.conversation_store = get_conversation_store()
+                st.session_state.conversation_search = get_conversation_search()
 
                 # crea le istanze del chatbot e del token monitor e le salva nello stato della sessione
-                st.session_state.chatbot = ContextualChatBot(llm, memory_window_size=10)
-                st.session_state.token_monitor = TokenMonitor()
+                st.session_state.chatbot = ContextualChatBot(
+                    llm,
+                    memory_window_size=10,
+                    response_cache=response_cache,
+                    conversation_store=st.session_state.conversation_store,
+                    # prompt a messaggi (system + cronologia + domanda) con prefisso stabile tra i turni,
+                    # così la cache del prompt di OpenAI riduce costo e latenza dei token già inviati
+                    structured_messages=True,
+                    single_flight=get_single_flight(),
+                    # le domande dalla UI hanno un utente in attesa: in coda passano per prime
+                    rate_limiter=get_rate_limiter(),
+                    usage_quotas=get_usage_quotas(),
+                    priority=PRIORITY_HIGH,
+                    retrieval_embeddings=self.get_retrieval_embeddings()
+                )
+                st.session_state.token_monitor = TokenMonitor(response_cache=response_cache)
                 st.session_state.messages = [] # 'messages' è la lista usata per renderizzare la chat nella UI
+                # posizione nell'archivio del primo messaggio di 'messages' (quelli prima vengono letti
+                # solo su richiesta) e quanti messaggi precedenti all'ultima pagina sono visibili
+                st.session_state.history_start = 0
+                st.session_state.older_shown = 0
                 st.session_state.total_cost = 0.0
                 st.session_state.total_tokens = 0
                 st.session_state.conversation_loaded_id = None # 'conversation_loaded_id' è un flag per evitare ricaricamenti indesiderati
@@ -51,6 +235,14 @@ class StreamlitChatApp:
                 st.error(f"Errore nell'inizializzazione: {str(e)}")
                 st.stop()
     
+    @staticmethod
+    def get_retrieval_embeddings():
+        """Embedding locali per l'indice degli scambi nella modalità a recupero (None nella modalità a finestra)."""
+        if MEMORY_MODE != "retrieval":
+            return None
+        from response_cache import HashingEmbeddings
+        return HashingEmbeddings()
+    
     def setup_sidebar(self):
         """Configura la barra laterale con tutti i controlli e le statistiche."""
         st.sidebar.title("🤖 Controlli Assistente")
@@ -61,21 +253,21 @@ class StreamlitChatApp:
         if st.sidebar.button("🔄 Nuova Conversazione", type="secondary"):
             self.reset_conversation()
         
-        # se la folder 'memory' non esiste, la crea per salvare le conversazioni
-        folder_path = "./memory"
-        if not os.path.exists(folder_path):
-            os.makedirs(folder_path)
-        
         # pulsante per salvare la conversazione
         if st.sidebar.button("💾 Salva Conversazione"):
             self.save_conversation()
 
-        # menu a tendina per caricare una coversazione passata
-        conversations = (c for c in os.listdir("./memory") if c.endswith(".json"))
+        # menu a tendina per caricare una coversazione passata: l'elenco arriva da una query
+        # indicizzata sull'archivio, memorizzata finché non viene salvata una conversazione
+        conversations = {
+            c["conversation_id"]: f"{c['end_time'][:16].replace('T', ' ')} · {c['message_count']} messaggi"
+            for c in list_saved_conversations()
+        }
         conv = st.sidebar.selectbox(
             "Seleziona una conversazione da caricare",
-            conversations,
+            list(conversations),
             index=None,
+            format_func=lambda conversation_id: conversations[conversation_id],
             placeholder="Conversazioni salvate...",
         )
         # carica la conversazione solo se ne viene selezionata una e se è DIVERSA da quella già caricata.
@@ -84,132 +276,217 @@ class StreamlitChatApp:
             # aggiorna il flag con l'ID della conversazione appena caricata
             st.session_state.conversation_loaded_id = conv
         
+        self.setup_search()
+        
         # sezione statistiche
         st.sidebar.header("📊 Statistiche Sessione")
         
         # recupera e visualizza le statistiche dal token monitor
-        stats = st.session_state.token_monitor.get_session_summary()
+        stats = self.get_session_stats()
         
         col1, col2 = st.sidebar.columns(2)
         with col1:
-            st.metric("Messaggi", len(st.session_state.messages) // 2)
+            st.metric("Messaggi", (st.session_state.history_start + len(st.session_state.messages)) // 2)
             st.metric("Token Totali", f"{stats['total_tokens']:,}")
         
         with col2:
             st.metric("Costo Totale", f"${stats['total_cost_usd']:.6f}")
             if stats['total_interactions'] > 0:
                 st.metric("Costo Medio", f"${stats['average_cost_per_interaction']:.6f}")
+        
+        # statistiche della cache delle risposte
+        st.sidebar.caption(
+            f"Cache: {stats['cache_hits']} hit | {stats['cache_misses']} miss | "
+            f"{stats.get('cache_evictions', 0)} eviction"
+        )
+        # token del prompt ripetuti identici dal turno precedente e quanti ne ha serviti la cache di OpenAI
+        st.sidebar.caption(
+            f"Prefisso stabile: {stats['prefix_tokens']:,} token | in cache OpenAI: {stats['cached_input_tokens']:,}"
+        )
+        
+        # ripartizione delle risposte e dei costi tra i modelli usati dal router
+        for model, model_stats in stats['models'].items():
+            st.sidebar.caption(f"{model}: {model_stats['interactions']} risposte | ${model_stats['cost_usd']:.6f}")
+        
+        # budget di token della sessione, se configurato
+        chatbot = st.session_state.chatbot
+        if chatbot.usage_quotas is not None:
+            usage = chatbot.usage_quotas.get_usage(chatbot.quota_key)
+            st.sidebar.progress(min(1.0, usage["used"] / usage["limit"]),
+                                text=f"Budget: {usage['used']:,} / {usage['limit']:,} token")
+        
+        self.setup_latency_panel()
+    
+    def get_session_stats(self):
+        """
+        Statistiche della sessione, ricalcolate solo quando cambiano: la chiave è la sessione
+        del monitor (nuova dopo un reset o un caricamento) più il numero di interazioni registrate.
+        """
+        session_data = st.session_state.token_monitor.session_data
+        key = (session_data["session_id"], session_data["total_interactions"])
+        if st.session_state.get("stats_key") != key:
+            st.session_state.stats = st.session_state.token_monitor.get_session_summary()
+            st.session_state.stats_key = key
+        return st.session_state.stats
+    
+    def setup_latency_panel(self):
+        """Pannello con i percentili di latenza di ogni fase, misurati su tutte le richieste del processo."""
+        histogram = st.session_state.chatbot.instrumentation.get_histogram()
+        if histogram is None:
+            return
+        percentiles, requests, cache_hits = get_latency_percentiles(histogram)
+        with st.sidebar.expander("⏱️ Latenze (ms)"):
+            self.show_ui_timings()
+            if not percentiles:
+                st.caption("Nessuna richiesta misurata.")
+                return
+            st.table([
+                {"Fase": metric, "N": p["count"], "p50": f"{p['p50']:.1f}", "p95": f"{p['p95']:.1f}", "p99": f"{p['p99']:.1f}"}
+                for metric, p in percentiles.items()
+            ])
+            st.caption(f"Richieste: {requests} | da cache: {cache_hits} | "
+                       f"condivise con richieste identiche: {get_single_flight().get_stats()['coalesced']}")
+    
+    def show_ui_timings(self):
+        """Durata del primo avvio del processo e percentili della durata dei rerun dell'interfaccia."""
+        timings = get_ui_timings()
+        rerun = timings["instrumentation"].get_histogram().get_percentiles().get("total")
+        cold_start = f"{timings['cold_start_ms']:.0f} ms" if timings["cold_start_ms"] is not None else "-"
+        if rerun:
+            st.caption(f"Avvio a freddo: {cold_start} | rerun p50 {rerun['p50']:.0f} ms, p95 {rerun['p95']:.0f} ms")
+        else:
+            st.caption(f"Avvio a freddo: {cold_start}")
+    
+    def setup_search(self):
+        """Casella di ricerca nella sidebar: trova le conversazioni salvate e permette di aprirle."""
+        query = st.sidebar.text_input("🔎 Cerca nelle conversazioni", placeholder="Parole da cercare...")
+        by_similarity = st.sidebar.toggle("Ricerca per similarità", value=False)
+        if not query:
+            return
+        
+        search = st.session_state.conversation_search
+        results = search.search_similar(query) if by_similarity else search.search(query)
+        if not results:
+            st.sidebar.caption("Nessuna conversazione trovata.")
+            return
+        
+        for result in results:
+            # ogni risultato mostra lo snippet e un pulsante per caricare la conversazione
+            st.sidebar.markdown(f"**{result['conversation_id']}**  \n{result['snippet']}")
+            if st.sidebar.button("Apri", key=f"open_{result['conversation_id']}"):
+                self.load_conversation(result['conversation_id'])
+                st.session_state.conversation_loaded_id = result['conversation_id']
     
     def reset_conversation(self):
         """Resetta lo stato della conversazione a quello iniziale."""
         st.session_state.chatbot.reset_conversation()
         st.session_state.token_monitor.reset_session()
         st.session_state.messages = []
-        # resetta anche il flag della conversazione caricata
+        st.session_state.history_start = 0
+        st.session_state.older_shown = 0
+        # resetta anche il flag della conversazione caricata e le statistiche memorizzate
         st.session_state.conversation_loaded_id = None
+        st.session_state.pop("stats_key", None)
         st.success("Conversazione resettata!")
         st.rerun() # forza un refresh immediato della pagina
     
     def save_conversation(self):
-        """Salva la conversazione corrente su file."""
+        """Salva la conversazione corrente nell'archivio."""
         try:
-            filename = st.session_state.chatbot.save_conversation()
-            st.sidebar.success(f"Conversazione salvata: {filename}")
+            conversation_id = st.session_state.chatbot.save_conversation()
+            # l'elenco delle conversazioni è cambiato: si invalida la copia memorizzata
+            list_saved_conversations.clear()
+            st.sidebar.success(f"Conversazione salvata: {conversation_id}")
         except Exception as e:
             st.sidebar.error(f"Errore nel salvataggio: {str(e)}")
 
-    def load_conversation(self, filename: str):
+    def load_conversation(self, conversation_id: str):
         """Carica una conversazione e aggiorna la UI."""
-        st.session_state.chatbot.load_conversation(filename)
+        st.session_state.chatbot.load_conversation(conversation_id)
         
         # recupera la cronologia dal backend dopo il caricamento
-        history = st.session_state.chatbot.conversation_manager.get_conversation_history()
+        history = st.session_state.chatbot.conversation_manager.get_messages()
 
-        # popola la lista 'messages' della UI con la cronologia caricata
-        st.session_state.messages = []
-        for msg in history:
-            # traduce il tipo ('human'/'ai') nel ruolo ('user'/'assistant')
-            role = "user" if msg["type"] == "human" else "assistant"
-            st.session_state.messages.append({"role": role, "content": msg["content"]})
+        # la lista 'messages' della UI parte solo dall'ultima pagina della cronologia caricata:
+        # i messaggi precedenti vengono letti dall'archivio quando l'utente li chiede
+        page = history[-MESSAGES_PER_PAGE:]
+        st.session_state.messages = [to_ui_message(msg.type, msg.content) for msg in page]
+        conversation = st.session_state.conversation_store.get_conversation(conversation_id)
+        st.session_state.history_start = conversation["message_count"] - len(page) if conversation else 0
+        st.session_state.older_shown = 0
 
         # resetta il monitor dei costi per la sessione caricata
         st.session_state.token_monitor.reset_session()
     
     def display_chat_messages(self):
-        """Renderizza i messaggi della chat nella UI."""
-        for message in st.session_state.messages:
-            # 'st.chat_message' gestisce automaticamente l'icona e l'allineamento
-            with st.chat_message(message["role"]):
-                st.write(message["content"])
-                
-                # mostra metadati (costo/token) solo per i messaggi dell'assistente
-                if message["role"] == "assistant" and "metadata" in message:
-                    metadata = message["metadata"]
-                    st.caption(f"Token: ~{metadata.get('tokens', 0)} | " f"Costo: ${metadata.get('cost', 0):.6f}")
+        """
+        Renderizza i messaggi della chat nella UI: a ogni rerun solo l'ultima pagina
+        (MESSAGES_PER_PAGE messaggi), così la durata del rerun non cresce con la conversazione.
+        """
+        show_older_messages()
+        for message in st.session_state.messages[-MESSAGES_PER_PAGE:]:
+            render_message(message)
     
     def process_user_input(self, user_input: str):
         """Gestisce il ciclo completo: input utente -> risposta AI -> aggiornamento UI."""
+        from rate_limiter import AdmissionRejected
+        
         # 1. aggiunge e visualizza subito il messaggio dell'utente per una UI reattiva
         st.session_state.messages.append({"role": "user", "content": user_input})
         
         with st.chat_message("user"):
             st.write(user_input)
         
-        # 2. genera la risposta dell'AI mostrando uno spinner
+        # 2. genera la risposta dell'AI mostrandola in streaming, frammento per frammento
         with st.chat_message("assistant"):
-            with st.spinner("Sto pensando..."):
-                try:
-                    # chiamata al backend per ottenere la risposta
-                    response = st.session_state.chatbot.chat(user_input)
-                    
-                    # stima l'utilizzo dei token
-                    estimated_input_tokens = len(user_input.split()) * 1.3
-                    estimated_output_tokens = len(response.split()) * 1.3
-                    
-                    usage_metadata = {
-                        'prompt_tokens': int(estimated_input_tokens),
-                        'completion_tokens': int(estimated_output_tokens),
-                        'total_tokens': int(estimated_input_tokens + estimated_output_tokens)
+            try:
+                # 'st.write_stream' renderizza i frammenti appena arrivano e,
+                # a stream concluso, restituisce il testo completo della risposta
+                response = st.write_stream(st.session_state.chatbot.chat_stream(user_input))
+                
+                # consumo di token reale dell'intero prompt inviato (system prompt + cronologia +
+                # messaggio), come riportato dall'API o contato con il tokenizer locale
+                usage_metadata = st.session_state.chatbot.last_usage
+                
+                # 3. registra l'interazione e il costo solo a stream terminato
+                interaction_data = st.session_state.token_monitor.log_interaction(
+                    user_input, response, usage_metadata,
+                    cache_hit=st.session_state.chatbot.last_cache_hit
+                )
+                
+                # mostra metadati
+                total_tokens = interaction_data['input_tokens'] + interaction_data['output_tokens']
+                st.caption(f"Modello: {interaction_data['model']} | Token utilizzati: {total_tokens} | " f"Costo: ${interaction_data['cost_usd']:.6f}")
+                
+                # 4. aggiunge il messaggio completo dell'assistente alla cronologia della UI
+                st.session_state.messages.append({
+                    "role": "assistant", 
+                    "content": response,
+                    "metadata": {
+                        "tokens": total_tokens,
+                        "cost": interaction_data['cost_usd'],
+                        "model": interaction_data['model']
                     }
-                    
-                    # registra l'interazione e il costo
-                    interaction_data = st.session_state.token_monitor.log_interaction(
-                        user_input, response, usage_metadata
-                    )
-                    
-                    # 3. visualizza la risposta dell'AI e i suoi metadati
-                    st.write(response)
-                    
-                    # mostra metadati
-                    st.caption(f"Token utilizzati: ~{usage_metadata['total_tokens']} | " f"Costo: ${interaction_data['cost_usd']:.6f}")
-                    
-                    # 4. aggiunge il messaggio completo dell'assistente alla cronologia della UI
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": response,
-                        "metadata": {
-                            "tokens": usage_metadata['total_tokens'],
-                            "cost": interaction_data['cost_usd']
-                        }
-                    })
-                    
-                except Exception as e:
-                    error_msg = f"Si è verificato un errore: {str(e)}"
-                    st.error(error_msg)
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": error_msg
-                    })
+                })
+                
+            except AdmissionRejected as e:
+                # rifiutata prima di chiamare l'LLM (limite di traffico o budget esaurito): nessun costo
+                st.warning(f"⏳ {e}")
+                st.session_state.messages.append({"role": "assistant", "content": f"⏳ {e}"})
+            except Exception as e:
+                error_msg = f"Si è verificato un errore: {str(e)}"
+                st.error(error_msg)
+                st.session_state.messages.append({
+                    "role": "assistant", 
+                    "content": error_msg
+                })
     
     def run(self):
         """Metodo principale che esegue e organizza la UI."""
-        st.title("🤖 Assistente AI con LangChain")
-        st.markdown("*Conversazioni intelligenti con memoria e monitoraggio costi*")
-        
         # contenitore per i messaggi della chat
         chat_container = st.container()
             
-        with chat_container:
+        with chat_container, self.trace.stage("chat"):
             self.display_chat_messages()
     
         # campo di input per l'utente
@@ -219,8 +496,17 @@ class StreamlitChatApp:
             self.process_user_input(user_input)
             st.rerun() # ricarica lo script per mostrare subito il nuovo messaggio
 
+def record_rerun(trace):
+    """Chiude la misura del rerun; il primo rerun del processo è anche il tempo di avvio a freddo."""
+    timings = get_ui_timings()
+    trace.finish()
+    if timings["cold_start_ms"] is None:
+        timings["cold_start_ms"] = trace.total_ms
+
 def main():
     """Funzione di avvio dell'applicazione."""
+    # la misura parte dall'inizio dello script, non dalla creazione della traccia
+    trace = get_ui_timings()["instrumentation"].start_trace("rerun", start_ns=RERUN_START)
     try:
         # controllo di sicurezza: verifica che la chiave API sia presente
         api_key = os.getenv("OPENAI_KEY", default=None)
@@ -230,12 +516,15 @@ def main():
             st.stop()
         
         # crea e avvia l'applicazione
-        app = StreamlitChatApp()
+        app = StreamlitChatApp(trace)
         app.run()
         
     except Exception as e:
         st.error(f"❌ Errore nell'avvio dell'applicazione: {str(e)}")
         st.info("Verifica la configurazione e riprova.")
+    finally:
+        # anche i rerun interrotti da st.rerun() o st.stop() vengono misurati
+        record_rerun(trace)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,288 @@
+"""
+Benchmark offline dello stack del chatbot (ContextualChatBot, ConversationManager, TokenMonitor).
+
+Usa FakeChatModel al posto di OpenAI, quindi non richiede rete né chiave API e misura solo
+il costo del nostro codice. I risultati vengono scritti in un file JSON confrontabile tra
+un'esecuzione e l'altra:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output bench_new.json --compare bench.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List
+
+from conversation_memory import ContextualChatBot, ConversationManager
+from conversation_store import SQLiteConversationStore
+from fake_llm import FakeChatModel
+from response_cache import HashingEmbeddings
+from retrieval_memory import TurnIndex
+from token_monitor import TokenMonitor
+
+
+def _stats(samples: List[float]) -> Dict[str, float]:
+    """Riassume una serie di durate (in secondi) in millisecondi."""
+    ordered = sorted(samples)
+    return {
+        "mean_ms": statistics.fmean(ordered) * 1000,
+        "p50_ms": ordered[len(ordered) // 2] * 1000,
+        "p95_ms": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        "samples": len(ordered),
+    }
+
+
+def bench_turn_overhead(turns: int) -> Dict:
+    """Tempo di un turno di chat() con un LLM a latenza zero: tutto ciò che resta è overhead nostro."""
+    chatbot = ContextualChatBot(FakeChatModel(output_tokens=50), memory_window_size=10)
+    monitor = TokenMonitor(log_file=None)
+
+    samples = []
+    for i in range(turns):
+        start = time.perf_counter()
+        response, usage = chatbot.chat(f"Domanda numero {i} sul benchmark", return_usage=True)
+        monitor.log_interaction(f"Domanda numero {i}", response, usage)
+        samples.append(time.perf_counter() - start)
+    return _stats(samples)
+
+
+def bench_context(window_sizes: List[int], repeats: int) -> Dict:
+    """Costo di get_context_for_llm al crescere della finestra, a cronologia appena cambiata e in cache."""
+    results = {}
+    for window_size in window_sizes:
+        manager = ConversationManager(window_size=window_size)
+        for i in range(window_size):
+            manager.add_message(f"Domanda {i} " * 10, f"Risposta {i} " * 40)
+
+        after_change, cached = [], []
+        for i in range(repeats):
+            manager.add_message(f"Domanda extra {i}", f"Risposta extra {i}")
+            start = time.perf_counter()
+            manager.get_context_for_llm()
+            after_change.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            manager.get_context_for_llm()
+            cached.append(time.perf_counter() - start)
+
+        results[str(window_size)] = {"after_change": _stats(after_change), "cached": _stats(cached)}
+    return results
+
+
+def bench_retrieval(lengths: List[int], repeats: int) -> Dict:
+    """Costo della scelta del contesto nella modalità a recupero al crescere della conversazione."""
+    results = {}
+    for length in lengths:
+        manager = ConversationManager(turn_index=TurnIndex(HashingEmbeddings()))
+        start = time.perf_counter()
+        for i in range(length):
+            manager.add_message(f"Domanda {i} sull'argomento {i % 50} " * 3, f"Risposta {i} " * 40)
+        # la prima ricerca calcola a blocchi gli embedding di tutti gli scambi
+        manager.get_context_for_llm(query="argomento 7")
+        index_time = time.perf_counter() - start
+
+        samples = []
+        for i in range(repeats):
+            manager.add_message(f"Domanda extra {i}", f"Risposta extra {i}")
+            start = time.perf_counter()
+            manager.get_context_for_llm(query=f"argomento {i % 50}")
+            samples.append(time.perf_counter() - start)
+        results[str(length)] = {"index_ms": index_time * 1000, "query": _stats(samples)}
+    return results
+
+
+def bench_save_load(lengths: List[int]) -> Dict:
+    """Tempo di salvataggio e caricamento (JSON, binario e SQLite) al crescere della conversazione."""
+    results = {}
+    previous_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        # il formato JSON legge e scrive in './memory', relativo alla cartella corrente
+        os.chdir(tmp)
+        os.makedirs("memory")
+        try:
+            store = SQLiteConversationStore(os.path.join(tmp, "memory", "bench.db"))
+            for length in lengths:
+                manager = ConversationManager(window_size=10, store=store)
+                for i in range(length):
+                    manager.add_message(f"Domanda {i} " * 10, f"Risposta {i} " * 40)
+
+                start = time.perf_counter()
+                filename = manager.save_conversation(filename=os.path.join("memory", f"bench_{length}.json"))
+                json_save = time.perf_counter() - start
+
+                start = time.perf_counter()
+                ConversationManager(window_size=10).load_conversation(os.path.basename(filename))
+                json_load = time.perf_counter() - start
+
+                start = time.perf_counter()
+                manager.save_conversation(filename=os.path.join("memory", f"bench_{length}.lcv"))
+                binary_save = time.perf_counter() - start
+
+                # come per SQLite, dal formato binario (senza archivio) si leggono solo i messaggi della finestra
+                start = time.perf_counter()
+                ConversationManager(window_size=10).load_conversation(f"bench_{length}.lcv")
+                binary_load = time.perf_counter() - start
+
+                start = time.perf_counter()
+                manager.save_conversation()
+                sqlite_save = time.perf_counter() - start
+
+                # salvataggio incrementale: un solo scambio nuovo dopo una conversazione lunga
+                manager.add_message("Domanda finale", "Risposta finale")
+                start = time.perf_counter()
+                manager.save_conversation()
+                sqlite_incremental_save = time.perf_counter() - start
+
+                start = time.perf_counter()
+                ConversationManager(window_size=10, store=store).load_conversation(manager.conversation_id)
+                sqlite_load = time.perf_counter() - start
+
+                results[str(length)] = {
+                    "json_save_ms": json_save * 1000,
+                    "json_load_ms": json_load * 1000,
+                    "binary_save_ms": binary_save * 1000,
+                    "binary_load_ms": binary_load * 1000,
+                    "sqlite_save_ms": sqlite_save * 1000,
+                    "sqlite_incremental_save_ms": sqlite_incremental_save * 1000,
+                    "sqlite_load_ms": sqlite_load * 1000,
+                }
+                # ogni lunghezza usa una conversazione diversa
+                manager.clear_memory()
+            store.close()
+        finally:
+            os.chdir(previous_dir)
+    return results
+
+
+def bench_memory(sessions: int, turns: int) -> Dict:
+    """Memoria allocata per sessione (chatbot + monitor) dopo un certo numero di turni."""
+    gc.collect()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+
+    llm = FakeChatModel(output_tokens=50)
+    keep = []
+    for _ in range(sessions):
+        chatbot = ContextualChatBot(llm, memory_window_size=10)
+        monitor = TokenMonitor(log_file=None)
+        for i in range(turns):
+            response, usage = chatbot.chat(f"Domanda {i}", return_usage=True)
+            monitor.log_interaction(f"Domanda {i}", response, usage)
+        keep.append((chatbot, monitor))
+
+    gc.collect()
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {
+        "sessions": sessions,
+        "turns_per_session": turns,
+        "bytes_per_session": (current - baseline) / sessions,
+    }
+
+
+def bench_throughput(concurrency_levels: List[int], turns: int, latency: float) -> Dict:
+    """Turni al secondo con N sessioni concorrenti su achat(), con un LLM a latenza fissa."""
+    results = {}
+    llm = FakeChatModel(latency=latency, output_tokens=50)
+
+    async def session(chatbot: ContextualChatBot):
+        for i in range(turns):
+            await chatbot.achat(f"Domanda {i}")
+
+    for sessions in concurrency_levels:
+        chatbots = [ContextualChatBot(llm, memory_window_size=10) for _ in range(sessions)]
+
+        async def run_all():
+            await asyncio.gather(*(session(chatbot) for chatbot in chatbots))
+
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        elapsed = time.perf_counter() - start
+        results[str(sessions)] = {
+            "turns_per_second": sessions * turns / elapsed,
+            # rispetto al caso ideale (solo latenza dell'LLM), quanto tempo aggiunge il nostro codice
+            "overhead_ratio": elapsed / (turns * latency) if latency else None,
+        }
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ""
+
+
+def run_benchmarks(quick: bool = False) -> Dict:
+    """Esegue tutti i benchmark e restituisce i risultati in un dizionario serializzabile."""
+    scale = 1 if quick else 5
+    return {
+        "metadata": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": _git_commit(),
+            "quick": quick,
+        },
+        "turn_overhead": bench_turn_overhead(turns=40 * scale),
+        "context": bench_context(window_sizes=[5, 10, 50, 200], repeats=20 * scale),
+        "retrieval": bench_retrieval(lengths=[100, 1000] if quick else [100, 1000, 5000], repeats=20 * scale),
+        "save_load": bench_save_load(lengths=[10, 100, 1000] if quick else [10, 100, 1000, 5000]),
+        "memory": bench_memory(sessions=10 * scale, turns=20),
+        "throughput": bench_throughput(concurrency_levels=[1, 10, 50], turns=5 * scale, latency=0.05),
+    }
+
+
+def _flatten(data: Dict, prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(_flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current: Dict, previous: Dict, threshold: float = 0.2):
+    """Stampa le metriche cambiate di più del 'threshold' (20%) rispetto a un'esecuzione precedente."""
+    old = _flatten({k: v for k, v in previous.items() if k != "metadata"})
+    new = _flatten({k: v for k, v in current.items() if k != "metadata"})
+    print(f"Confronto con {previous['metadata'].get('commit') or previous['metadata']['timestamp']}:")
+    for name, value in new.items():
+        if name not in old or not old[name] or name.endswith("samples"):
+            continue
+        change = (value - old[name]) / old[name]
+        if abs(change) >= threshold:
+            print(f"  {name}: {old[name]:.4f} -> {value:.4f} ({change:+.0%})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline del chatbot")
+    parser.add_argument("--output", default="benchmark_results.json", help="File JSON in cui scrivere i risultati")
+    parser.add_argument("--compare", metavar="FILE", help="File di risultati precedente con cui confrontarsi")
+    parser.add_argument("--quick", action="store_true", help="Esecuzione ridotta, per un controllo veloce")
+    args = parser.parse_args()
+
+    results = run_benchmarks(quick=args.quick)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Risultati scritti in {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
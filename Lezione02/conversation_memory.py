@@ -1,104 +1,391 @@
 import os
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Iterator, Tuple, Union
 from datetime import datetime
 import json
-from langchain.schema import HumanMessage, AIMessage
-from langchain.memory import ConversationBufferWindowMemory
+import threading
+import uuid
+from collections import deque
+from langchain.schema import HumanMessage, SystemMessage
+from langchain_core.messages.ai import add_usage
+from conversation_summary import RollingSummarizer
+from message_log import MessageRecord, read_conversation, write_conversation
+from rate_limiter import PRIORITY_NORMAL, AdmissionRejected
+from retrieval_memory import TurnIndex
+from token_counter import TokenCounter
+from instrumentation import get_default_instrumentation
+
+class IncrementalContextBuilder:
+    """
+    Mantiene già formattate le righe "Utente: .../Assistente: ..." della finestra di contesto.
+    Le righe vivono in un buffer circolare (deque con 'maxlen'): aggiungere una riga e scartare
+    la più vecchia costa O(1), e la stringa finale viene ricostruita solo se la cronologia
+    è cambiata dall'ultima richiesta.
+    """
+    
+    PREFIXES = {"human": "Utente", "ai": "Assistente"}
+    HEADER = "Contesto della conversazione precedente:\n"
+    
+    def __init__(self, window_size: int):
+        # ogni scambio occupa due righe (utente + assistente)
+        self.lines = deque(maxlen=2 * window_size)
+        self._cached_context: Optional[str] = None
+    
+    def append(self, message_type: str, content: str) -> List[str]:
+        """
+        Formatta e aggiunge una riga; la più vecchia esce dal buffer se la finestra è piena.
+        Restituisce le righe uscite dalla finestra.
+        """
+        line = f"{self.PREFIXES[message_type]}: {content}"
+        evicted = []
+        if len(self.lines) >= self.lines.maxlen:
+            evicted.append(self.lines[0] if self.lines else line)
+        self.lines.append(line)
+        self._cached_context = None
+        return evicted
+    
+    def reset(self):
+        """Svuota il buffer."""
+        self.lines.clear()
+        self._cached_context = None
+    
+    def render(self, token_budget: Optional[int] = None) -> str:
+        """Restituisce il contesto formattato, riusando la stringa in cache se possibile."""
+        if self._cached_context is None:
+            self._cached_context = self._format(self.lines)
+        return self._cached_context
+    
+    def _format(self, lines) -> str:
+        if lines:
+            return self.HEADER + "\n".join(lines) + "\n\n"
+        return ""
+
+
+class TokenBudgetContextBuilder(IncrementalContextBuilder):
+    """
+    Variante del builder in cui la finestra è limitata dai token e non dal numero di scambi:
+    il contesto contiene i messaggi più recenti che rientrano nel budget.
+    Il numero di token di ogni riga viene calcolato una sola volta, quando la riga è aggiunta.
+    """
+    
+    def __init__(self, max_tokens: int, token_counter):
+        super().__init__(window_size=0)
+        self.lines = deque()
+        self.line_tokens = deque()
+        self.total_tokens = 0
+        self.max_tokens = max_tokens
+        self.token_counter = token_counter
+        self._header_tokens = token_counter.count(self.HEADER)
+        self._cached_budget: Optional[int] = None
+    
+    def append(self, message_type: str, content: str) -> List[str]:
+        """Aggiunge una riga e scarta le più vecchie che non potrebbero più rientrare nel budget massimo."""
+        line = f"{self.PREFIXES[message_type]}: {content}"
+        tokens = self.token_counter.count(line)
+        self.lines.append(line)
+        self.line_tokens.append(tokens)
+        self.total_tokens += tokens
+        
+        evicted = []
+        while self.lines and self.total_tokens > self.max_tokens:
+            evicted.append(self.lines.popleft())
+            self.total_tokens -= self.line_tokens.popleft()
+        self._cached_context = None
+        return evicted
+    
+    def reset(self):
+        super().reset()
+        self.line_tokens.clear()
+        self.total_tokens = 0
+    
+    def render(self, token_budget: Optional[int] = None) -> str:
+        """
+        Restituisce il contesto con i messaggi più recenti che stanno in 'token_budget'
+        (per default il budget massimo del builder).
+        """
+        budget = self.max_tokens if token_budget is None else min(token_budget, self.max_tokens)
+        if self._cached_context is not None and self._cached_budget == budget:
+            return self._cached_context
+        
+        # risale dai messaggi più recenti finché il budget lo consente
+        available = budget - self._header_tokens
+        count = 0
+        for tokens in reversed(self.line_tokens):
+            # ogni riga costa anche il separatore "\n" (circa un token)
+            if tokens + 1 > available:
+                break
+            available -= tokens + 1
+            count += 1
+        
+        selected = list(self.lines)[len(self.lines) - count:] if count else []
+        self._cached_context = self._format(selected)
+        self._cached_budget = budget
+        return self._cached_context
+
 
 class ConversationManager:
     """Gestisce la memoria di basso livello, la cronologia, e il salvataggio/caricamento delle conversazioni."""
     
-    def __init__(self, window_size: int = 10):
+    def __init__(self, window_size: int = 10, max_context_tokens: Optional[int] = None, token_counter=None, summarizer=None,
+                 store=None, load_last_n: Optional[int] = None, turn_index=None, retrieval_k: int = 4,
+                 recent_exchanges: int = 3, retrieval_max_tokens: int = 2000):
         """
         Inizializza il gestore della conversazione.
         
         Args:
             window_size (int): Il numero di scambi (utente+AI) da mantenere in memoria. Questo previene che il contesto diventi troppo lungo e costoso.
+            max_context_tokens (int): Se indicato, attiva la modalità a budget di token: il contesto
+                contiene i messaggi più recenti che rientrano in questo numero di token, invece
+                degli ultimi 'window_size' scambi.
+            token_counter (TokenCounter): Il contatore di token da usare nella modalità a budget.
+            summarizer (RollingSummarizer): Se indicato, attiva la modalità con riassunto: i messaggi
+                che escono dalla finestra vengono riassunti in background e il riassunto
+                viene anteposto al contesto.
+            store (ConversationStore): Se indicato, le conversazioni vengono salvate e caricate da questo
+                archivio (es. SQLiteConversationStore) invece che da file JSON.
+            load_last_n (int): Quanti messaggi leggere dall'archivio quando si carica una conversazione
+                (per default quelli della finestra, cioè 2 * window_size; tutti nella modalità a recupero).
+            turn_index (TurnIndex): Se indicato, attiva la modalità a recupero: ogni scambio viene
+                indicizzato e il contesto contiene gli ultimi 'recent_exchanges' scambi più i
+                'retrieval_k' scambi precedenti più pertinenti alla domanda, entro il budget di
+                token (per default 'retrieval_max_tokens'). In questa modalità il riassunto non si usa.
         """
-        # Inizializza la memoria a finestra di LangChain.
-        # 'k' è il numero di interazioni da ricordare.
-        # 'return_messages=True' fa sì che la memoria restituisca oggetti messaggio, non una stringa.
-        self.memory = ConversationBufferWindowMemory(
-            k=window_size,
-            return_messages=True,
-            memory_key="chat_history" # chiave standard per la cronologia
-        )
+        # numero di scambi (utente+AI) che entrano nel contesto inviato all'LLM
+        self.window_size = window_size
         
         # ogni nuova conversazione ottiene un ID univoco basato sulla data e l'ora
         self.conversation_id = self._generate_conversation_id()
         self.conversation_start = datetime.now()
         
+        # cronologia completa come record compatti (MessageRecord, con il timestamp reale di ogni
+        # messaggio): i messaggi di LangChain vengono creati solo per la chiamata all'LLM.
+        # Accanto, il builder incrementale del contesto testuale, aggiornato insieme alla cronologia.
+        self._history: List[MessageRecord] = []
+        if max_context_tokens is not None:
+            self.context_builder = TokenBudgetContextBuilder(max_context_tokens, token_counter or TokenCounter())
+        else:
+            self.context_builder = IncrementalContextBuilder(window_size)
+        self.summarizer = summarizer
+        
+        # modalità a recupero: l'indice vettoriale degli scambi e, per ognuno, la posizione
+        # dei suoi messaggi in '_history' e i suoi token (calcolati una volta sola)
+        self.turn_index = turn_index
+        self.retrieval_k = retrieval_k
+        self.recent_exchanges = recent_exchanges
+        self.retrieval_max_tokens = retrieval_max_tokens
+        if turn_index is not None and token_counter is None:
+            token_counter = TokenCounter()
+        self.token_counter = token_counter
+        self._turns: List[Tuple[int, int]] = []
+        self._turn_tokens: List[int] = []
+        
+        # archivio delle conversazioni: '_unsaved_count' conta i messaggi in coda a '_history'
+        # non ancora salvati, così un salvataggio scrive solo quelli nuovi.
+        self.store = store
+        if load_last_n is None and turn_index is None:
+            load_last_n = 2 * window_size
+        self.load_last_n = load_last_n # None: tutti i messaggi
+        self._unsaved_count = 0
+        
+        # senza archivio, una conversazione '.lcv' si carica come dall'archivio, leggendo solo gli
+        # ultimi 'load_last_n' messaggi: qui il file e il numero dei messaggi iniziali rimasti
+        # nel file, che vengono riletti solo per salvare o esportare la conversazione completa.
+        self._file_source: Optional[Tuple[str, int]] = None
+        
+        # lock che rende il gestore sicuro se usato da più thread o coroutine:
+        # le letture e le modifiche della memoria non si sovrappongono mai.
+        self._lock = threading.RLock()
+        
     def _generate_conversation_id(self) -> str:
-        """Genera un ID univoco per la conversazione usando il timestamp corrente."""
-        return f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        """
+        Genera un ID univoco per la conversazione usando il timestamp corrente. Il suffisso
+        casuale distingue le conversazioni iniziate nello stesso secondo da sessioni diverse,
+        che altrimenti scriverebbero i propri messaggi nella stessa conversazione dell'archivio.
+        """
+        return f"conv_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
     
     def add_message(self, human_message: str, ai_message: str):
-        """Aggiunge uno scambio domanda-risposta alla memoria di LangChain."""
-        self.memory.chat_memory.add_user_message(human_message)
-        self.memory.chat_memory.add_ai_message(ai_message)
+        """Aggiunge uno scambio domanda-risposta alla memoria."""
+        with self._lock:
+            timestamp = datetime.now().isoformat()
+            self._record("human", human_message, timestamp)
+            self._record("ai", ai_message, timestamp)
+            self._unsaved_count += 2
+    
+    def _record(self, message_type: str, content: str, timestamp: str):
+        """Aggiorna cronologia e contesto incrementale con un nuovo messaggio."""
+        self._history.append(MessageRecord(message_type, content, timestamp))
+        evicted = self.context_builder.append(message_type, content)
+        if message_type == "ai" and self.turn_index is not None:
+            self._index_turn()
+        
+        # i messaggi usciti dalla finestra vengono riassunti in background, senza attendere
+        # (non nella modalità a recupero, dove restano disponibili nell'indice)
+        if evicted and self.summarizer is not None and self.turn_index is None:
+            self.summarizer.submit(evicted)
+    
+    def _index_turn(self):
+        """Indicizza lo scambio appena concluso da una risposta (con la domanda che la precede, se c'è)."""
+        end = len(self._history)
+        start = end - 2 if end >= 2 and self._history[-2].type == "human" else end - 1
+        text = "\n".join(f"{IncrementalContextBuilder.PREFIXES[r.type]}: {r.content}" for r in self._history[start:end])
+        self._turns.append((start, end))
+        self._turn_tokens.append(self.token_counter.count(text))
+        self.turn_index.add(text)
+    
+    def _reset_turns(self):
+        self._turns = []
+        self._turn_tokens = []
+        if self.turn_index is not None:
+            self.turn_index.reset()
+    
+    def _select_turns(self, query: str, token_budget: Optional[int]) -> List[Tuple[int, int]]:
+        """
+        Modalità a recupero: sceglie gli scambi da mettere nel contesto. Prima gli ultimi
+        'recent_exchanges' (dal più recente), poi i più pertinenti alla domanda tra quelli
+        precedenti, finché c'è budget. Restituisce gli intervalli di '_history' in ordine cronologico.
+        """
+        budget = self.retrieval_max_tokens if token_budget is None else token_budget
+        first_recent = max(0, len(self._turns) - self.recent_exchanges)
+        candidates = list(range(len(self._turns) - 1, first_recent - 1, -1))
+        candidates += [i for i, _ in self.turn_index.search(query, self.retrieval_k, limit=first_recent)]
+        
+        selected = []
+        for i in candidates:
+            # ogni scambio costa anche il separatore tra uno scambio e l'altro (circa un token)
+            if self._turn_tokens[i] + 1 > budget:
+                continue
+            budget -= self._turn_tokens[i] + 1
+            selected.append(i)
+        return [self._turns[i] for i in sorted(selected)]
     
     def get_conversation_history(self) -> List[Dict[str, str]]:
         """
         Restituisce la storia della conversazione come una lista di dizionari.
-        Questo formato è ideale per essere processato dalla UI o salvato in JSON.
-        """
-        messages = self.memory.chat_memory.messages
-        history = []
-        
-        for message in messages:
-            # distingue tra messaggi umani e dell'IA per creare un dizionario strutturato.
-            if isinstance(message, HumanMessage):
-                history.append({
-                    "type": "human",
-                    "content": message.content,
-                    "timestamp": datetime.now().isoformat()
-                })
-            elif isinstance(message, AIMessage):
-                history.append({
-                    "type": "ai",
-                    "content": message.content,
-                    "timestamp": datetime.now().isoformat()
-                })
-        
-        return history
-    
-    def get_context_for_llm(self) -> str:
+        Questo formato è ideale per essere salvato in JSON; ogni messaggio riporta
+        il momento reale in cui è stato scambiato.
+        
+        I dizionari vengono creati a ogni chiamata: per scorrere la cronologia
+        senza copiarla conviene get_messages().
+        """
+        with self._lock:
+            return [record.to_dict() for record in self._history]
+    
+    def get_messages(self) -> List[MessageRecord]:
+        """Restituisce la cronologia come lista di MessageRecord (attributi type, content, timestamp)."""
+        with self._lock:
+            return list(self._history)
+    
+    def get_context_for_llm(self, token_budget: Optional[int] = None, query: Optional[str] = None) -> str:
         """
         Formatta la storia della conversazione in una singola stringa di testo
         che può essere inserita nel prompt del modello LLM per dargli contesto.
+        
+        Include solo gli ultimi 'window_size' scambi (o, nella modalità a budget, i messaggi
+        più recenti che stanno in 'token_budget'); restituisce una stringa vuota
+        se la conversazione non è ancora iniziata.
+        Nella modalità a recupero, con 'query' (la nuova domanda) include gli ultimi
+        scambi e quelli passati più pertinenti; i salti tra scambi non consecutivi sono segnati con "...".
         """
-        messages = self.memory.chat_memory.messages
-        context_parts = []
+        if self.turn_index is not None and query is not None:
+            with self._lock:
+                lines, previous_end = [], None
+                for start, end in self._select_turns(query, token_budget):
+                    if previous_end is not None and start != previous_end:
+                        lines.append("...")
+                    lines.extend(f"{IncrementalContextBuilder.PREFIXES[r.type]}: {r.content}" for r in self._history[start:end])
+                    previous_end = end
+                return self.context_builder._format(lines)
         
-        for message in messages:
-            if isinstance(message, HumanMessage):
-                context_parts.append(f"Utente: {message.content}")
-            elif isinstance(message, AIMessage):
-                context_parts.append(f"Assistente: {message.content}")
+        summary = self.summarizer.get_summary() if self.summarizer is not None else ""
+        if not summary:
+            with self._lock:
+                return self.context_builder.render(token_budget)
         
-        # restituisce il contesto solo se la conversazione è iniziata.
-        if context_parts:
-            return "Contesto della conversazione precedente:\n" + "\n".join(context_parts) + "\n\n"
-        return ""
+        summary_block = f"Riassunto della conversazione precedente:\n{summary}\n\n"
+        if token_budget is not None and isinstance(self.context_builder, TokenBudgetContextBuilder):
+            # anche il riassunto occupa una parte del budget di token
+            token_budget -= self.context_builder.token_counter.count(summary_block)
+        with self._lock:
+            return summary_block + self.context_builder.render(token_budget)
+    
+    def get_messages_for_llm(self, token_budget: Optional[int] = None, query: Optional[str] = None) -> List:
+        """
+        Restituisce la cronologia da inviare all'LLM come oggetti HumanMessage/AIMessage
+        (modalità a messaggi strutturati), creati dai record solo per questa chiamata.
+        
+        Per sfruttare la cache del prompt del provider, l'inizio della finestra non scorre
+        a ogni turno ma avanza a blocchi di metà finestra: per diversi turni consecutivi la
+        cronologia comincia con gli stessi identici messaggi, quindi il prompt precedente è
+        un prefisso di quello nuovo. La finestra contiene sempre almeno gli ultimi
+        'window_size' scambi (e meno di una volta e mezza tanti).
+        Nella modalità a budget, se la cronologia non entra in 'token_budget', l'inizio
+        avanza sempre a blocchi, così il prefisso resta stabile.
+        Nella modalità a recupero, con 'query' restituisce gli scambi scelti come in
+        get_context_for_llm (qui il prefisso cambia con la domanda).
+        """
+        with self._lock:
+            if self.turn_index is not None and query is not None:
+                return [record.to_langchain()
+                        for start, end in self._select_turns(query, token_budget)
+                        for record in self._history[start:end]]
+
+            window = self.window_size
+            step = max(1, window // 2)
+            exchanges = len(self._history) // 2
+            start = 0 if exchanges <= window else (exchanges - window) // step * step
+            selected = self._history[2 * start:]
+            
+            if token_budget is not None and isinstance(self.context_builder, TokenBudgetContextBuilder):
+                count = self.context_builder.token_counter.count
+                total = sum(count(m.content) for m in selected)
+                while selected and total > token_budget:
+                    dropped, selected = selected[:2 * step], selected[2 * step:]
+                    total -= sum(count(m.content) for m in dropped)
+        return [record.to_langchain() for record in selected]
     
     def clear_memory(self):
         """Pulisce la memoria e inizia una nuova conversazione con un nuovo ID."""
-        self.memory.clear()
-        self.conversation_id = self._generate_conversation_id()
-        self.conversation_start = datetime.now()
+        with self._lock:
+            self._history = []
+            self._unsaved_count = 0
+            self._file_source = None
+            self.context_builder.reset()
+            self._reset_turns()
+            if self.summarizer is not None:
+                self.summarizer.reset()
+            self.conversation_id = self._generate_conversation_id()
+            self.conversation_start = datetime.now()
     
     def save_conversation(self, filename: Optional[str] = None) -> str:
-        """Salva la conversazione corrente su un file JSON."""
+        """
+        Salva la conversazione corrente.
+        
+        Con un archivio configurato e senza 'filename', aggiunge all'archivio solo i messaggi
+        nuovi e restituisce l'ID della conversazione; altrimenti la salva su un file JSON,
+        o nel formato binario di message_log se il nome del file termina con '.lcv'.
+        """
+        if self.store is not None and filename is None:
+            with self._lock:
+                new_messages = [record.to_dict() for record in self._history[len(self._history) - self._unsaved_count:]]
+                self.store.append_messages(self.conversation_id, self.conversation_start.isoformat(), new_messages)
+                self._unsaved_count = 0
+            return self.conversation_id
+        
         folder_path = "./memory"
 
         if filename is None:
             filename = os.path.join(folder_path, f"conversation_{self.conversation_id}.json")
         
+        records = self._full_history()
+        if filename.endswith(".lcv"):
+            return write_conversation(filename, self.conversation_id, self.conversation_start.isoformat(),
+                                      datetime.now().isoformat(), records)
+        
         conversation_data = {
             "conversation_id": self.conversation_id,
             "start_time": self.conversation_start.isoformat(),
             "end_time": datetime.now().isoformat(),
-            "messages": self.get_conversation_history()
+            "messages": [record.to_dict() for record in records]
         }
         
         # scrive i dati su file JSON, con indentazione per leggibilità.
@@ -108,28 +395,154 @@ class ConversationManager:
         
         return filename
     
+    def export_conversation(self, filename: str) -> str:
+        """Esporta la conversazione corrente, completa, nel formato JSON."""
+        if self.store is None:
+            return self.save_conversation(filename)
+        # con un archivio, la cronologia in memoria può contenere solo gli ultimi messaggi:
+        # prima si salvano quelli nuovi, poi si esporta la conversazione intera dall'archivio
+        self.save_conversation()
+        if filename.endswith(".lcv"):
+            conversation = self.store.get_conversation(self.conversation_id)
+            records = [MessageRecord(m["type"], m["content"], m["timestamp"])
+                       for m in self.store.load_messages(self.conversation_id)]
+            return write_conversation(filename, self.conversation_id, conversation["start_time"],
+                                      conversation["end_time"], records)
+        return self.store.export_json(self.conversation_id, filename)
+    
     def load_conversation(self, _filename: str):
-        """Carica una conversazione da un file JSON."""
+        """
+        Carica una conversazione: dall'archivio, se configurato, usando il suo ID
+        (leggendo solo gli ultimi 'load_last_n' messaggi), oppure da un file JSON
+        o binario ('.lcv'). Il file JSON si legge per intero; del file binario, senza
+        archivio, si leggono solo gli ultimi 'load_last_n' messaggi.
+        """
+        if self.store is not None and not _filename.endswith((".json", ".lcv")):
+            conversation = self.store.get_conversation(_filename)
+            if conversation is None:
+                raise KeyError(f"Conversazione non trovata: {_filename}")
+            messages = self.store.load_messages(_filename, last_n=self.load_last_n)
+            self._restore(_filename, conversation['start_time'], messages, unsaved=False)
+            return
+        
         folder_path = "./memory"
         filename = os.path.join(folder_path, _filename)
+        
+        if filename.endswith(".lcv"):
+            if self.store is not None:
+                # un'importazione nell'archivio: tutti i messaggi risultano da salvare, e
+                # salvarne solo gli ultimi perderebbe i precedenti
+                meta, records = read_conversation(filename)
+                self._restore(meta["conversation_id"], meta["start_time"], records, unsaved=True)
+                return
+            # con mmap si leggono solo l'indice e i contenuti degli ultimi messaggi
+            meta, records = read_conversation(filename, last_n=self.load_last_n)
+            self._restore(meta["conversation_id"], meta["start_time"], records, unsaved=True)
+            if meta["message_count"] > len(records):
+                self._file_source = (filename, meta["message_count"] - len(records))
+            return
 
         with open(filename, 'r', encoding='utf-8') as f:
             conv_data = json.load(f)
         
-        self.conversation_id = conv_data.get('conversation_id', self._generate_conversation_id())
-        self.conversation_start = datetime.fromisoformat(conv_data.get('start_time', datetime.now().isoformat()))
-        
-        # FONDAMENTALE: ricostruisce gli oggetti HumanMessage/AIMessage di LangChain
-        # dalla lista di dizionari letta dal file JSON.
-        loaded_messages = []
-        for msg_data in conv_data.get('messages', []):
-            if msg_data.get('type') == 'human':
-                loaded_messages.append(HumanMessage(content=msg_data['content']))
-            elif msg_data.get('type') == 'ai':
-                loaded_messages.append(AIMessage(content=msg_data['content']))
+        # con un archivio configurato, i messaggi importati da JSON verranno salvati al prossimo salvataggio
+        self._restore(conv_data.get('conversation_id', self._generate_conversation_id()),
+                      conv_data.get('start_time', datetime.now().isoformat()),
+                      conv_data.get('messages', []),
+                      unsaved=True)
+    
+    def get_state(self) -> Dict:
+        """
+        Restituisce lo stato del gestore in un dizionario serializzabile in JSON, per
+        salvarlo in un backend di sessione (vedi session_backend.py) e riprenderlo in un
+        altro processo. Contiene solo i messaggi che servono a riprendere: gli ultimi
+        'load_last_n' e quelli non ancora salvati nell'archivio, non l'intera cronologia.
+        """
+        with self._lock:
+            keep = len(self._history) if self.load_last_n is None else max(self.load_last_n, self._unsaved_count)
+            return {
+                "conversation_id": self.conversation_id,
+                "conversation_start": self.conversation_start.isoformat(),
+                "messages": [record.to_dict() for record in self._history[-keep:]] if keep else [],
+                "unsaved_count": self._unsaved_count,
+                "file_source": self._file_source,
+                "summary": self.summarizer.get_summary() if self.summarizer is not None else ""
+            }
+    
+    def set_state(self, state: Dict):
+        """
+        Ripristina uno stato prodotto da get_state(). A differenza del caricamento di una
+        conversazione, il riassunto viene ripreso così com'è e non si chiama l'LLM.
+        """
+        with self._lock:
+            self.conversation_id = state["conversation_id"]
+            self.conversation_start = datetime.fromisoformat(state["conversation_start"])
+            self._history = []
+            self.context_builder.reset()
+            self._reset_turns()
+            for msg in state["messages"]:
+                self._history.append(MessageRecord(msg["type"], msg["content"], msg["timestamp"]))
+                self.context_builder.append(msg["type"], msg["content"])
+                if msg["type"] == "ai" and self.turn_index is not None:
+                    self._index_turn()
+            self._unsaved_count = state["unsaved_count"]
+            self._file_source = tuple(state["file_source"]) if state.get("file_source") else None
+            if self.summarizer is not None:
+                self.summarizer.restore(state.get("summary", ""))
+    
+    def _restore(self, conversation_id: str, start_time: str, messages: List[Union[Dict[str, str], MessageRecord]], unsaved: bool):
+        """
+        Sostituisce lo stato del gestore con quello di una conversazione caricata.
+        'messages' sono i dizionari letti dal file JSON o dall'archivio, oppure i record letti dal formato binario.
+        """
+        with self._lock:
+            self.conversation_id = conversation_id
+            self.conversation_start = datetime.fromisoformat(start_time)
+            
+            # ricostruisce cronologia e contesto, conservando i timestamp salvati
+            self._history = []
+            self.context_builder.reset()
+            self._reset_turns()
+            if self.summarizer is not None:
+                self.summarizer.reset()
+            for msg in messages:
+                if isinstance(msg, MessageRecord):
+                    self._record(msg.type, msg.content, msg.timestamp)
+                elif msg.get('type') in ('human', 'ai'):
+                    self._record(msg['type'], msg['content'], msg.get('timestamp', start_time))
+            self._unsaved_count = len(self._history) if unsaved else 0
+            self._file_source = None
+    
+    def _full_history(self) -> List[MessageRecord]:
+        """
+        La cronologia completa da salvare su file: dopo un caricamento parziale da '.lcv',
+        anche i messaggi iniziali rimasti nel file (riletti solo ora).
+        """
+        with self._lock:
+            history = list(self._history)
+            source = self._file_source
+        if source is None:
+            return history
+        filename, skipped = source
+        return read_conversation(filename)[1][:skipped] + history
+
+
+class _Turn:
+    """
+    Stato di una singola richiesta al chatbot: le prenotazioni nel rate limiter e nel budget,
+    se ha chiamato davvero l'LLM, il consumo di token e l'eventuale cache hit. Ogni chiamata
+    ne crea uno, così più richieste contemporanee sullo stesso chatbot (es. con achat) non si
+    sovrascrivono a vicenda le prenotazioni e i consumi.
+    """
+
+    __slots__ = ("reservation", "quota_reservation", "llm_called", "usage", "cache_hit")
 
-        # assegna la lista di oggetti ricostruiti alla memoria di LangChain.
-        self.memory.chat_memory.messages = loaded_messages
+    def __init__(self):
+        self.reservation = None
+        self.quota_reservation = None
+        self.llm_called = False
+        self.usage: Dict = {}
+        self.cache_hit = False
 
 
 class ContextualChatBot:
@@ -138,9 +551,60 @@ class ContextualChatBot:
     Gestisce l'LLM e delega la gestione della memoria al ConversationManager.
     """
     
-    def __init__(self, llm, memory_window_size: int = 10):
+    def __init__(self, llm, memory_window_size: int = 10, response_cache=None, max_prompt_tokens: Optional[int] = None, summary_llm=None,
+                 conversation_store=None, instrumentation=None, structured_messages: bool = False, single_flight=None,
+                 rate_limiter=None, usage_quotas=None, quota_key: Optional[str] = None, priority: int = PRIORITY_NORMAL,
+                 retrieval_embeddings=None, retrieval_k: int = 4):
         self.llm = llm # l'oggetto LLM (es. ChatOpenAI) viene passato dall'esterno.
-        self.conversation_manager = ConversationManager(window_size=memory_window_size) # crea un'istanza del gestore della memoria.
+        
+        # controllo di ammissione prima di chiamare l'LLM (vedi rate_limiter.py): 'rate_limiter'
+        # mette in coda, per 'priority', le richieste oltre i limiti al minuto del processo e
+        # 'usage_quotas' rifiuta quelle che supererebbero il budget di token di 'quota_key'
+        # (un utente o, per default, questo chatbot).
+        self.rate_limiter = rate_limiter
+        self.usage_quotas = usage_quotas
+        self.quota_key = quota_key or f"chatbot_{uuid.uuid4().hex}"
+        self.priority = priority
+        
+        # con 'single_flight' (vedi single_flight.py) le richieste identiche contemporanee,
+        # anche di sessioni diverse, condividono un'unica chiamata all'LLM.
+        self.single_flight = single_flight
+        
+        # con 'structured_messages' il prompt è una lista di messaggi con i loro ruoli
+        # (SystemMessage + cronologia + nuovo HumanMessage) invece di un'unica stringa;
+        # l'inizio del prompt resta identico tra un turno e l'altro e il provider può metterlo in cache.
+        self.structured_messages = structured_messages
+        # messaggi dell'ultima richiesta, per misurare il prefisso stabile: è solo una misura, quindi
+        # con richieste contemporanee basta che ognuna legga e sostituisca la lista in un passo solo
+        self._previous_messages: List = []
+        
+        # misura la latenza di ogni fase di una richiesta (vedi instrumentation.py);
+        # per default le misure finiscono nell'istogramma condiviso dal processo.
+        self.instrumentation = instrumentation or get_default_instrumentation()
+        
+        # con 'max_prompt_tokens' la memoria è limitata dai token: system prompt, cronologia
+        # e nuovo messaggio insieme non superano mai questo budget.
+        self.max_prompt_tokens = max_prompt_tokens
+        self.token_counter = TokenCounter(getattr(llm, "model_name", "gpt-4o-mini"))
+        self.conversation_manager = ConversationManager(
+            window_size=memory_window_size,
+            max_context_tokens=max_prompt_tokens,
+            token_counter=self.token_counter,
+            # con 'summary_llm' (anche un modello più economico) gli scambi usciti dalla finestra
+            # vengono compattati in un riassunto invece di essere dimenticati.
+            summarizer=RollingSummarizer(summary_llm) if summary_llm is not None else None,
+            store=conversation_store, # archivio delle conversazioni (es. SQLiteConversationStore)
+            # con 'retrieval_embeddings' (es. HashingEmbeddings) tutti gli scambi restano in un indice
+            # vettoriale e il contesto contiene gli ultimi scambi più i 'retrieval_k' più pertinenti alla domanda.
+            turn_index=TurnIndex(retrieval_embeddings) if retrieval_embeddings is not None else None,
+            retrieval_k=retrieval_k
+        ) # crea un'istanza del gestore della memoria.
+        
+        # cache delle risposte opzionale (es. ResponseCache), condivisibile tra più chatbot.
+        self.response_cache = response_cache
+        # esito dell'ultima richiesta conclusa: le richieste in corso tengono il proprio in un _Turn
+        self.last_cache_hit = False # indica se l'ultima risposta è arrivata dalla cache
+        self.last_usage: Dict = {} # consumo di token reale dell'ultima risposta (vedi _get_usage)
         
         # il 'system prompt' istruisce l'LLM su come comportarsi.
         self.system_prompt = """
@@ -148,28 +612,407 @@ class ContextualChatBot:
             Mantieni il contesto della conversazione e fornisci risposte coerenti e pertinenti.
             Se fai riferimento a informazioni discusse precedentemente, menzionalo esplicitamente.
         """
+        # creato una sola volta: lo stesso oggetto apre ogni richiesta in modalità strutturata
+        self.system_message = SystemMessage(content=self.system_prompt)
+    
+    def _build_prompt(self, user_message: str, trace) -> Tuple[Union[str, List], str, str]:
+        """
+        Costruisce il prompt completo: istruzioni + contesto + nuovo messaggio.
+        Restituisce l'input da passare all'LLM (una stringa, o una lista di messaggi in
+        modalità strutturata), il prompt in forma di testo e il suo prefisso
+        (istruzioni + contesto), che la cache delle risposte usa come chiave e ambito.
+        """
+        if self.structured_messages:
+            return self._build_messages(user_message, trace)
+        
+        with trace.stage("build_context"):
+            token_budget = None
+            if self.max_prompt_tokens is not None:
+                # il system prompt e il nuovo messaggio sono sempre inclusi: alla cronologia resta il budget avanzato
+                user_part = f"Utente: {user_message}\nAssistente:"
+                token_budget = self.max_prompt_tokens - self.token_counter.count(self.system_prompt) - self.token_counter.count(user_part)
+            context = self.conversation_manager.get_context_for_llm(token_budget, query=user_message)
+        
+        with trace.stage("build_prompt"):
+            prefix = f"{self.system_prompt}\n\n{context}"
+            full_prompt = f"{prefix}Utente: {user_message}\nAssistente:"
+        trace.set(prompt_chars=len(full_prompt))
+        return full_prompt, full_prompt, prefix
+    
+    def _build_messages(self, user_message: str, trace) -> Tuple[List, str, str]:
+        """
+        Modalità a messaggi strutturati: [SystemMessage, cronologia..., HumanMessage].
+        
+        L'ordine mette prima tutto ciò che non cambia tra un turno e l'altro (system prompt
+        e cronologia, vedi get_messages_for_llm) e dopo ciò che cambia (l'eventuale riassunto
+        e il nuovo messaggio), così la cache del prompt del provider copre il prefisso più lungo.
+        Registra nella traccia quanti token iniziali coincidono con la richiesta precedente.
+        """
+        with trace.stage("build_context"):
+            token_budget = None
+            if self.max_prompt_tokens is not None:
+                token_budget = self.max_prompt_tokens - self.token_counter.count(self.system_prompt) - self.token_counter.count(user_message)
+            summarizer = self.conversation_manager.summarizer
+            summary = summarizer.get_summary() if summarizer is not None else ""
+            if summary:
+                summary = f"Riassunto della conversazione precedente:\n{summary}"
+                if token_budget is not None:
+                    token_budget -= self.token_counter.count(summary)
+            history = self.conversation_manager.get_messages_for_llm(token_budget, query=user_message)
+        
+        with trace.stage("build_prompt"):
+            messages = [self.system_message, *history]
+            prefix = "\n".join(f"{m.type}: {m.content}" for m in messages)
+            full_prompt = prefix
+            if summary:
+                messages.append(SystemMessage(content=summary))
+                full_prompt += f"\nsystem: {summary}"
+            messages.append(HumanMessage(content=user_message))
+            full_prompt += f"\nhuman: {user_message}"
+            
+            # prefisso stabile: i messaggi iniziali identici a quelli della richiesta precedente
+            stable = 0
+            for previous, current in zip(self._previous_messages, messages):
+                if previous.type != current.type or previous.content != current.content:
+                    break
+                stable += 1
+            self._previous_messages = messages
+        trace.set(prompt_chars=len(full_prompt),
+                  prefix_tokens=sum(self.token_counter.count(m.content) for m in messages[:stable]))
+        return messages, full_prompt, prefix
+    
+    def _finish_trace(self, trace, turn: "_Turn"):
+        """
+        Completa la traccia della richiesta con cache hit e token del prompt, poi la invia ai sink.
+        Pubblica anche l'esito della richiesta in 'last_usage' e 'last_cache_hit'.
+        """
+        self.last_usage, self.last_cache_hit = turn.usage, turn.cache_hit
+        trace.set(cache_hit=turn.cache_hit)
+        if turn.usage:
+            trace.set(prompt_tokens=turn.usage["prompt_tokens"], model=turn.usage["model"] or "")
+        trace.finish()
+    
+    def _admit(self, full_prompt: str, turn: "_Turn") -> int:
+        """
+        Prenota i token del prompt nel budget prima di chiamare l'LLM (solo se la risposta non
+        è in cache): solleva QuotaExceeded se lo farebbero superare. Restituisce i token del prompt.
+        """
+        if self.rate_limiter is None and self.usage_quotas is None:
+            return 0
+        prompt_tokens = self.token_counter.count(full_prompt)
+        if self.usage_quotas is not None:
+            turn.quota_reservation = self.usage_quotas.reserve(self.quota_key, prompt_tokens)
+        return prompt_tokens
+    
+    def _reserve(self, prompt_tokens: int, trace, turn: "_Turn"):
+        """Attende il turno della richiesta nel rate limiter condiviso (solo chi chiama davvero l'LLM)."""
+        if self.rate_limiter is not None:
+            with trace.stage("rate_limit"):
+                turn.reservation = self.rate_limiter.acquire(prompt_tokens, self.priority)
+    
+    def _record_admitted_usage(self, turn: "_Turn"):
+        """
+        Corregge le prenotazioni del rate limiter e del budget con i token realmente consumati
+        dalla risposta (nessuno se la chiamata è fallita o la risposta era condivisa).
+        """
+        total_tokens = turn.usage.get("total_tokens", 0)
+        if turn.reservation is not None:
+            turn.reservation.settle(total_tokens)
+            turn.reservation = None
+        if turn.quota_reservation is not None:
+            turn.quota_reservation.settle(total_tokens)
+            turn.quota_reservation = None
+    
+    def _invoke(self, llm_input, full_prompt: str, prompt_tokens: int, trace, turn: "_Turn") -> Tuple[object, bool]:
+        """Chiama l'LLM, o attende la stessa richiesta già in corso. Restituisce (risposta, condivisa)."""
+        def call():
+            self._reserve(prompt_tokens, trace, turn)
+            return self.llm.invoke(llm_input)
+        
+        if self.single_flight is None:
+            return call(), False
+        key = self.single_flight.make_key(self.llm, full_prompt)
+        # un rifiuto del rate limiter riguarda solo chi guidava la chiamata: chi attendeva riprova
+        return self.single_flight.do(key, call, retry_on=(AdmissionRejected,))
+    
+    async def _ainvoke(self, llm_input, full_prompt: str, prompt_tokens: int, trace, turn: "_Turn") -> Tuple[object, bool]:
+        async def call():
+            if self.rate_limiter is not None:
+                with trace.stage("rate_limit"):
+                    turn.reservation = await self.rate_limiter.aacquire(prompt_tokens, self.priority)
+            return await self.llm.ainvoke(llm_input)
+        
+        if self.single_flight is None:
+            return await call(), False
+        key = self.single_flight.make_key(self.llm, full_prompt)
+        return await self.single_flight.ado(key, call, retry_on=(AdmissionRejected,))
+    
+    def _stream(self, llm_input, full_prompt: str, prompt_tokens: int, trace, turn: "_Turn") -> Tuple[Iterator, bool]:
+        def call():
+            self._reserve(prompt_tokens, trace, turn)
+            turn.llm_called = True
+            return self.llm.stream(llm_input)
+        
+        if self.single_flight is None:
+            return call(), False
+        key = self.single_flight.make_key(self.llm, full_prompt, mode="stream")
+        return self.single_flight.stream(key, call, retry_on=(AdmissionRejected,))
+    
+    def _shared_response(self, trace, turn: "_Turn"):
+        """
+        La risposta è arrivata da una richiesta identica di un altro utente: come per la
+        cache, questa richiesta non ha speso token e la risposta è già stata messa in cache.
+        """
+        turn.cache_hit = True
+        turn.usage = {}
+        self._record_admitted_usage(turn)
+        trace.set(coalesced=True)
+    
+    def _get_cached_response(self, full_prompt: str, user_message: str, prefix: str, turn: "_Turn") -> Optional[str]:
+        """Cerca la risposta nella cache, se configurata, e registra l'esito in 'turn'."""
+        cached = None
+        if self.response_cache is not None:
+            cached = self.response_cache.get(full_prompt, question=user_message, scope=prefix)
+        turn.cache_hit = cached is not None
+        return cached
     
-    def chat(self, user_message: str) -> str:
+    def _store_cached_response(self, full_prompt: str, user_message: str, prefix: str, ai_response: str):
+        """Salva nella cache, se configurata, una risposta appena generata dall'LLM."""
+        if self.response_cache is not None:
+            self.response_cache.put(full_prompt, ai_response, question=user_message, scope=prefix)
+    
+    def _get_usage(self, full_prompt: str, ai_response: str, usage_metadata: Optional[Dict] = None,
+                   response_metadata: Optional[Dict] = None, prefix_tokens: int = 0) -> Dict:
+        """
+        Restituisce il consumo di token di una risposta nel formato atteso da TokenMonitor.
+        
+        Usa i conteggi reali restituiti dall'API ('usage_metadata' di LangChain oppure
+        'token_usage' nei 'response_metadata' di OpenAI), inclusi i token del prompt letti
+        dalla cache del provider. Se il provider non li fornisce, conta i token del prompt
+        effettivamente inviato e della risposta con il tokenizer locale.
+        
+        Riporta anche il modello che ha risposto (es. quello scelto da ModelRouter),
+        perché TokenMonitor applichi il suo listino, e i token del prefisso identico alla
+        richiesta precedente ('prefix_tokens'), candidati alla cache del prompt del provider.
+        """
+        response_metadata = response_metadata or {}
+        model = response_metadata.get("model_name") or getattr(self.llm, "model_name", None)
+        
+        if usage_metadata:
+            return {
+                "prompt_tokens": usage_metadata.get("input_tokens", 0),
+                "completion_tokens": usage_metadata.get("output_tokens", 0),
+                "total_tokens": usage_metadata.get("total_tokens", 0),
+                "cached_prompt_tokens": (usage_metadata.get("input_token_details") or {}).get("cache_read", 0),
+                "prefix_tokens": prefix_tokens,
+                "model": model,
+                "source": "api"
+            }
+        
+        token_usage = response_metadata.get("token_usage")
+        if token_usage:
+            return {
+                "prompt_tokens": token_usage.get("prompt_tokens", 0),
+                "completion_tokens": token_usage.get("completion_tokens", 0),
+                "total_tokens": token_usage.get("total_tokens", 0),
+                "cached_prompt_tokens": (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+                "prefix_tokens": prefix_tokens,
+                "model": model,
+                "source": "api"
+            }
+        
+        prompt_tokens = self.token_counter.count(full_prompt)
+        completion_tokens = self.token_counter.count(ai_response)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cached_prompt_tokens": 0,
+            "prefix_tokens": prefix_tokens,
+            "model": model,
+            "source": "tokenizer" if self.token_counter.is_exact else "estimate"
+        }
+    
+    def chat(self, user_message: str, return_usage: bool = False) -> Union[str, Tuple[str, Dict]]:
         """
         Processa un messaggio dell'utente, genera una risposta e aggiorna la memoria.
         Questo è il ciclo di interazione principale.
+        
+        Con 'return_usage=True' restituisce la coppia (risposta, consumo di token),
+        pronta da passare a TokenMonitor.log_interaction.
         """
-        # 1. ottiene il contesto dalla memoria.
-        context = self.conversation_manager.get_context_for_llm()
+        trace = self.instrumentation.start_trace()
+        turn = _Turn()
+        try:
+            # 1-2. ottiene il contesto dalla memoria e costruisce il prompt completo.
+            llm_input, full_prompt, prefix = self._build_prompt(user_message, trace)
+            
+            # 3. chiama l'LLM per ottenere una risposta, a meno che non sia già in cache.
+            with trace.stage("cache_lookup"):
+                ai_response = self._get_cached_response(full_prompt, user_message, prefix, turn)
+            if ai_response is None:
+                prompt_tokens = self._admit(full_prompt, turn)
+                try:
+                    with trace.stage("llm_invoke"):
+                        response, shared = self._invoke(llm_input, full_prompt, prompt_tokens, trace, turn)
+                except BaseException:
+                    # la chiamata non ha prodotto una risposta: le prenotazioni vengono rilasciate
+                    self._record_admitted_usage(turn)
+                    raise
+                ai_response = response.content
+                if shared:
+                    self._shared_response(trace, turn)
+                else:
+                    turn.usage = self._get_usage(full_prompt, ai_response, response.usage_metadata, response.response_metadata,
+                                                 trace.attributes.get("prefix_tokens", 0))
+                    self._record_admitted_usage(turn)
+                    self._store_cached_response(full_prompt, user_message, prefix, ai_response)
+            
+            # 4. aggiunge il nuovo scambio (domanda+risposta) alla memoria.
+            with trace.stage("update_memory"):
+                self.conversation_manager.add_message(user_message, ai_response)
+        except Exception as e:
+            trace.finish(error=e)
+            raise
+        self._finish_trace(trace, turn)
         
-        # 2. costruisce il prompt completo: istruzioni + contesto + nuovo messaggio.
-        full_prompt = f"{self.system_prompt}\n\n{context}Utente: {user_message}\nAssistente:"
+        # 5. restituisce la risposta dell'IA.
+        if return_usage:
+            return ai_response, turn.usage
+        return ai_response
+    
+    def chat_stream(self, user_message: str) -> Iterator[str]:
+        """
+        Variante in streaming di chat(): restituisce un generatore che produce
+        la risposta un frammento alla volta, man mano che l'LLM la genera.
         
-        # 3. chiama l'LLM per ottenere una risposta.
-        response = self.llm.invoke(full_prompt)
-        ai_response = response.content
+        Lo scambio viene aggiunto alla memoria solo quando lo stream è terminato:
+        se il generatore viene interrotto a metà, la memoria resta invariata (ma i token
+        già spesi vengono contati nel budget e la traccia viene chiusa come abbandonata).
+        A stream concluso, il consumo di token è disponibile in 'last_usage'.
         
-        # 4. aggiunge il nuovo scambio (domanda+risposta) alla memoria.
-        self.conversation_manager.add_message(user_message, ai_response)
+        Oltre alle fasi di chat(), la traccia registra il time-to-first-token:
+        il tempo che l'utente attende prima di vedere comparire la risposta.
+        """
+        trace = self.instrumentation.start_trace("chat_turn_stream")
+        turn = _Turn()
+        try:
+            llm_input, full_prompt, prefix = self._build_prompt(user_message, trace)
+            
+            # una risposta in cache viene restituita subito, in un unico frammento.
+            with trace.stage("cache_lookup"):
+                cached = self._get_cached_response(full_prompt, user_message, prefix, turn)
+            if cached is not None:
+                trace.mark_first_token()
+                yield cached
+                with trace.stage("update_memory"):
+                    self.conversation_manager.add_message(user_message, cached)
+                self._finish_trace(trace, turn)
+                return
+            
+            # 'stream()' è l'interfaccia standard di LangChain per ricevere i token
+            # appena disponibili, invece di attendere l'intera risposta come 'invoke()'.
+            chunks = []
+            usage_metadata = None
+            response_metadata = {}
+            prompt_tokens = self._admit(full_prompt, turn)
+            try:
+                with trace.stage("llm_stream"):
+                    # con 'single_flight' lo stream può essere quello di una richiesta identica già in corso
+                    stream, _ = self._stream(llm_input, full_prompt, prompt_tokens, trace, turn)
+                    for chunk in stream:
+                        if chunk.content:
+                            trace.mark_first_token()
+                            chunks.append(chunk.content)
+                            yield chunk.content
+                        # con OpenAI il consumo di token arriva nell'ultimo frammento (vedi 'stream_usage')
+                        if getattr(chunk, "usage_metadata", None):
+                            usage_metadata = add_usage(usage_metadata, chunk.usage_metadata)
+                        # il nome del modello (es. quello scelto dal router) arriva nei metadati dei frammenti
+                        response_metadata.update(chunk.response_metadata)
+            finally:
+                # anche se lo stream si interrompe (errore, o generatore abbandonato da un rerun
+                # o dallo Stop di Streamlit) i token spesi contano nel budget e nel rate limiter:
+                # senza il consumo dell'ultimo frammento si stimano da prompt e frammenti ricevuti.
+                # Lo stream è condiviso se questa richiesta non ha chiamato l'LLM: anche chi si era
+                # accodato lo chiama, se il leader è stato rifiutato dal rate limiter (vedi _stream)
+                shared = not turn.llm_called
+                if not shared:
+                    turn.usage = self._get_usage(full_prompt, "".join(chunks), usage_metadata, response_metadata,
+                                                 trace.attributes.get("prefix_tokens", 0))
+                self._record_admitted_usage(turn)
+            
+            # lo stream è completo: registra lo scambio in memoria.
+            ai_response = "".join(chunks)
+            if shared:
+                self._shared_response(trace, turn)
+            else:
+                self._store_cached_response(full_prompt, user_message, prefix, ai_response)
+            with trace.stage("update_memory"):
+                self.conversation_manager.add_message(user_message, ai_response)
+        except GeneratorExit:
+            # chi legge ha smesso a metà: la traccia resta nelle misure, segnata come abbandonata
+            trace.set(abandoned=True)
+            self._finish_trace(trace, turn)
+            raise
+        except Exception as e:
+            trace.finish(error=e)
+            raise
+        self._finish_trace(trace, turn)
+    
+    async def achat(self, user_message: str, return_usage: bool = False) -> Union[str, Tuple[str, Dict]]:
+        """
+        Versione asincrona di chat() basata su 'ainvoke()'.
+        Mentre attende l'LLM non occupa alcun thread, quindi un solo processo può
+        servire molte conversazioni contemporaneamente con asyncio.
         
-        # 5. restituisce la risposta dell'IA.
+        Più chiamate contemporanee sullo stesso chatbot sono possibili: prenotazioni e consumo
+        di ognuna restano separati (con 'return_usage=True' restituisce il proprio consumo,
+        mentre 'last_usage' riporta quello dell'ultima richiesta conclusa).
+        """
+        trace = self.instrumentation.start_trace()
+        turn = _Turn()
+        try:
+            llm_input, full_prompt, prefix = self._build_prompt(user_message, trace)
+            
+            with trace.stage("cache_lookup"):
+                ai_response = self._get_cached_response(full_prompt, user_message, prefix, turn)
+            if ai_response is None:
+                prompt_tokens = self._admit(full_prompt, turn)
+                try:
+                    with trace.stage("llm_invoke"):
+                        response, shared = await self._ainvoke(llm_input, full_prompt, prompt_tokens, trace, turn)
+                except BaseException:
+                    # la chiamata non ha prodotto una risposta: le prenotazioni vengono rilasciate
+                    self._record_admitted_usage(turn)
+                    raise
+                ai_response = response.content
+                if shared:
+                    self._shared_response(trace, turn)
+                else:
+                    turn.usage = self._get_usage(full_prompt, ai_response, response.usage_metadata, response.response_metadata,
+                                                 trace.attributes.get("prefix_tokens", 0))
+                    self._record_admitted_usage(turn)
+                    self._store_cached_response(full_prompt, user_message, prefix, ai_response)
+            
+            with trace.stage("update_memory"):
+                self.conversation_manager.add_message(user_message, ai_response)
+        except Exception as e:
+            trace.finish(error=e)
+            raise
+        self._finish_trace(trace, turn)
+        if return_usage:
+            return ai_response, turn.usage
         return ai_response
     
+    def get_state(self) -> Dict:
+        """Stato della sessione del chatbot, serializzabile in JSON (vedi ConversationManager.get_state)."""
+        return {"conversation": self.conversation_manager.get_state()}
+    
+    def set_state(self, state: Dict):
+        """Riprende una sessione salvata con get_state(), anche da un altro processo."""
+        self.conversation_manager.set_state(state["conversation"])
+    
     def reset_conversation(self):
         """Resetta la conversazione corrente."""
         self.conversation_manager.clear_memory()
@@ -180,4 +1023,8 @@ class ContextualChatBot:
     
     def load_conversation(self, filename: str):
         """Carica una conversazione esistente."""
-        return self.conversation_manager.load_conversation(filename)
\ No newline at end of file
+        return self.conversation_manager.load_conversation(filename)
+    
+    def export_conversation(self, filename: str) -> str:
+        """Esporta la conversazione corrente in formato JSON."""
+        return self.conversation_manager.export_conversation(filename)
@@ -0,0 +1,237 @@
+import re
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+
+
+class ConversationSearch:
+    """
+    Ricerca tra le conversazioni salvate in un SQLiteConversationStore.
+
+    - Full-text: un indice invertito SQLite FTS5 sulla tabella dei messaggi, aggiornato da un
+      trigger nella stessa transazione del salvataggio; i risultati sono ordinati per BM25
+      e accompagnati da uno snippet con i termini evidenziati.
+    - Similarità (opzionale, se viene passato un modello di 'embeddings'): ogni conversazione
+      ha un vettore (la media degli embedding dei suoi messaggi) aggiornato in modo incrementale
+      a ogni salvataggio e tenuto in memoria in una matrice NumPy, interrogata con un solo prodotto.
+
+    Nessuna ricerca legge i file o riscorre i messaggi: si interrogano solo gli indici.
+    """
+
+    SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            content='messages',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (new.rowid, new.content);
+        END;
+        CREATE TABLE IF NOT EXISTS conversation_embeddings (
+            conversation_id TEXT PRIMARY KEY,
+            vector BLOB NOT NULL,
+            message_count INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, store, embeddings=None):
+        self.store = store
+        self.embeddings = embeddings
+
+        # connessione propria allo stesso database dell'archivio (in modalità WAL le letture
+        # non bloccano i salvataggi); 'timeout' attende se un altro writer è attivo
+        self._conn = sqlite3.connect(store.db_path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+
+        with self._lock, self._conn:
+            is_new = self._conn.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE name = 'messages_fts'"
+            ).fetchone()[0] == 0
+            self._conn.executescript(self.SCHEMA)
+            # alla creazione, l'indice viene popolato con i messaggi già salvati
+            if is_new:
+                self._conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+
+        # indice vettoriale in memoria: una riga della matrice per conversazione.
+        # La matrice ha una capacità che raddoppia quando è piena, come una lista Python,
+        # quindi aggiungere una conversazione non ricopia ogni volta tutti i vettori.
+        self._conversation_ids: List[str] = []
+        self._row_by_id: Dict[str, int] = {}
+        self._vector_sums = np.zeros((0, 0), dtype=np.float32)
+        self._message_counts = np.zeros(0, dtype=np.int64)
+
+        if self.embeddings is not None:
+            self._load_embeddings()
+            store.add_append_listener(self._on_append)
+
+    @staticmethod
+    def _to_fts_query(query: str) -> str:
+        """
+        Converte il testo dell'utente in una query FTS5 sicura: ogni parola diventa un termine
+        tra virgolette (così i caratteri speciali non sono interpretati come operatori)
+        e l'ultima viene cercata anche come prefisso, per la ricerca mentre si digita.
+        """
+        words = re.findall(r"\w+", query)
+        if not words:
+            return ""
+        terms = [f'"{w}"' for w in words]
+        terms[-1] += "*"
+        return " ".join(terms)
+
+    def search(self, query: str, limit: int = 10) -> List[Dict]:
+        """
+        Cerca il testo nelle conversazioni salvate e restituisce al massimo 'limit' conversazioni,
+        dalla più pertinente, ciascuna con lo snippet del messaggio migliore.
+        """
+        fts_query = self._to_fts_query(query)
+        if not fts_query:
+            return []
+
+        # il raggruppamento per conversazione avviene in SQL, prima del LIMIT: anche se una
+        # conversazione ha molti messaggi pertinenti, ne conta uno solo (il migliore, che con
+        # MIN() SQLite restituisce insieme alla sua riga). Nel GROUP BY si usa la colonna 'rank'
+        # di FTS5 (per default il punteggio BM25) perché bm25() non si può usare in un'aggregazione;
+        # lo snippet si calcola poi, con una seconda MATCH, solo sui messaggi scelti.
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                WITH best AS (
+                    SELECT m.conversation_id, messages_fts.rowid AS message_rowid, MIN(messages_fts.rank) AS score
+                    FROM messages_fts
+                    JOIN messages AS m ON m.rowid = messages_fts.rowid
+                    WHERE messages_fts MATCH ?
+                    GROUP BY m.conversation_id
+                    ORDER BY score
+                    LIMIT ?
+                )
+                SELECT best.conversation_id, m.position, m.type,
+                       snippet(messages_fts, 0, '**', '**', '…', 16) AS snippet,
+                       best.score
+                FROM messages_fts
+                JOIN best ON best.message_rowid = messages_fts.rowid
+                JOIN messages AS m ON m.rowid = messages_fts.rowid
+                WHERE messages_fts MATCH ?
+                ORDER BY best.score
+                """,
+                (fts_query, limit, fts_query)
+            ).fetchall()
+
+        return [
+            {
+                "conversation_id": conversation_id,
+                "position": position,
+                "type": message_type,
+                "snippet": snippet,
+                # BM25 in FTS5 è negativo: più è basso, più il risultato è pertinente
+                "score": -score
+            }
+            for conversation_id, position, message_type, snippet, score in rows
+        ]
+
+    def search_similar(self, query: str, limit: int = 10) -> List[Dict]:
+        """Restituisce le conversazioni il cui contenuto è più simile al testo indicato."""
+        if self.embeddings is None:
+            raise ValueError("La ricerca per similarità richiede un modello di embeddings")
+
+        vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        with self._lock:
+            size = len(self._conversation_ids)
+            if not size or not np.linalg.norm(vector):
+                return []
+            # similarità coseno con tutte le conversazioni in un'unica operazione
+            matrix = self._vector_sums[:size]
+            norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(vector)
+            scores = (matrix @ vector) / np.where(norms == 0, 1.0, norms)
+            top = np.argsort(scores)[::-1][:limit]
+            matches = [(self._conversation_ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+        results = []
+        for conversation_id, score in matches:
+            # come snippet si usa l'ultimo messaggio, letto con una query sull'indice
+            last = self.store.load_messages(conversation_id, last_n=1)
+            snippet = last[0]["content"][:160] if last else ""
+            results.append({"conversation_id": conversation_id, "snippet": snippet, "score": score})
+        return results
+
+    def _load_embeddings(self):
+        """Carica in memoria i vettori salvati e calcola quelli delle conversazioni mancanti."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT conversation_id, vector, message_count FROM conversation_embeddings"
+            ).fetchall()
+            for conversation_id, blob, count in rows:
+                self._set_row(conversation_id, np.frombuffer(blob, dtype=np.float32).copy(), count)
+
+            missing = self._conn.execute(
+                "SELECT conversation_id FROM conversations WHERE conversation_id NOT IN "
+                "(SELECT conversation_id FROM conversation_embeddings)"
+            ).fetchall()
+
+        for (conversation_id,) in missing:
+            self._on_append(conversation_id, self.store.load_messages(conversation_id))
+
+    def _on_append(self, conversation_id: str, messages: List[Dict]):
+        """Aggiorna il vettore della conversazione con i soli messaggi appena salvati."""
+        if not messages:
+            return
+        vectors = np.asarray([self.embeddings.embed_query(m["content"]) for m in messages], dtype=np.float32)
+
+        with self._lock:
+            row = self._row_by_id.get(conversation_id)
+            if row is None:
+                vector_sum, count = vectors.sum(axis=0), len(messages)
+            else:
+                vector_sum = self._vector_sums[row] + vectors.sum(axis=0)
+                count = int(self._message_counts[row]) + len(messages)
+            self._set_row(conversation_id, vector_sum, count)
+
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO conversation_embeddings (conversation_id, vector, message_count) VALUES (?, ?, ?)",
+                    (conversation_id, vector_sum.astype(np.float32).tobytes(), count)
+                )
+
+    def _set_row(self, conversation_id: str, vector_sum: np.ndarray, count: int):
+        # si conserva la somma dei vettori: per la similarità coseno equivale alla media
+        row = self._row_by_id.get(conversation_id)
+        if row is not None:
+            self._vector_sums[row] = vector_sum
+            self._message_counts[row] = count
+            return
+
+        size = len(self._conversation_ids)
+        if size == self._vector_sums.shape[0]:
+            capacity = max(64, 2 * size)
+            vector_sums = np.zeros((capacity, vector_sum.shape[0]), dtype=np.float32)
+            if size:
+                vector_sums[:size] = self._vector_sums[:size]
+            message_counts = np.zeros(capacity, dtype=np.int64)
+            message_counts[:size] = self._message_counts[:size]
+            self._vector_sums, self._message_counts = vector_sums, message_counts
+
+        self._vector_sums[size] = vector_sum
+        self._message_counts[size] = count
+        self._row_by_id[conversation_id] = size
+        self._conversation_ids.append(conversation_id)
+
+    def close(self):
+        """Chiude la connessione al database."""
+        with self._lock:
+            self._conn.close()
+
+
+# un indice di ricerca per archivio, condiviso dal processo.
+_shared_searches: Dict[str, ConversationSearch] = {}
+_shared_searches_lock = threading.Lock()
+
+
+def get_shared_conversation_search(store, embeddings=None) -> ConversationSearch:
+    """Restituisce l'indice di ricerca del processo per l'archivio indicato, creandolo se necessario."""
+    with _shared_searches_lock:
+        search = _shared_searches.get(store.db_path)
+        if search is None:
+            search = ConversationSearch(store, embeddings=embeddings)
+            _shared_searches[store.db_path] = search
+        return search
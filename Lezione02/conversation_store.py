@@ -0,0 +1,247 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+
+class ConversationStore(ABC):
+    """
+    Interfaccia comune degli archivi di conversazioni usati da ConversationManager
+    (un archivio che non implementa tutti i metodi astratti non si può istanziare).
+    Un archivio salva i messaggi in modo incrementale (solo quelli nuovi), carica solo
+    gli ultimi N messaggi di una conversazione e offre un elenco economico delle
+    conversazioni salvate per la UI.
+    """
+
+    def __init__(self):
+        # funzioni chiamate dopo ogni salvataggio con (conversation_id, messaggi aggiunti):
+        # permettono ad altri componenti (es. l'indice di ricerca) di aggiornarsi in modo incrementale
+        self._append_listeners: List[Callable[[str, List[Dict]], None]] = []
+
+    def add_append_listener(self, callback: Callable[[str, List[Dict]], None]):
+        """Registra una funzione da chiamare dopo ogni append_messages."""
+        self._append_listeners.append(callback)
+
+    def _notify_append(self, conversation_id: str, messages: List[Dict]):
+        for callback in self._append_listeners:
+            callback(conversation_id, messages)
+
+    @abstractmethod
+    def append_messages(self, conversation_id: str, start_time: str, messages: List[Dict[str, str]], end_time: Optional[str] = None):
+        """
+        Aggiunge in coda alla conversazione i messaggi indicati (creandola se non esiste).
+        'end_time' è la data di ultimo aggiornamento da registrare (per default l'istante corrente).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def load_messages(self, conversation_id: str, last_n: Optional[int] = None, before: Optional[int] = None) -> List[Dict[str, str]]:
+        """Restituisce gli ultimi 'last_n' messaggi (tutti se None), opzionalmente solo quelli prima della posizione 'before'."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        """Restituisce i metadati di una conversazione, o None se non esiste."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def list_conversations(self, limit: int = 100) -> List[Dict]:
+        """Restituisce i metadati delle conversazioni più recenti."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def count_conversations(self) -> int:
+        """Restituisce il numero di conversazioni salvate."""
+        raise NotImplementedError
+
+    def export_json(self, conversation_id: str, filename: str) -> str:
+        """Esporta una conversazione nel formato JSON storico di ConversationManager."""
+        conversation = self.get_conversation(conversation_id)
+        if conversation is None:
+            raise KeyError(conversation_id)
+
+        conversation_data = {
+            "conversation_id": conversation_id,
+            "start_time": conversation["start_time"],
+            "end_time": conversation["end_time"],
+            "messages": [
+                {"type": msg["type"], "content": msg["content"], "timestamp": msg["timestamp"]}
+                for msg in self.load_messages(conversation_id)
+            ]
+        }
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(conversation_data, f, indent=2, ensure_ascii=False)
+        return filename
+
+    def import_json(self, filename: str) -> str:
+        """Importa un file JSON nel formato storico e restituisce l'ID della conversazione."""
+        with open(filename, 'r', encoding='utf-8') as f:
+            conv_data = json.load(f)
+
+        conversation_id = conv_data.get('conversation_id') or os.path.splitext(os.path.basename(filename))[0]
+        start_time = conv_data.get('start_time', datetime.now().isoformat())
+        messages = [
+            {
+                "type": msg['type'],
+                "content": msg['content'],
+                "timestamp": msg.get('timestamp', start_time)
+            }
+            for msg in conv_data.get('messages', [])
+            if msg.get('type') in ('human', 'ai')
+        ]
+        # una conversazione già importata non viene duplicata
+        if self.get_conversation(conversation_id) is None:
+            self.append_messages(conversation_id, start_time, messages, end_time=conv_data.get('end_time'))
+        return conversation_id
+
+    def import_json_directory(self, folder_path: str) -> int:
+        """Importa tutti i file JSON di una cartella (es. la vecchia './memory'). Restituisce quanti ne ha letti."""
+        if not os.path.isdir(folder_path):
+            return 0
+        count = 0
+        for name in os.listdir(folder_path):
+            if name.endswith(".json"):
+                self.import_json(os.path.join(folder_path, name))
+                count += 1
+        return count
+
+
+class SQLiteConversationStore(ConversationStore):
+    """
+    Archivio delle conversazioni su SQLite: ogni messaggio è una riga, indicizzata per
+    (conversation_id, position). Un salvataggio inserisce solo i messaggi nuovi, un
+    caricamento legge solo le ultime righe richieste e l'elenco per la sidebar è una
+    query sull'indice della data di ultimo aggiornamento, senza leggere i messaggi.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id TEXT PRIMARY KEY,
+            start_time TEXT NOT NULL,
+            end_time TEXT NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_conversations_end_time ON conversations (end_time);
+        CREATE TABLE IF NOT EXISTS messages (
+            conversation_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            PRIMARY KEY (conversation_id, position)
+        );
+    """
+
+    def __init__(self, db_path: str = "./memory/conversations.db"):
+        super().__init__()
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+
+        # una sola connessione condivisa tra i thread, protetta da un lock;
+        # la modalità WAL permette letture concorrenti anche da altri processi
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def append_messages(self, conversation_id: str, start_time: str, messages: List[Dict[str, str]], end_time: Optional[str] = None):
+        now = end_time or datetime.now().isoformat()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO conversations (conversation_id, start_time, end_time, message_count) VALUES (?, ?, ?, 0)",
+                (conversation_id, start_time, now)
+            )
+            row = self._conn.execute(
+                "SELECT message_count FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()
+            offset = row["message_count"]
+
+            self._conn.executemany(
+                "INSERT INTO messages (conversation_id, position, type, content, timestamp) VALUES (?, ?, ?, ?, ?)",
+                [
+                    (conversation_id, offset + i, msg["type"], msg["content"], msg["timestamp"])
+                    for i, msg in enumerate(messages)
+                ]
+            )
+            self._conn.execute(
+                "UPDATE conversations SET end_time = ?, message_count = ? WHERE conversation_id = ?",
+                (now, offset + len(messages), conversation_id)
+            )
+
+        if messages:
+            self._notify_append(conversation_id, [
+                {**msg, "position": offset + i} for i, msg in enumerate(messages)
+            ])
+
+    def load_messages(self, conversation_id: str, last_n: Optional[int] = None, before: Optional[int] = None) -> List[Dict[str, str]]:
+        query = "SELECT position, type, content, timestamp FROM messages WHERE conversation_id = ?"
+        params: list = [conversation_id]
+        if before is not None:
+            query += " AND position < ?"
+            params.append(before)
+        # si leggono le righe dalla più recente, poi si riporta l'ordine cronologico
+        query += " ORDER BY position DESC"
+        if last_n is not None:
+            query += " LIMIT ?"
+            params.append(last_n)
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [
+            {"type": row["type"], "content": row["content"], "timestamp": row["timestamp"], "position": row["position"]}
+            for row in reversed(rows)
+        ]
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT conversation_id, start_time, end_time, message_count FROM conversations WHERE conversation_id = ?",
+                (conversation_id,)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def list_conversations(self, limit: int = 100) -> List[Dict]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT conversation_id, start_time, end_time, message_count FROM conversations ORDER BY end_time DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_conversations(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def close(self):
+        """Chiude la connessione al database."""
+        with self._lock:
+            self._conn.close()
+
+
+# archivi condivisi dal processo, uno per file di database.
+_shared_stores: Dict[str, SQLiteConversationStore] = {}
+_shared_stores_lock = threading.Lock()
+
+
+def get_shared_conversation_store(db_path: str = "./memory/conversations.db") -> SQLiteConversationStore:
+    """
+    Restituisce l'archivio SQLite del processo per il file indicato, creandolo alla prima chiamata.
+    Se l'archivio è vuoto, vi importa le conversazioni JSON già presenti nella sua cartella.
+    """
+    key = os.path.abspath(db_path)
+    with _shared_stores_lock:
+        store = _shared_stores.get(key)
+        if store is None:
+            store = SQLiteConversationStore(db_path)
+            if store.count_conversations() == 0:
+                store.import_json_directory(os.path.dirname(db_path) or ".")
+            _shared_stores[key] = store
+        return store
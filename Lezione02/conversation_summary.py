@@ -0,0 +1,108 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+# pool di thread condiviso dal processo per i riassunti: le chiamate all'LLM
+# di riassunto non girano mai nel thread che serve la richiesta dell'utente.
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summarizer")
+
+SUMMARY_PROMPT = """Aggiorna il riassunto di una conversazione tra un utente e un assistente AI.
+Integra nel riassunto esistente i nuovi scambi, conservando fatti, nomi, numeri, richieste
+e decisioni importanti. Rispondi solo con il riassunto aggiornato, in modo conciso.
+
+Riassunto esistente:
+{summary}
+
+Nuovi scambi da integrare:
+{lines}
+
+Riassunto aggiornato:"""
+
+
+class RollingSummarizer:
+    """
+    Mantiene un riassunto progressivo dei messaggi usciti dalla finestra di contesto.
+
+    I messaggi scartati vengono accodati con submit() e integrati nel riassunto da un
+    worker in background; get_summary() restituisce subito l'ultimo riassunto disponibile,
+    anche se un aggiornamento è ancora in corso, quindi non blocca mai la chat.
+    """
+
+    def __init__(self, llm, executor: Optional[ThreadPoolExecutor] = None):
+        self.llm = llm
+        self.executor = executor or _executor
+        self.summary = ""
+        self._pending: List[str] = []
+        self._running = False
+        # la generazione cambia a ogni reset: i risultati di lavori avviati prima vengono scartati
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Event()
+        self._idle.set()
+
+    def submit(self, lines: List[str]):
+        """Accoda le righe scartate dalla finestra e avvia il worker se non è già attivo."""
+        with self._lock:
+            self._pending.extend(lines)
+            if self._running:
+                return
+            self._running = True
+            self._idle.clear()
+            generation = self._generation
+        self.executor.submit(self._run, generation)
+
+    def _run(self, generation: int):
+        """Worker: integra nel riassunto i blocchi di righe in attesa finché la coda è vuota."""
+        while True:
+            with self._lock:
+                if generation != self._generation or not self._pending:
+                    if generation == self._generation:
+                        self._running = False
+                        self._idle.set()
+                    return
+                lines, self._pending = self._pending, []
+                summary = self.summary
+
+            try:
+                prompt = SUMMARY_PROMPT.format(summary=summary or "(vuoto)", lines="\n".join(lines))
+                new_summary = self.llm.invoke(prompt).content.strip()
+            except Exception as e:
+                # in caso di errore le righe vengono rimesse in coda per il prossimo tentativo
+                logger.warning("Aggiornamento del riassunto fallito: %s", e)
+                with self._lock:
+                    if generation == self._generation:
+                        self._pending[:0] = lines
+                        self._running = False
+                        self._idle.set()
+                return
+
+            with self._lock:
+                if generation == self._generation:
+                    self.summary = new_summary
+
+    def get_summary(self) -> str:
+        """Restituisce l'ultimo riassunto disponibile, senza attendere i lavori in corso."""
+        with self._lock:
+            return self.summary
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Attende che i riassunti in coda siano completati (utile prima di salvare o nei test)."""
+        return self._idle.wait(timeout)
+
+    def restore(self, summary: str):
+        """Riparte da un riassunto già calcolato (es. letto dallo stato di una sessione), senza chiamare l'LLM."""
+        self.reset()
+        with self._lock:
+            self.summary = summary
+
+    def reset(self):
+        """Azzera il riassunto e annulla i lavori in coda."""
+        with self._lock:
+            self._generation += 1
+            self.summary = ""
+            self._pending = []
+            self._running = False
+            self._idle.set()
@@ -0,0 +1,87 @@
+import asyncio
+import random
+import time
+import zlib
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# vocabolario da cui vengono estratte le parole delle risposte finte
+_VOCABULARY = (
+    "il la un una che di per con non come più anche questo questa sono essere fare "
+    "risposta domanda conversazione modello contesto memoria token costo esempio"
+).split()
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Chat model locale e deterministico per benchmark e prove senza rete.
+
+    La risposta dipende solo dal prompt (stesso prompt, stessa risposta) ed è lunga
+    'output_tokens' parole. 'latency' simula l'attesa prima del primo token e
+    'token_latency' il tempo di generazione di ogni token successivo; il modello
+    restituisce anche 'usage_metadata' come farebbe un provider reale.
+    """
+
+    latency: float = 0.0
+    token_latency: float = 0.0
+    output_tokens: int = 50
+    model_name: str = "fake-chat-model"
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-model"
+
+    def _prompt_text(self, messages: List[BaseMessage]) -> str:
+        return "\n".join(str(message.content) for message in messages)
+
+    def _words(self, prompt: str) -> List[str]:
+        rng = random.Random(zlib.crc32(prompt.encode("utf-8")))
+        return [rng.choice(_VOCABULARY) for _ in range(self.output_tokens)]
+
+    def _usage(self, prompt: str) -> dict:
+        input_tokens = max(1, len(prompt) // 4)
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": self.output_tokens,
+            "total_tokens": input_tokens + self.output_tokens,
+        }
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt_text(messages)
+        time.sleep(self.latency + self.token_latency * self.output_tokens)
+        message = AIMessage(content=" ".join(self._words(prompt)), usage_metadata=self._usage(prompt))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt = self._prompt_text(messages)
+        await asyncio.sleep(self.latency + self.token_latency * self.output_tokens)
+        message = AIMessage(content=" ".join(self._words(prompt)), usage_metadata=self._usage(prompt))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        prompt = self._prompt_text(messages)
+        time.sleep(self.latency)
+        words = self._words(prompt)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+        # come OpenAI con 'stream_usage', il consumo di token arriva in un ultimo frammento vuoto
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt)))
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager=None, **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        prompt = self._prompt_text(messages)
+        await asyncio.sleep(self.latency)
+        words = self._words(prompt)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_latency)
+            yield ChatGenerationChunk(message=AIMessageChunk(content=word if i == 0 else " " + word))
+        yield ChatGenerationChunk(message=AIMessageChunk(content="", usage_metadata=self._usage(prompt)))
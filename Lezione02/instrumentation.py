@@ -0,0 +1,260 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+
+from usage_log import get_usage_writer
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    Misure di una singola richiesta al chatbot: la durata di ogni fase (con inizio e fine,
+    per poterle esportare come span), il time-to-first-token in streaming e altri attributi
+    come la dimensione del prompt e l'eventuale cache hit.
+    """
+
+    def __init__(self, instrumentation: "Instrumentation", name: str, start_ns: Optional[int] = None):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.trace_id = os.urandom(16).hex()
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.stages: List[tuple] = []  # (nome, inizio_ns, fine_ns)
+        self.attributes: Dict = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Misura la durata del blocco 'with' come fase 'name' della richiesta."""
+        start = time.time_ns()
+        try:
+            yield
+        finally:
+            self.stages.append((name, start, time.time_ns()))
+
+    def set(self, **attributes):
+        """Aggiunge attributi alla traccia (es. prompt_chars, prompt_tokens, cache_hit)."""
+        self.attributes.update(attributes)
+
+    def mark_first_token(self):
+        """Registra il time-to-first-token, alla prima chiamata soltanto."""
+        if "ttft_ms" not in self.attributes:
+            self.attributes["ttft_ms"] = (time.time_ns() - self.start_ns) / 1e6
+
+    def stage_durations_ms(self) -> Dict[str, float]:
+        """Restituisce la durata in millisecondi di ogni fase."""
+        return {name: (end - start) / 1e6 for name, start, end in self.stages}
+
+    @property
+    def total_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def finish(self, error: Optional[BaseException] = None):
+        """Chiude la traccia e la invia a tutti i sink."""
+        self.end_ns = time.time_ns()
+        if error is not None:
+            self.attributes["error"] = type(error).__name__
+        self.instrumentation.emit(self)
+
+
+class HistogramSink:
+    """
+    Tiene in memoria le ultime 'window' misure di ogni fase e calcola i percentili
+    (p50/p95/p99) su richiesta. L'occupazione è costante, indipendente dal traffico.
+    """
+
+    def __init__(self, window: int = 5000):
+        self.window = window
+        self._samples: Dict[str, deque] = {}
+        self.cache_hits = 0
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def _add(self, metric: str, value: float):
+        samples = self._samples.get(metric)
+        if samples is None:
+            samples = self._samples[metric] = deque(maxlen=self.window)
+        samples.append(value)
+
+    def record(self, trace: Trace):
+        with self._lock:
+            self.requests += 1
+            self.cache_hits += bool(trace.attributes.get("cache_hit"))
+            self._add("total", trace.total_ms)
+            for name, duration in trace.stage_durations_ms().items():
+                self._add(name, duration)
+            if "ttft_ms" in trace.attributes:
+                self._add("time_to_first_token", trace.attributes["ttft_ms"])
+
+    def get_percentiles(self) -> Dict[str, Dict[str, float]]:
+        """Restituisce, per ogni metrica, numero di campioni e percentili in millisecondi."""
+        with self._lock:
+            snapshot = {metric: np.fromiter(samples, dtype=np.float64) for metric, samples in self._samples.items()}
+        result = {}
+        for metric, values in snapshot.items():
+            p50, p95, p99 = np.percentile(values, [50, 95, 99])
+            result[metric] = {"count": len(values), "p50": p50, "p95": p95, "p99": p99}
+        return result
+
+
+class JsonLogSink:
+    """Scrive ogni traccia come una riga JSON, con lo stesso writer bufferizzato dei log di utilizzo."""
+
+    def __init__(self, path: str = "chat_traces.jsonl"):
+        self.writer = get_usage_writer(path)
+
+    def record(self, trace: Trace):
+        self.writer.write({
+            "trace_id": trace.trace_id,
+            "name": trace.name,
+            "start_time_ns": trace.start_ns,
+            "total_ms": trace.total_ms,
+            "stages_ms": trace.stage_durations_ms(),
+            **trace.attributes
+        })
+
+
+class OTLPExporterSink:
+    """
+    Esporta le tracce in formato OpenTelemetry (OTLP/HTTP con codifica JSON) verso un collector,
+    ad esempio un OpenTelemetry Collector locale oppure otlp_collector_stub.py.
+    Ogni richiesta diventa uno span radice con uno span figlio per fase.
+
+    Le tracce vengono accumulate e inviate a blocchi da un thread in background,
+    così l'esportazione non aggiunge latenza alle richieste degli utenti.
+    """
+
+    def __init__(self, endpoint: str = "http://localhost:4318/v1/traces", service_name: str = "chatbot",
+                 max_batch: int = 100, flush_interval: float = 5.0):
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self._pending: List[Trace] = []
+        self._lock = threading.Lock()
+        self._client = httpx.Client(timeout=5.0)
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._export_periodically, name="otlp-export", daemon=True)
+        self._thread.start()
+
+    def record(self, trace: Trace):
+        with self._lock:
+            self._pending.append(trace)
+            if len(self._pending) >= self.max_batch:
+                self._wake.set()
+
+    @staticmethod
+    def _attribute(key: str, value) -> Dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _to_spans(self, trace: Trace) -> List[Dict]:
+        root_id = os.urandom(8).hex()
+        spans = [{
+            "traceId": trace.trace_id,
+            "spanId": root_id,
+            "name": trace.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(trace.start_ns),
+            "endTimeUnixNano": str(trace.end_ns),
+            "attributes": [self._attribute(f"chat.{k}", v) for k, v in trace.attributes.items()],
+            "status": {"code": 2 if "error" in trace.attributes else 1}
+        }]
+        for name, start, end in trace.stages:
+            spans.append({
+                "traceId": trace.trace_id,
+                "spanId": os.urandom(8).hex(),
+                "parentSpanId": root_id,
+                "name": name,
+                "kind": 1,
+                "startTimeUnixNano": str(start),
+                "endTimeUnixNano": str(end)
+            })
+        return spans
+
+    def flush(self):
+        """Invia al collector tutte le tracce in attesa."""
+        with self._lock:
+            traces, self._pending = self._pending, []
+        if not traces:
+            return
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attribute("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": "chatbot.instrumentation"},
+                    "spans": [span for trace in traces for span in self._to_spans(trace)]
+                }]
+            }]
+        }
+        try:
+            self._client.post(self.endpoint, json=payload).raise_for_status()
+        except httpx.HTTPError as e:
+            # la telemetria non deve mai far fallire l'applicazione: il blocco viene scartato
+            logger.warning("Esportazione OTLP fallita (%d tracce scartate): %s", len(traces), e)
+
+    def _export_periodically(self):
+        while True:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+
+class Instrumentation:
+    """Punto di raccolta delle tracce del chatbot: crea le tracce e le inoltra ai sink configurati."""
+
+    def __init__(self, sinks: Optional[List] = None):
+        self.sinks = list(sinks or [])
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def start_trace(self, name: str = "chat_turn", start_ns: Optional[int] = None) -> Trace:
+        """Crea una traccia; 'start_ns' (da time.time_ns()) permette di retrodatarne l'inizio."""
+        return Trace(self, name, start_ns)
+
+    def emit(self, trace: Trace):
+        for sink in self.sinks:
+            try:
+                sink.record(trace)
+            except Exception as e:
+                logger.warning("Sink %s fallito: %s", type(sink).__name__, e)
+
+    def get_histogram(self) -> Optional[HistogramSink]:
+        """Restituisce il primo HistogramSink configurato, se presente."""
+        return next((sink for sink in self.sinks if isinstance(sink, HistogramSink)), None)
+
+
+# strumentazione di default del processo, condivisa da tutti i chatbot.
+_default_instrumentation: Optional[Instrumentation] = None
+_default_instrumentation_lock = threading.Lock()
+
+
+def get_default_instrumentation() -> Instrumentation:
+    """
+    Restituisce la strumentazione condivisa dal processo, creandola alla prima chiamata:
+    sempre un istogramma in memoria, più un log JSON Lines se è impostata la variabile
+    d'ambiente CHAT_TRACE_LOG e un export OTLP se è impostata OTEL_EXPORTER_OTLP_TRACES_ENDPOINT.
+    """
+    global _default_instrumentation
+    with _default_instrumentation_lock:
+        if _default_instrumentation is None:
+            sinks = [HistogramSink()]
+            if os.getenv("CHAT_TRACE_LOG"):
+                sinks.append(JsonLogSink(os.getenv("CHAT_TRACE_LOG")))
+            if os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT"):
+                sinks.append(OTLPExporterSink(os.getenv("OTEL_EXPORTER_OTLP_TRACES_ENDPOINT")))
+            _default_instrumentation = Instrumentation(sinks)
+        return _default_instrumentation
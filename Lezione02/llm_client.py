@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+from langchain_openai import ChatOpenAI
+
+# limiti di default del client condiviso: numero massimo di connessioni HTTP
+# aperte verso l'API e di richieste all'LLM in volo contemporaneamente.
+DEFAULT_MAX_CONNECTIONS = 20
+DEFAULT_MAX_CONCURRENCY = 10
+
+# cache dei client condivisi del processo, indicizzata per configurazione.
+_shared_clients: Dict[Tuple, "SharedLLMClient"] = {}
+_shared_clients_lock = threading.Lock()
+
+
+class SharedLLMClient:
+    """
+    Involucro attorno a un LLM di LangChain condiviso da tutte le sessioni del processo.
+    Espone la stessa interfaccia dell'LLM (invoke/stream/ainvoke/astream), quindi può
+    essere passato direttamente a ContextualChatBot, ma limita il numero di chiamate
+    contemporanee con un semaforo comune a thread e coroutine.
+    """
+
+    def __init__(self, llm, max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.llm = llm
+        self.max_concurrency = max_concurrency
+
+        # semaforo per le chiamate sincrone (ogni sessione Streamlit gira nel proprio thread).
+        self._sync_semaphore = threading.BoundedSemaphore(max_concurrency)
+
+        # un asyncio.Semaphore è legato al proprio event loop: ne teniamo uno per loop.
+        self._async_semaphores = weakref.WeakKeyDictionary()
+        self._async_lock = threading.Lock()
+
+    def _get_async_semaphore(self) -> asyncio.Semaphore:
+        """Restituisce il semaforo asincrono associato all'event loop corrente."""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            semaphore = self._async_semaphores.get(loop)
+            if semaphore is None:
+                semaphore = asyncio.Semaphore(self.max_concurrency)
+                self._async_semaphores[loop] = semaphore
+            return semaphore
+
+    def invoke(self, prompt, **kwargs):
+        """Chiamata sincrona all'LLM, limitata dal semaforo condiviso."""
+        with self._sync_semaphore:
+            return self.llm.invoke(prompt, **kwargs)
+
+    def stream(self, prompt, **kwargs):
+        """Streaming sincrono: lo slot del semaforo resta occupato fino alla fine dello stream."""
+        with self._sync_semaphore:
+            yield from self.llm.stream(prompt, **kwargs)
+
+    async def ainvoke(self, prompt, **kwargs):
+        """Chiamata asincrona all'LLM: non occupa un thread mentre attende la risposta."""
+        async with self._get_async_semaphore():
+            return await self.llm.ainvoke(prompt, **kwargs)
+
+    async def astream(self, prompt, **kwargs):
+        """Streaming asincrono, limitato dal semaforo del loop corrente."""
+        async with self._get_async_semaphore():
+            async for chunk in self.llm.astream(prompt, **kwargs):
+                yield chunk
+
+    def __getattr__(self, name):
+        # tutti gli altri attributi (es. 'model_name') vengono letti dall'LLM sottostante.
+        if name == "llm":
+            raise AttributeError(name)
+        return getattr(self.llm, name)
+
+
+def get_shared_llm(
+    api_key: str,
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.7,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+    max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+    timeout: Optional[float] = None,
+) -> SharedLLMClient:
+    """
+    Restituisce l'unico client LLM del processo per la configurazione indicata,
+    creandolo alla prima richiesta.
+
+    Il client usa un pool di connessioni HTTP limitato (sincrono e asincrono) che viene
+    riutilizzato da tutte le sessioni: le connessioni TLS restano aperte tra una
+    richiesta e l'altra invece di essere rinegoziate per ogni nuovo utente.
+    Con 'timeout' una richiesta che non risponde entro quei secondi viene interrotta
+    (utile con ModelRouter, che passa al modello di riserva).
+    """
+    key = (api_key, model, temperature, max_connections, max_concurrency, timeout)
+
+    with _shared_clients_lock:
+        client = _shared_clients.get(key)
+        if client is None:
+            limits = httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+            )
+            llm = ChatOpenAI(
+                model=model,
+                api_key=api_key,
+                temperature=temperature,
+                timeout=timeout,
+                # con un http_client personalizzato va richiesto esplicitamente il conteggio
+                # dei token anche per le risposte in streaming
+                stream_usage=True,
+                http_client=httpx.Client(limits=limits),
+                http_async_client=httpx.AsyncClient(limits=limits),
+            )
+            client = SharedLLMClient(llm, max_concurrency=max_concurrency)
+            _shared_clients[key] = client
+        return client
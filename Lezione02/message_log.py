@@ -0,0 +1,146 @@
+"""
+Rappresentazione compatta dei messaggi di una conversazione e formato binario su disco.
+
+In memoria ogni messaggio è un MessageRecord: un oggetto con '__slots__' (tipo, contenuto,
+timestamp) che occupa una frazione di un HumanMessage/AIMessage di LangChain (oggetti
+pydantic) o di un dizionario. I messaggi di LangChain vengono creati solo quando servono,
+al momento di chiamare l'LLM (vedi MessageRecord.to_langchain).
+
+Il formato binario (estensione '.lcv') è pensato per essere letto con mmap senza
+analizzare tutto il file:
+
+    intestazione  MAGIC (4 byte) | versione (u16) | riservato (u16) | numero messaggi (u32) | lunghezza metadati (u32)
+    metadati      JSON UTF-8 con conversation_id, start_time, end_time
+    indice        un elemento di 24 byte per messaggio: tipo (u8) | fuso (u8) | scarto UTC (i16, minuti) |
+                  lunghezza (u32) | timestamp (i64, µs) | posizione del contenuto nella sezione dati (u64)
+    dati          i contenuti UTF-8 dei messaggi, uno dopo l'altro
+
+L'indice ha elementi di dimensione fissa, quindi l'elemento i-esimo si trova con un
+calcolo: per leggere gli ultimi N messaggi si leggono solo i loro N elementi
+dell'indice e si decodificano solo i loro contenuti.
+
+Il timestamp è l'ora locale del messaggio; se il timestamp ISO aveva un fuso orario
+(es. '+02:00'), il byte 'fuso' vale 1 e lo scarto da UTC viene conservato, così
+il timestamp riletto è identico a quello scritto.
+"""
+import json
+import mmap
+import os
+import struct
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from langchain.schema import AIMessage, HumanMessage
+
+MAGIC = b"LCV1"
+VERSION = 1
+_HEADER = struct.Struct("<4sHHII")
+_ENTRY = struct.Struct("<BBhIqQ")
+_TYPES = ("human", "ai")
+_TYPE_CODES = {name: code for code, name in enumerate(_TYPES)}
+_EPOCH = datetime(1970, 1, 1)
+
+
+class MessageRecord:
+    """Un messaggio della conversazione: tipo ('human'/'ai'), contenuto e timestamp ISO."""
+
+    __slots__ = ("type", "content", "timestamp")
+
+    def __init__(self, message_type: str, content: str, timestamp: str):
+        self.type = message_type
+        self.content = content
+        self.timestamp = timestamp
+
+    def to_dict(self) -> Dict[str, str]:
+        """Il formato a dizionario usato dai file JSON, dall'archivio e dalla UI."""
+        return {"type": self.type, "content": self.content, "timestamp": self.timestamp}
+
+    def to_langchain(self):
+        """Converte il record nel messaggio di LangChain da inviare all'LLM."""
+        if self.type == "human":
+            return HumanMessage(content=self.content)
+        return AIMessage(content=self.content)
+
+    def __repr__(self) -> str:
+        return f"MessageRecord({self.type!r}, {self.content[:30]!r}, {self.timestamp!r})"
+
+
+def _to_micros(timestamp: str) -> Tuple[int, int, int]:
+    """Codifica un timestamp ISO in (fuso, scarto UTC in minuti, µs dal 1970 in ora locale)."""
+    try:
+        moment = datetime.fromisoformat(timestamp)
+    except (TypeError, ValueError):
+        raise ValueError(f"Timestamp non valido (atteso il formato ISO 8601): {timestamp!r}") from None
+    offset = moment.utcoffset()
+    if offset is not None and offset % timedelta(minutes=1):
+        raise ValueError(f"Fuso orario con secondi non supportato: {timestamp!r}")
+    micros = (moment.replace(tzinfo=None) - _EPOCH) // timedelta(microseconds=1)
+    if offset is None:
+        return 0, 0, micros
+    return 1, offset // timedelta(minutes=1), micros
+
+
+def _from_micros(has_zone: int, offset_minutes: int, micros: int) -> str:
+    moment = _EPOCH + timedelta(microseconds=micros)
+    if has_zone:
+        moment = moment.replace(tzinfo=timezone(timedelta(minutes=offset_minutes)))
+    return moment.isoformat()
+
+
+def write_conversation(filename: str, conversation_id: str, start_time: str, end_time: str,
+                       records: Iterable[MessageRecord]) -> str:
+    """
+    Scrive una conversazione nel formato binario. Il file viene prima scritto accanto
+    e poi rinominato, così un lettore non vede mai un file a metà.
+    """
+    records = list(records)
+    meta = json.dumps(
+        {"conversation_id": conversation_id, "start_time": start_time, "end_time": end_time},
+        ensure_ascii=False
+    ).encode("utf-8")
+    contents = [record.content.encode("utf-8") for record in records]
+    # l'indice viene costruito prima di aprire il file: un timestamp non valido non lascia file a metà
+    index, position = [], 0
+    for record, content in zip(records, contents):
+        has_zone, offset_minutes, micros = _to_micros(record.timestamp)
+        index.append(_ENTRY.pack(_TYPE_CODES[record.type], has_zone, offset_minutes, len(content), micros, position))
+        position += len(content)
+
+    temp_filename = f"{filename}.tmp"
+    with open(temp_filename, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, 0, len(records), len(meta)))
+        f.write(meta)
+        f.write(b"".join(index))
+        f.write(b"".join(contents))
+    os.replace(temp_filename, filename)
+    return filename
+
+
+def read_conversation(filename: str, last_n: Optional[int] = None) -> Tuple[Dict, List[MessageRecord]]:
+    """
+    Legge i metadati (con il numero totale di messaggi, 'message_count') e gli ultimi
+    'last_n' messaggi (tutti se None) di un file binario.
+    Il file è mappato in memoria: vengono letti solo l'intestazione, l'indice
+    e i contenuti dei messaggi richiesti.
+    """
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError(f"File di conversazione vuoto: {filename}")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, _, count, meta_length = _HEADER.unpack_from(data, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError(f"Formato di conversazione non riconosciuto: {filename}")
+
+            meta = json.loads(data[_HEADER.size:_HEADER.size + meta_length].decode("utf-8"))
+            meta["message_count"] = count
+            index_start = _HEADER.size + meta_length
+            data_start = index_start + count * _ENTRY.size
+
+            # dei messaggi saltati non si legge nulla, né l'indice né il contenuto
+            first = 0 if last_n is None else max(0, count - last_n)
+            records = []
+            for i in range(first, count):
+                type_code, has_zone, offset_minutes, length, micros, offset = _ENTRY.unpack_from(data, index_start + i * _ENTRY.size)
+                content = data[data_start + offset:data_start + offset + length].decode("utf-8")
+                records.append(MessageRecord(_TYPES[type_code], content, _from_micros(has_zone, offset_minutes, micros)))
+    return meta, records
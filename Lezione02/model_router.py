@@ -0,0 +1,281 @@
+import logging
+import re
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import openai
+
+from llm_client import get_shared_llm
+from token_counter import TokenCounter
+
+logger = logging.getLogger(__name__)
+
+# errori per cui una richiesta viene ripetuta con il modello successivo:
+# timeout, limite di richieste superato (429) e problemi di connessione
+FAILOVER_ERRORS = (openai.RateLimitError, openai.APIConnectionError, httpx.TimeoutException, TimeoutError)
+
+# indizi di una domanda impegnativa: richieste di ragionamento, analisi, codice o calcoli
+_COMPLEX_HINTS = re.compile(
+    r"\b(perch[eé]|spiega\w*|analizz\w*|confront\w*|dimostr\w*|valut\w*|progett\w*|ottimizz\w*|"
+    r"codice|algoritm\w*|calcol\w*|passo\s+passo|debug\w*)\b|```",
+    re.IGNORECASE
+)
+
+
+class CircuitBreaker:
+    """
+    Interruttore per un modello che sta fallendo: dopo 'failure_threshold' errori consecutivi
+    si apre e per 'reset_timeout' secondi il modello non riceve richieste. Trascorso
+    il tempo lascia passare una richiesta di prova: se va a buon fine si richiude.
+    """
+
+    def __init__(self, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def allow_request(self) -> bool:
+        """True se il modello può ricevere una richiesta (interruttore chiuso o richiesta di prova)."""
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # mezza apertura: una sola richiesta di prova, le altre attendono il suo esito
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ModelRouter:
+    """
+    Sceglie per ogni richiesta quale modello usare tra quelli configurati ed espone la
+    stessa interfaccia di un LLM (invoke/stream/ainvoke/astream), quindi può essere
+    passato direttamente a ContextualChatBot.
+
+    I modelli vanno indicati dal più economico e veloce al più capace. Un prompt lungo
+    o una domanda complessa vanno all'ultimo modello, tutto il resto al primo; se il modello
+    scelto è diventato lento (latenza recente oltre 'max_latency') si preferisce il più rapido.
+    In caso di timeout o errore 429 la richiesta passa al modello successivo e, dopo errori
+    ripetuti, il circuit breaker esclude il modello per un po'.
+
+    Il nome del modello che ha risposto viene scritto in 'response_metadata["model_name"]',
+    così TokenMonitor può applicare il listino corretto.
+    """
+
+    def __init__(self, models: List[Tuple[str, object]], token_counter: Optional[TokenCounter] = None,
+                 large_prompt_tokens: int = 3000, complexity_threshold: int = 2, max_latency: float = 10.0,
+                 failure_threshold: int = 3, reset_timeout: float = 30.0):
+        if not models:
+            raise ValueError("Il router richiede almeno un modello")
+        self.models = list(models)
+        self.token_counter = token_counter or TokenCounter(models[0][0])
+        self.large_prompt_tokens = large_prompt_tokens
+        self.complexity_threshold = complexity_threshold
+        self.max_latency = max_latency
+        self.breakers: Dict[str, CircuitBreaker] = {
+            name: CircuitBreaker(failure_threshold, reset_timeout) for name, _ in models
+        }
+        # latenza recente di ogni modello (media mobile esponenziale, in secondi): sempre il
+        # tempo della risposta completa, anche in streaming, così è la stessa misura per tutte le API
+        self.latency: Dict[str, Optional[float]] = {name: None for name, _ in models}
+        self._lock = threading.Lock()
+
+    @property
+    def model_name(self) -> str:
+        # usato per scegliere il tokenizer: i modelli configurati sono della stessa famiglia
+        return self.models[0][0]
+
+    @staticmethod
+    def _prompt_text(prompt) -> str:
+        # il prompt può essere una stringa o una lista di messaggi (modalità strutturata)
+        if isinstance(prompt, str):
+            return prompt
+        return "\n".join(str(message.content) for message in prompt)
+
+    @staticmethod
+    def _question(prompt) -> str:
+        # il messaggio dell'utente: l'ultimo messaggio della lista o l'ultimo "Utente:" del testo
+        if isinstance(prompt, str):
+            return prompt.rsplit("Utente:", 1)[-1]
+        return str(prompt[-1].content) if prompt else ""
+
+    @classmethod
+    def complexity(cls, prompt) -> int:
+        """
+        Stima quanto è impegnativa la domanda: conta gli indizi di ragionamento nel
+        messaggio dell'utente, più uno se è molto lungo e uno per ogni domanda oltre la prima.
+        """
+        question = cls._question(prompt)
+        score = len(_COMPLEX_HINTS.findall(question))
+        score += len(question) > 600
+        score += max(0, question.count("?") - 1)
+        return score
+
+    def _record_latency(self, name: str, seconds: float):
+        with self._lock:
+            previous = self.latency[name]
+            self.latency[name] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    def select(self, prompt) -> List[Tuple[str, object]]:
+        """Restituisce i modelli in ordine di tentativo per questo prompt."""
+        last = len(self.models) - 1
+        large = (self.token_counter.count(self._prompt_text(prompt)) > self.large_prompt_tokens
+                 or self.complexity(prompt) >= self.complexity_threshold)
+        preferred = last if large else 0
+
+        # se il modello scelto è lento, si passa al più rapido degli altri; quelli non ancora
+        # misurati vengono prima (latenza None), così ricevono traffico e una misura
+        with self._lock:
+            latency = dict(self.latency)
+        slow = latency[self.models[preferred][0]]
+        if slow is not None and slow > self.max_latency:
+            others = [(latency[name] is not None, latency[name] or 0.0, i)
+                      for i, (name, _) in enumerate(self.models) if i != preferred]
+            fastest = min(others, default=None)
+            if fastest is not None and (not fastest[0] or fastest[1] < slow):
+                preferred = fastest[2]
+
+        ordered = [self.models[preferred]] + [m for i, m in enumerate(self.models) if i != preferred]
+        # i modelli con l'interruttore aperto vanno in fondo, come ultima risorsa
+        available = [m for m in ordered if not self.breakers[m[0]].is_open]
+        return available + [m for m in ordered if m not in available]
+
+    def _candidates(self, prompt):
+        """Scorre i modelli selezionati saltando quelli esclusi dal circuit breaker (tranne l'ultimo)."""
+        candidates = self.select(prompt)
+        for i, (name, llm) in enumerate(candidates):
+            if self.breakers[name].allow_request() or i == len(candidates) - 1:
+                yield name, llm, i == len(candidates) - 1
+
+    def _failed(self, name: str, error: Exception, is_last: bool):
+        self.breakers[name].record_failure()
+        if is_last:
+            raise error
+        logger.warning("Modello %s non disponibile (%s): si passa al successivo", name, type(error).__name__)
+
+    def _succeeded(self, name: str, started: float):
+        self.breakers[name].record_success()
+        self._record_latency(name, time.monotonic() - started)
+
+    def invoke(self, prompt, **kwargs):
+        for name, llm, is_last in self._candidates(prompt):
+            started = time.monotonic()
+            try:
+                response = llm.invoke(prompt, **kwargs)
+            except FAILOVER_ERRORS as e:
+                self._failed(name, e, is_last)
+                continue
+            self._succeeded(name, started)
+            response.response_metadata["model_name"] = name
+            return response
+
+    async def ainvoke(self, prompt, **kwargs):
+        for name, llm, is_last in self._candidates(prompt):
+            started = time.monotonic()
+            try:
+                response = await llm.ainvoke(prompt, **kwargs)
+            except FAILOVER_ERRORS as e:
+                self._failed(name, e, is_last)
+                continue
+            self._succeeded(name, started)
+            response.response_metadata["model_name"] = name
+            return response
+
+    def stream(self, prompt, **kwargs):
+        """
+        Streaming con failover: si passa al modello successivo solo se l'errore arriva
+        prima del primo frammento; a risposta iniziata l'errore viene propagato.
+        Il primo frammento conta come successo per il circuit breaker, mentre la latenza
+        del modello, come per invoke(), è quella dello stream completo (uno stream
+        abbandonato a metà non viene misurato).
+        """
+        for name, llm, is_last in self._candidates(prompt):
+            started = time.monotonic()
+            stream = llm.stream(prompt, **kwargs)
+            try:
+                first = next(stream, None)
+            except FAILOVER_ERRORS as e:
+                self._failed(name, e, is_last)
+                continue
+            self.breakers[name].record_success()
+            if first is not None:
+                first.response_metadata["model_name"] = name
+                yield first
+                for chunk in stream:
+                    chunk.response_metadata["model_name"] = name
+                    yield chunk
+            self._record_latency(name, time.monotonic() - started)
+            return
+
+    async def astream(self, prompt, **kwargs):
+        for name, llm, is_last in self._candidates(prompt):
+            started = time.monotonic()
+            stream = llm.astream(prompt, **kwargs).__aiter__()
+            try:
+                first = await stream.__anext__()
+            except StopAsyncIteration:
+                self._succeeded(name, started)
+                return
+            except FAILOVER_ERRORS as e:
+                self._failed(name, e, is_last)
+                continue
+            self.breakers[name].record_success()
+            first.response_metadata["model_name"] = name
+            yield first
+            async for chunk in stream:
+                chunk.response_metadata["model_name"] = name
+                yield chunk
+            self._record_latency(name, time.monotonic() - started)
+            return
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """Stato di ogni modello: latenza recente e circuit breaker."""
+        with self._lock:
+            latency = dict(self.latency)
+        return {
+            name: {"latency_s": latency[name], "circuit_open": self.breakers[name].is_open}
+            for name, _ in self.models
+        }
+
+
+# router condivisi dal processo: latenze e circuit breaker valgono per tutte le sessioni.
+_shared_routers: Dict[Tuple, ModelRouter] = {}
+_shared_routers_lock = threading.Lock()
+
+
+def get_shared_router(api_key: str, models: Tuple[str, ...] = ("gpt-4o-mini", "gpt-4o"),
+                      temperature: float = 0.7, timeout: float = 30.0) -> ModelRouter:
+    """
+    Restituisce il router del processo per i modelli indicati (dal più economico al più capace),
+    ciascuno con il proprio client condiviso di get_shared_llm.
+    """
+    key = (api_key, tuple(models), temperature, timeout)
+    with _shared_routers_lock:
+        router = _shared_routers.get(key)
+        if router is None:
+            router = ModelRouter([
+                (model, get_shared_llm(api_key=api_key, model=model, temperature=temperature, timeout=timeout))
+                for model in models
+            ])
+            _shared_routers[key] = router
+        return router
@@ -0,0 +1,95 @@
+"""
+Collector OpenTelemetry minimale per provare l'esportazione delle tracce in locale.
+
+Riceve le tracce in formato OTLP/HTTP JSON (come le invia OTLPExporterSink) e stampa
+una riga per span con la sua durata. Non sostituisce un vero OpenTelemetry Collector:
+serve solo a verificare cosa esce dall'applicazione.
+
+    python otlp_collector_stub.py --port 4318
+"""
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+
+class CollectorStub:
+    """Server HTTP che accetta POST su /v1/traces e conserva in memoria gli span ricevuti."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 4318, verbose: bool = True):
+        self.spans: List[Dict] = []
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        collector = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != "/v1/traces":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                try:
+                    collector._receive(json.loads(body))
+                except (ValueError, KeyError, TypeError):
+                    self.send_response(400)
+                    self.end_headers()
+                    return
+                # risposta vuota di successo, come previsto da OTLP/HTTP JSON
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, format, *args):
+                pass  # niente log di accesso: si stampano solo gli span
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1/traces"
+
+    def _receive(self, payload: Dict):
+        spans = [
+            span
+            for resource_spans in payload["resourceSpans"]
+            for scope_spans in resource_spans["scopeSpans"]
+            for span in scope_spans["spans"]
+        ]
+        with self._lock:
+            self.spans.extend(spans)
+        if self.verbose:
+            for span in spans:
+                duration_ms = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6
+                indent = "  " if span.get("parentSpanId") else ""
+                print(f"{span['traceId'][:8]} {indent}{span['name']}: {duration_ms:.2f} ms")
+
+    def start(self) -> "CollectorStub":
+        """Avvia il server in un thread in background (utile nei test e nelle prove interattive)."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Collector OTLP/HTTP minimale per le tracce del chatbot")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4318)
+    args = parser.parse_args()
+
+    collector = CollectorStub(args.host, args.port)
+    print(f"In ascolto su {collector.endpoint}")
+    try:
+        collector.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Pagina della dashboard: dove sono andati token e costi, dai log di TokenMonitor di tutte le sessioni.
+
+Streamlit la mostra nel menu laterale accanto alla chat (le pagine nella cartella 'pages/'
+accanto ad app.py). I log da analizzare si indicano con la variabile d'ambiente
+CHAT_USAGE_LOGS (percorsi separati da virgole, per default token_usage.jsonl).
+"""
+import os
+from datetime import datetime, timedelta
+
+import streamlit as st
+
+USAGE_LOGS = tuple(path.strip() for path in os.getenv("CHAT_USAGE_LOGS", "token_usage.jsonl").split(",") if path.strip())
+
+PERIODS = {
+    "Ultime 24 ore": timedelta(days=1),
+    "Ultimi 7 giorni": timedelta(days=7),
+    "Ultimi 30 giorni": timedelta(days=30),
+    "Tutto": None,
+}
+BUCKET_LABELS = {"hour": "Ora", "day": "Giorno", "week": "Settimana"}
+
+st.set_page_config(page_title="Analisi dei costi", page_icon="📊", layout="wide")
+
+
+@st.cache_data(show_spinner="Lettura dei log...")
+def get_usage_report(paths, sizes, period: str, bucket: str, top: int):
+    """
+    Rapporto sui log indicati. 'sizes' (le dimensioni dei file) fa parte della chiave della
+    cache: il rapporto viene ricalcolato solo quando i log crescono.
+    """
+    # NumPy viene importato solo quando si apre questa pagina
+    from usage_analytics import load_logs, usage_report
+    table = load_logs(paths)
+    if PERIODS[period] is not None:
+        table = table.between(datetime.now() - PERIODS[period])
+    return usage_report(table, bucket, top)
+
+
+st.title("📊 Analisi dei costi")
+
+period = st.sidebar.selectbox("Periodo", list(PERIODS), index=1)
+bucket = st.sidebar.selectbox("Intervallo", list(BUCKET_LABELS), index=1, format_func=BUCKET_LABELS.get)
+top = st.sidebar.number_input("Conversazioni in classifica", min_value=1, max_value=100, value=10)
+st.sidebar.caption("Log: " + ", ".join(USAGE_LOGS))
+
+sizes = tuple(os.path.getsize(path) if os.path.exists(path) else 0 for path in USAGE_LOGS)
+report = get_usage_report(USAGE_LOGS, sizes, period, bucket, int(top))
+totals = report["totals"]
+
+if not totals["interactions"]:
+    st.info("Nessuna interazione registrata nel periodo selezionato.")
+    st.stop()
+
+col1, col2, col3, col4 = st.columns(4)
+col1.metric("Costo", f"${totals['cost_usd']:.4f}")
+col2.metric("Token", f"{totals['input_tokens'] + totals['output_tokens']:,}")
+col3.metric("Interazioni", f"{totals['interactions']:,}")
+col4.metric("Conversazioni", f"{totals['sessions']:,}")
+st.caption(f"Risposte dalla cache: {totals['cache_hit_rate']:.1%} | "
+           f"token di input dalla cache del prompt: {totals['cached_input_tokens']:,}")
+
+st.subheader(f"Costo per {BUCKET_LABELS[bucket].lower()}")
+buckets = report["buckets"]
+st.bar_chart(
+    {"inizio": [row["start"] for row in buckets], "costo $": [row["cost_usd"] for row in buckets]},
+    x="inizio", y="costo $"
+)
+with st.expander("Token per intervallo"):
+    st.dataframe(buckets, hide_index=True)
+
+st.subheader("Per modello")
+st.caption("Percentili dei token e del costo di una singola interazione.")
+st.dataframe(
+    [{"modello": model, **stats} for model, stats in
+     sorted(report["models"].items(), key=lambda item: -item[1]["cost_usd"])],
+    hide_index=True
+)
+
+st.subheader("Per conversazione")
+st.caption("Percentili, tra le conversazioni del periodo, dei loro totali.")
+st.dataframe([{"": name, **stats} for name, stats in report["sessions"].items()], hide_index=True)
+
+st.subheader(f"Le {len(report['top_sessions'])} conversazioni più costose")
+st.dataframe(report["top_sessions"], hide_index=True)
@@ -0,0 +1,323 @@
+"""
+Controllo di ammissione delle richieste all'LLM, prima che partano.
+
+- RateLimiter: limita le richieste e i token al minuto inviati al provider da tutto il
+  processo, con due token bucket (RPM e TPM). Le richieste in eccesso vengono messe in coda
+  per priorità invece di partire tutte insieme e ricevere errori 429 (e i relativi retry).
+  Se l'attesa stimata supera 'max_wait' la richiesta viene rifiutata subito.
+- UsageQuotas: budget di token per utente o per sessione in un periodo (es. un giorno).
+  Prima della chiamata i token del prompt vengono prenotati nel budget: una richiesta che lo
+  supererebbe viene rifiutata invece di essere pagata e contata a posteriori da TokenMonitor,
+  e le richieste contemporanee della stessa chiave non possono superarlo insieme. I consumi
+  possono stare nella memoria del processo o, con più worker, in un backend di sessione
+  condiviso (vedi session_backend.py).
+
+I rifiuti sono eccezioni AdmissionRejected con un messaggio leggibile e, se ha senso
+riprovare, i secondi da attendere ('retry_after').
+"""
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# priorità delle richieste in coda: un numero minore passa prima
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+
+class AdmissionRejected(Exception):
+    """Richiesta rifiutata prima di chiamare l'LLM."""
+
+    def __init__(self, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimitExceeded(AdmissionRejected):
+    """Il limite di richieste o token al minuto del processo non permette la richiesta in tempo."""
+
+
+class QuotaExceeded(AdmissionRejected):
+    """Il budget di token dell'utente o della sessione non basta per la richiesta."""
+
+
+class TokenBucket:
+    """
+    Secchio che si riempie a velocità costante fino a 'capacity': ogni richiesta preleva
+    la propria quantità e, se non è disponibile, deve attendere che si riempia.
+    """
+
+    def __init__(self, capacity: float, per_second: float):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Secondi da attendere perché 'amount' sia disponibile (dopo refill)."""
+        return 0.0 if self.level >= amount else (amount - self.level) / self.per_second
+
+
+class Reservation:
+    """
+    Token prenotati da una richiesta ammessa. Alla prenotazione si contano i token del prompt
+    più una stima della risposta; a risposta ricevuta settle() corregge con il consumo reale.
+    """
+
+    __slots__ = ("limiter", "tokens", "settled")
+
+    def __init__(self, limiter: "RateLimiter", tokens: int):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.settled = False
+
+    def settle(self, actual_tokens: int):
+        if not self.settled:
+            self.settled = True
+            self.limiter._adjust(self.tokens - actual_tokens)
+
+
+class RateLimiter:
+    """
+    Limite di richieste e token al minuto condiviso da tutte le sessioni del processo
+    (vedi get_shared_rate_limiter), con coda per priorità: a parità di priorità l'ordine
+    è quello di arrivo, e solo la prima richiesta della coda può prelevare dai secchi.
+    """
+
+    def __init__(self, requests_per_minute: int = 500, tokens_per_minute: int = 200_000,
+                 max_wait: float = 10.0, expected_output_tokens: int = 256):
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.max_wait = max_wait
+        # il provider conta nel limite anche i token della risposta, noti solo alla fine
+        self.expected_output_tokens = expected_output_tokens
+        self._queue: List[list] = []  # heap di [priorità, numero d'arrivo, token]
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self.admitted = 0
+        self.rejected = 0
+
+    def _enqueue(self, tokens: int, priority: int) -> list:
+        """Mette la richiesta in coda, o la rifiuta subito se non potrebbe partire entro 'max_wait'."""
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        if tokens > self.tokens.capacity:
+            self.rejected += 1
+            raise RateLimitExceeded(
+                f"La richiesta ({tokens} token) supera il limite di {self.tokens.capacity:.0f} token al minuto"
+            )
+        # stima dell'attesa: prima di questa partono le richieste in coda con priorità uguale o maggiore
+        ahead = [ticket for ticket in self._queue if ticket[0] <= priority]
+        wait = max(
+            self.requests.wait_time(len(ahead) + 1),
+            self.tokens.wait_time(sum(ticket[2] for ticket in ahead) + tokens)
+        )
+        if wait > self.max_wait:
+            self.rejected += 1
+            raise RateLimitExceeded(
+                f"Troppe richieste in corso: riprova tra {wait:.0f} secondi", retry_after=wait
+            )
+        ticket = [priority, next(self._counter), tokens]
+        heapq.heappush(self._queue, ticket)
+        return ticket
+
+    def _try_admit(self, ticket: list) -> float:
+        """Preleva dai secchi se la richiesta è la prima della coda; altrimenti restituisce l'attesa."""
+        if self._queue[0] is not ticket:
+            # non è il suo turno: verrà svegliata quando la coda avanza
+            return self.max_wait
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        wait = max(self.requests.wait_time(1), self.tokens.wait_time(ticket[2]))
+        if wait > 0:
+            return wait
+        self.requests.level -= 1
+        self.tokens.level -= ticket[2]
+        heapq.heappop(self._queue)
+        self.admitted += 1
+        self._cond.notify_all()
+        return 0.0
+
+    def _abandon(self, ticket: list, waited: float):
+        self._queue.remove(ticket)
+        heapq.heapify(self._queue)
+        self.rejected += 1
+        self._cond.notify_all()
+        return RateLimitExceeded(f"Nessuno slot libero dopo {waited:.0f} secondi di attesa", retry_after=waited)
+
+    def acquire(self, prompt_tokens: int, priority: int = PRIORITY_NORMAL) -> Reservation:
+        """Attende il turno della richiesta (al massimo 'max_wait' secondi) e prenota i suoi token."""
+        tokens = prompt_tokens + self.expected_output_tokens
+        with self._cond:
+            ticket = self._enqueue(tokens, priority)
+            deadline = time.monotonic() + self.max_wait
+            while True:
+                wait = self._try_admit(ticket)
+                if wait == 0:
+                    return Reservation(self, tokens)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._abandon(ticket, self.max_wait)
+                self._cond.wait(min(wait, remaining))
+
+    async def aacquire(self, prompt_tokens: int, priority: int = PRIORITY_NORMAL) -> Reservation:
+        """Versione asincrona di acquire(): attende con asyncio.sleep senza occupare un thread."""
+        tokens = prompt_tokens + self.expected_output_tokens
+        with self._cond:
+            ticket = self._enqueue(tokens, priority)
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            with self._cond:
+                wait = self._try_admit(ticket)
+                if wait == 0:
+                    return Reservation(self, tokens)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise self._abandon(ticket, self.max_wait)
+            # le coroutine non ricevono le notifiche del Condition: controllano la coda a intervalli brevi
+            await asyncio.sleep(min(wait, remaining, 0.05))
+
+    def _adjust(self, tokens: int):
+        """Restituisce ai secchi i token prenotati in più (o preleva quelli mancanti)."""
+        with self._cond:
+            self.tokens.refill(time.monotonic())
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + tokens)
+            self._cond.notify_all()
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._cond:
+            now = time.monotonic()
+            self.requests.refill(now)
+            self.tokens.refill(now)
+            return {
+                "queued": len(self._queue),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "requests_available": int(self.requests.level),
+                "tokens_available": int(self.tokens.level)
+            }
+
+
+class QuotaReservation:
+    """
+    Token prenotati nel budget di una chiave da una richiesta ammessa (i token del prompt);
+    a risposta ricevuta settle() corregge con il consumo reale, nella stessa finestra.
+    """
+
+    __slots__ = ("quotas", "key", "window", "tokens", "settled")
+
+    def __init__(self, quotas: "UsageQuotas", key: str, window: float, tokens: int):
+        self.quotas = quotas
+        self.key = key
+        self.window = window
+        self.tokens = tokens
+        self.settled = False
+
+    def settle(self, actual_tokens: int):
+        if not self.settled:
+            self.settled = True
+            if actual_tokens != self.tokens:
+                self.quotas._add(self.key, actual_tokens - self.tokens, self.window)
+
+
+class UsageQuotas:
+    """
+    Budget di token per chiave (un utente o una sessione) in finestre di 'period' secondi.
+    Per default i consumi sono tenuti in memoria dal processo; con 'counters' (un
+    SessionBackend) sono nel backend, condivisi da tutti i worker e conservati ai riavvii,
+    in finestre allineate (es. giorni interi).
+    """
+
+    def __init__(self, max_tokens: int, period: float = 24 * 3600, counters=None):
+        self.max_tokens = max_tokens
+        self.period = period
+        self.counters = counters
+        self._usage: Dict[str, Tuple[float, int]] = {}  # chiave -> (inizio della finestra, token usati)
+        self._lock = threading.Lock()
+
+    def _window(self, key: str, now: float) -> Tuple[float, int]:
+        if self.counters is not None:
+            return self.counters.get_usage(key, self.period)
+        start, used = self._usage.get(key, (now, 0))
+        if now - start >= self.period:
+            return now, 0
+        return start, used
+
+    def _add(self, key: str, tokens: int, window: Optional[float] = None) -> Tuple[float, int]:
+        """
+        Aggiunge 'tokens' al consumo della chiave nella finestra corrente (o in 'window', se
+        è ancora quella corrente) e restituisce l'inizio della finestra e i token usati.
+        """
+        if self.counters is not None:
+            return self.counters.add_usage(key, tokens, self.period, window)
+        now = time.time()
+        with self._lock:
+            start, used = self._window(key, now)
+            if window is not None and window != start:
+                # la finestra della prenotazione è finita: il suo consumo non conta più
+                return start, used
+            self._usage[key] = (start, used + tokens)
+            return start, used + tokens
+
+    def reserve(self, key: str, prompt_tokens: int) -> QuotaReservation:
+        """
+        Prenota i token del prompt nel budget della chiave, o rifiuta la richiesta se lo
+        farebbero superare. L'aggiunta e il controllo sono un'unica operazione atomica
+        (anche nel backend condiviso): due richieste contemporanee non vedono lo stesso consumo.
+        """
+        start, used = self._add(key, prompt_tokens)
+        if used > self.max_tokens:
+            self._add(key, -prompt_tokens, start)
+            used -= prompt_tokens
+            reset_in = start + self.period - time.time()
+            raise QuotaExceeded(
+                f"Budget di token esaurito: usati {used} su {self.max_tokens}, la richiesta ne richiede "
+                f"almeno {prompt_tokens}. Il budget si rinnova tra {reset_in / 60:.0f} minuti.",
+                retry_after=reset_in
+            )
+        return QuotaReservation(self, key, start, prompt_tokens)
+
+    def get_usage(self, key: str) -> Dict[str, float]:
+        now = time.time()
+        with self._lock:
+            start, used = self._window(key, now)
+        return {"used": used, "limit": self.max_tokens, "reset_in": start + self.period - now}
+
+
+# limiter e budget condivisi dal processo, indicizzati per configurazione.
+_shared_limiters: Dict[Tuple, RateLimiter] = {}
+_shared_quotas: Dict[Tuple, UsageQuotas] = {}
+_shared_lock = threading.Lock()
+
+
+def get_shared_rate_limiter(requests_per_minute: int = 500, tokens_per_minute: int = 200_000,
+                            max_wait: float = 10.0) -> RateLimiter:
+    """Restituisce il limiter del processo per i limiti indicati, creandolo alla prima richiesta."""
+    key = (requests_per_minute, tokens_per_minute, max_wait)
+    with _shared_lock:
+        limiter = _shared_limiters.get(key)
+        if limiter is None:
+            limiter = _shared_limiters[key] = RateLimiter(requests_per_minute, tokens_per_minute, max_wait)
+        return limiter
+
+
+def get_shared_usage_quotas(max_tokens: int, period: float = 24 * 3600, counters=None) -> UsageQuotas:
+    """
+    Restituisce i budget del processo per il limite indicato, creandoli alla prima richiesta.
+    Con 'counters' (un SessionBackend) i consumi sono quelli condivisi nel backend.
+    """
+    key = (max_tokens, period, id(counters))
+    with _shared_lock:
+        quotas = _shared_quotas.get(key)
+        if quotas is None:
+            quotas = _shared_quotas[key] = UsageQuotas(max_tokens, period, counters)
+        return quotas
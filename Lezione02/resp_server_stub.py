@@ -0,0 +1,149 @@
+"""
+Server minimale compatibile con Redis per provare RedisSessionBackend in locale.
+
+Implementa sul protocollo RESP solo i comandi usati dal backend delle sessioni
+(PING, AUTH, SELECT, GET, SET con EX/PX/NX/XX, INCRBY, EXPIRE, DEL, EXISTS, FLUSHDB), con le scadenze
+delle chiavi. Tiene tutto in memoria: non sostituisce un vero server Redis.
+
+    python resp_server_stub.py --port 6379
+"""
+import argparse
+import socketserver
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+
+class RespServerStub:
+    """Server TCP che risponde ai comandi Redis essenziali; ogni client è servito da un thread."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379):
+        # chiave -> (valore, istante di scadenza secondo time.monotonic o None)
+        self.data: Dict[bytes, Tuple[bytes, Optional[float]]] = {}
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        command = stub._read_command(self.rfile)
+                    except (ValueError, IndexError):
+                        self.wfile.write(b"-ERR protocol error\r\n")
+                        return
+                    if command is None:
+                        return
+                    self.wfile.write(stub.execute(command))
+                    if command[0].upper() == b"QUIT":
+                        return
+
+        class Server(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        self.server = Server((host, port), Handler)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"redis://{host}:{port}/0"
+
+    @staticmethod
+    def _read_command(reader) -> Optional[List[bytes]]:
+        line = reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b"*"):
+            # comando "inline" (es. digitato con telnet o nc)
+            return line.split()
+        args = []
+        for _ in range(int(line[1:-2])):
+            length = int(reader.readline()[1:-2])
+            args.append(reader.read(length + 2)[:-2])
+        return args
+
+    def _get(self, key: bytes) -> Optional[bytes]:
+        entry = self.data.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and time.monotonic() >= expires_at:
+            del self.data[key]
+            return None
+        return value
+
+    def execute(self, command: List[bytes]) -> bytes:
+        """Esegue un comando e restituisce la risposta già codificata in RESP."""
+        name, args = command[0].upper(), command[1:]
+        with self._lock:
+            if name == b"PING":
+                return b"+PONG\r\n"
+            if name in (b"AUTH", b"SELECT", b"QUIT"):
+                return b"+OK\r\n"
+            if name == b"GET":
+                value = self._get(args[0])
+                return b"$-1\r\n" if value is None else b"$%d\r\n%s\r\n" % (len(value), value)
+            if name == b"SET":
+                return self._set(args)
+            if name == b"INCRBY":
+                value = int(self._get(args[0]) or 0) + int(args[1])
+                # come in Redis, l'incremento conserva la scadenza della chiave
+                self.data[args[0]] = (str(value).encode(), self.data.get(args[0], (None, None))[1])
+                return b":%d\r\n" % value
+            if name == b"EXPIRE":
+                value = self._get(args[0])
+                if value is None:
+                    return b":0\r\n"
+                self.data[args[0]] = (value, time.monotonic() + int(args[1]))
+                return b":1\r\n"
+            if name == b"DEL":
+                removed = sum(self._get(key) is not None for key in args)
+                for key in args:
+                    self.data.pop(key, None)
+                return b":%d\r\n" % removed
+            if name == b"EXISTS":
+                return b":%d\r\n" % sum(self._get(key) is not None for key in args)
+            if name == b"FLUSHDB":
+                self.data.clear()
+                return b"+OK\r\n"
+        return b"-ERR unknown command '%s'\r\n" % name
+
+    def _set(self, args: List[bytes]) -> bytes:
+        key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+        expires_at = None
+        if b"EX" in options:
+            expires_at = time.monotonic() + int(options[options.index(b"EX") + 1])
+        elif b"PX" in options:
+            expires_at = time.monotonic() + int(options[options.index(b"PX") + 1]) / 1000
+        exists = self._get(key) is not None
+        if (b"NX" in options and exists) or (b"XX" in options and not exists):
+            return b"$-1\r\n"
+        self.data[key] = (value, expires_at)
+        return b"+OK\r\n"
+
+    def start(self) -> "RespServerStub":
+        """Avvia il server in un thread in background (utile nei test e nelle prove interattive)."""
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server minimale compatibile con Redis per le prove locali")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+
+    stub = RespServerStub(args.host, args.port)
+    print(f"In ascolto su {stub.url}")
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
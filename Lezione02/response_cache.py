@@ -0,0 +1,245 @@
+import hashlib
+import re
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Normalizza un prompt: spazi, tabulazioni e a capo consecutivi diventano un solo spazio."""
+    return " ".join(prompt.split())
+
+
+class HashingEmbeddings:
+    """
+    Embedding locale e deterministico, senza chiamate di rete né modelli da scaricare.
+    Ogni parola (e ogni coppia di parole consecutive) viene mappata con un hash su una
+    delle 'dimensions' componenti del vettore, che viene poi normalizzato.
+    Espone 'embed_query' come gli Embeddings di LangChain, quindi può essere sostituito
+    da un qualsiasi modello di embedding compatibile.
+    """
+
+    def __init__(self, dimensions: int = 512):
+        self.dimensions = dimensions
+
+    @staticmethod
+    def _hashes(text: str) -> List[int]:
+        words = re.findall(r"\w+", text.lower())
+        features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        return [zlib.crc32(feature.encode("utf-8")) for feature in features]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for h in self._hashes(text):
+            # il bit più alto dell'hash decide il segno, per ridurre l'effetto delle collisioni
+            vector[h % self.dimensions] += 1.0 if h & 0x80000000 else -1.0
+
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embedding di più testi insieme, come 'embed_documents' degli Embeddings di LangChain:
+        gli hash di tutti i testi finiscono in un'unica matrice con una sola operazione NumPy.
+        """
+        hashes = [self._hashes(text) for text in texts]
+        rows = np.repeat(np.arange(len(texts)), [len(h) for h in hashes])
+        values = np.fromiter((h for text_hashes in hashes for h in text_hashes), dtype=np.uint32, count=len(rows))
+        signs = np.where(values & 0x80000000, 1.0, -1.0).astype(np.float32)
+
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        np.add.at(matrix, (rows, values % self.dimensions), signs)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return (matrix / np.where(norms > 0, norms, 1.0)).tolist()
+
+
+class ResponseCache:
+    """
+    Cache delle risposte dell'LLM da mettere davanti a ContextualChatBot.
+
+    - Livello esatto: la chiave è l'hash del prompt completo normalizzato (system prompt +
+      contesto + messaggio). Eviction LRU, scadenza TTL e un budget massimo in byte.
+    - Livello semantico (opzionale): se viene passato un modello di 'embeddings', una
+      domanda simile a una già vista (similarità coseno >= 'similarity_threshold') riusa
+      la risposta. Il confronto avviene solo tra domande con lo stesso contesto ('scope'),
+      così una risposta non viene mai riusata in una conversazione diversa.
+
+    La cache è thread-safe e pensata per essere condivisa da tutte le sessioni del processo.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        max_bytes: int = 10 * 1024 * 1024,
+        ttl_seconds: Optional[float] = 3600,
+        embeddings=None,
+        similarity_threshold: float = 0.92,
+        max_semantic_entries: int = 1000,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.max_semantic_entries = max_semantic_entries
+
+        # livello esatto: chiave -> (risposta, istante di inserimento, dimensione in byte)
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._total_bytes = 0
+
+        # livello semantico: vettori delle domande in una matrice, più i metadati paralleli
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._semantic_meta: List[tuple] = []  # (scope, risposta, istante di inserimento)
+
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def _make_key(text: str) -> str:
+        # si conserva solo l'hash: i prompt lunghi non occupano memoria come chiavi
+        return hashlib.sha256(normalize_prompt(text).encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created_at: float, now: float) -> bool:
+        return self.ttl_seconds is not None and now - created_at > self.ttl_seconds
+
+    def get(self, prompt: str, question: Optional[str] = None, scope: str = "") -> Optional[str]:
+        """
+        Cerca una risposta per il prompt indicato; restituisce None in caso di miss.
+
+        Args:
+            prompt (str): Il prompt completo inviato all'LLM (chiave del livello esatto).
+            question (str): Il solo messaggio dell'utente, usato dal livello semantico.
+            scope (str): Il contesto della domanda (system prompt + cronologia).
+        """
+        now = time.time()
+        key = self._make_key(prompt)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, created_at, size = entry
+                if self._is_expired(created_at, now):
+                    self._remove(key)
+                    self.stats["evictions"] += 1
+                else:
+                    # l'elemento diventa il più recente nell'ordine LRU
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return response
+
+        # il calcolo dell'embedding avviene fuori dal lock
+        if self.embeddings is not None and question:
+            response = self._semantic_lookup(question, self._make_key(scope), now)
+            if response is not None:
+                with self._lock:
+                    self.stats["semantic_hits"] += 1
+                return response
+
+        with self._lock:
+            self.stats["misses"] += 1
+        return None
+
+    def put(self, prompt: str, response: str, question: Optional[str] = None, scope: str = ""):
+        """Memorizza una risposta in entrambi i livelli della cache."""
+        now = time.time()
+        key = self._make_key(prompt)
+        size = len(response.encode("utf-8"))
+
+        # una risposta più grande dell'intero budget non viene memorizzata
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (response, now, size)
+            self._total_bytes += size
+
+            # eviction LRU finché numero di elementi e byte rientrano nei limiti
+            while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.stats["evictions"] += 1
+
+        if self.embeddings is not None and question:
+            vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+            with self._lock:
+                self._semantic_add(vector, (self._make_key(scope), response, now))
+
+    def _remove(self, key: str):
+        _, _, size = self._entries.pop(key)
+        self._total_bytes -= size
+
+    def _semantic_add(self, vector: np.ndarray, meta: tuple):
+        if self._vectors.shape[0] == 0:
+            self._vectors = vector.reshape(1, -1)
+        else:
+            self._vectors = np.vstack([self._vectors, vector])
+        self._semantic_meta.append(meta)
+
+        # il livello semantico scarta le voci più vecchie (FIFO)
+        overflow = len(self._semantic_meta) - self.max_semantic_entries
+        if overflow > 0:
+            self._vectors = self._vectors[overflow:]
+            del self._semantic_meta[:overflow]
+            self.stats["evictions"] += overflow
+
+    def _semantic_lookup(self, question: str, scope_key: str, now: float) -> Optional[str]:
+        vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            return None
+
+        with self._lock:
+            if not self._semantic_meta:
+                return None
+            # similarità coseno con tutte le domande memorizzate in un'unica operazione
+            norms = np.linalg.norm(self._vectors, axis=1) * norm
+            scores = (self._vectors @ vector) / np.where(norms == 0, 1.0, norms)
+
+            for index in np.argsort(scores)[::-1]:
+                if scores[index] < self.similarity_threshold:
+                    break
+                entry_scope, response, created_at = self._semantic_meta[index]
+                if entry_scope == scope_key and not self._is_expired(created_at, now):
+                    return response
+        return None
+
+    def clear(self):
+        """Svuota la cache (le statistiche restano invariate)."""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._semantic_meta = []
+
+    def get_stats(self) -> Dict:
+        """Restituisce i contatori della cache e la sua occupazione attuale."""
+        with self._lock:
+            return {
+                **self.stats,
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "semantic_entries": len(self._semantic_meta),
+            }
+
+
+# cache condivisa dal processo: i moduli importati sopravvivono alle riesecuzioni di Streamlit.
+_shared_cache: Optional[ResponseCache] = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_shared_response_cache(**kwargs) -> ResponseCache:
+    """
+    Restituisce la ResponseCache unica del processo, creandola alla prima chiamata
+    con i parametri indicati (le chiamate successive ignorano i parametri).
+    """
+    global _shared_cache
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            _shared_cache = ResponseCache(**kwargs)
+        return _shared_cache
@@ -0,0 +1,80 @@
+"""
+Indice vettoriale in memoria degli scambi di una conversazione, per la memoria a recupero.
+
+Nella modalità a recupero (ConversationManager con 'turn_index') il contesto non è fatto
+solo degli ultimi scambi, ma anche di quelli passati più pertinenti alla nuova domanda:
+ogni scambio (domanda + risposta) viene indicizzato con un embedding locale e, a ogni
+domanda, si cercano i k scambi più simili con un unico prodotto matrice-vettore in NumPy.
+
+Gli embedding vengono calcolati a blocchi: gli scambi aggiunti restano in attesa e
+vengono elaborati insieme (con 'embed_documents') solo quando arriva una ricerca.
+"""
+from typing import List, Tuple
+
+import numpy as np
+
+
+class TurnIndex:
+    """
+    Vettori normalizzati degli scambi in una matrice NumPy, nell'ordine in cui sono stati
+    aggiunti: la riga i è l'i-esimo scambio. La matrice cresce raddoppiando, come una lista,
+    così aggiungere uno scambio non copia ogni volta tutti i vettori.
+    """
+
+    def __init__(self, embeddings, batch_size: int = 64):
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._size = 0
+        self._pending: List[str] = []
+
+    def __len__(self) -> int:
+        return self._size + len(self._pending)
+
+    def add(self, text: str):
+        """Aggiunge uno scambio; il suo embedding verrà calcolato alla prossima ricerca."""
+        self._pending.append(text)
+
+    def reset(self):
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._size = 0
+        self._pending = []
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        if hasattr(self.embeddings, "embed_documents"):
+            vectors = np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        else:
+            vectors = np.asarray([self.embeddings.embed_query(text) for text in texts], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    def _flush(self):
+        """Calcola a blocchi di 'batch_size' gli embedding degli scambi in attesa."""
+        for start in range(0, len(self._pending), self.batch_size):
+            vectors = self._embed(self._pending[start:start + self.batch_size])
+            needed = self._size + len(vectors)
+            if needed > len(self._vectors):
+                grown = np.zeros((max(needed, 2 * len(self._vectors), 16), vectors.shape[1]), dtype=np.float32)
+                if self._size:
+                    grown[:self._size] = self._vectors[:self._size]
+                self._vectors = grown
+            self._vectors[self._size:needed] = vectors
+            self._size = needed
+        self._pending = []
+
+    def search(self, query: str, k: int, limit: int) -> List[Tuple[int, float]]:
+        """
+        Restituisce i k scambi più simili alla domanda tra i primi 'limit' (i più recenti
+        restano fuori perché sono già nel contesto), come coppie (posizione, similarità)
+        dalla più simile.
+        """
+        self._flush()
+        n = min(limit, self._size)
+        if n <= 0 or k <= 0:
+            return []
+        query_vector = self._embed([query])[0]
+        scores = self._vectors[:n] @ query_vector
+        # argpartition trova i k migliori senza ordinare tutti i punteggi; poi si ordinano solo quelli
+        top = np.argpartition(-scores, k - 1)[:k] if k < n else np.arange(n)
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top]
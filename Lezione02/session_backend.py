@@ -0,0 +1,378 @@
+"""
+Stato delle sessioni condiviso tra processi.
+
+Con Streamlit lo stato di una sessione (cronologia, riassunto, totali di token e costi)
+vive in 'st.session_state', cioè nella memoria di un solo processo. Per servire il chatbot
+con più worker (uvicorn/gunicorn, vedi api.py) lo stato deve stare fuori dal processo:
+ogni richiesta prende il lock della sessione, carica lo stato, risponde e lo salva.
+
+Un backend salva per ogni sessione un dizionario JSON prodotto da session_state() e
+offre un lock per sessione valido tra processi, con una scadenza ('lease') che lo libera
+anche se il processo che lo tiene termina senza rilasciarlo. Tiene anche i contatori dei
+budget di token (vedi UsageQuotas in rate_limiter.py), così il budget di un utente vale per
+tutti i worker insieme e non si azzera riavviandoli. Le implementazioni sono:
+
+- SQLiteSessionBackend: un file SQLite condiviso dai worker della stessa macchina;
+- RedisSessionBackend: un server Redis (o compatibile), anche per worker su più macchine.
+  Parla direttamente il protocollo RESP, senza dipendenze; per provarlo in locale
+  c'è resp_server_stub.py.
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+
+class SessionLockTimeout(TimeoutError):
+    """Il lock della sessione non si è liberato entro il tempo di attesa."""
+
+
+def session_state(chatbot, token_monitor) -> Dict:
+    """Raccoglie lo stato di una sessione (chatbot e monitor dei token) in un dizionario JSON."""
+    return {"chatbot": chatbot.get_state(), "token_monitor": token_monitor.get_state()}
+
+
+def restore_session(state: Dict, chatbot, token_monitor):
+    """Riporta chatbot e monitor dei token allo stato salvato con session_state()."""
+    chatbot.set_state(state["chatbot"])
+    token_monitor.set_state(state["token_monitor"])
+
+
+class SessionBackend(ABC):
+    """Interfaccia comune dei backend di stato delle sessioni."""
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[Dict]:
+        """Restituisce lo stato salvato della sessione, o None se non esiste."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def save(self, session_id: str, state: Dict):
+        """Salva (sovrascrivendolo) lo stato della sessione."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, session_id: str):
+        """Elimina lo stato della sessione, se esiste."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _acquire(self, session_id: str, token: str, lease: float) -> bool:
+        """Prova una volta a prendere il lock; True se riuscito."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _release(self, session_id: str, token: str):
+        """Rilascia il lock, solo se è ancora di chi lo ha preso ('token')."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def add_usage(self, key: str, tokens: int, period: float, window: Optional[float] = None) -> Tuple[float, int]:
+        """
+        Aggiunge in modo atomico 'tokens' (anche negativi) al consumo di 'key' nella finestra
+        di 'period' secondi corrente, o in quella che inizia a 'window'. Restituisce l'inizio
+        della finestra e i token usati dopo l'aggiunta.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_usage(self, key: str, period: float) -> Tuple[float, int]:
+        """Inizio (secondi dal 1970) e token usati della finestra corrente di 'key'."""
+        raise NotImplementedError
+
+    @staticmethod
+    def _usage_window(period: float) -> float:
+        # finestre allineate (es. giorni interi per period=86400): tutti i worker calcolano la stessa
+        return time.time() // period * period
+
+    @contextmanager
+    def lock(self, session_id: str, timeout: float = 30.0, lease: float = 120.0) -> Iterator[None]:
+        """
+        Lock esclusivo sulla sessione, valido tra processi: due richieste della stessa
+        sessione non possono leggere e riscrivere lo stato contemporaneamente.
+        Attende al massimo 'timeout' secondi; il lock scade comunque dopo 'lease'
+        secondi, così un worker terminato non blocca la sessione per sempre.
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        delay = 0.005
+        while not self._acquire(session_id, token, lease):
+            if time.monotonic() >= deadline:
+                raise SessionLockTimeout(f"Sessione {session_id} occupata da un'altra richiesta")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        try:
+            yield
+        finally:
+            self._release(session_id, token)
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Stato delle sessioni in un file SQLite condiviso dai worker della stessa macchina.
+    Il lock è una riga della tabella 'session_locks': inserirla (o prenderla se scaduta)
+    è un'unica istruzione, quindi atomica anche tra processi diversi.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            state TEXT NOT NULL,
+            updated_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS session_locks (
+            session_id TEXT PRIMARY KEY,
+            token TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS usage_quotas (
+            quota_key TEXT NOT NULL,
+            window_start REAL NOT NULL,
+            used INTEGER NOT NULL,
+            PRIMARY KEY (quota_key, window_start)
+        );
+    """
+
+    def __init__(self, db_path: str = "./memory/sessions.db"):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.db_path = db_path
+
+        # come in SQLiteConversationStore: una connessione per processo protetta da un lock,
+        # modalità WAL per le letture concorrenti e attesa sui lock di scrittura degli altri processi
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30.0)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save(self, session_id: str, state: Dict):
+        data = json.dumps(state, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO sessions (session_id, state, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET state = excluded.state, updated_at = excluded.updated_at",
+                (session_id, data, time.time())
+            )
+
+    def delete(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def _acquire(self, session_id: str, token: str, lease: float) -> bool:
+        now = time.time()
+        with self._lock, self._conn:
+            # la riga viene inserita se manca, sostituita se il lock precedente è scaduto
+            cursor = self._conn.execute(
+                "INSERT INTO session_locks (session_id, token, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (session_id) DO UPDATE SET token = excluded.token, expires_at = excluded.expires_at "
+                "WHERE session_locks.expires_at < ?",
+                (session_id, token, now + lease, now)
+            )
+            return cursor.rowcount == 1
+
+    def _release(self, session_id: str, token: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM session_locks WHERE session_id = ? AND token = ?", (session_id, token))
+
+    def add_usage(self, key: str, tokens: int, period: float, window: Optional[float] = None) -> Tuple[float, int]:
+        window = self._usage_window(period) if window is None else window
+        with self._lock, self._conn:
+            # l'incremento è un'unica istruzione: atomico anche con più worker; la transazione
+            # tiene il lock in scrittura del file fino al commit, quindi il totale letto è il suo
+            self._conn.execute(
+                "INSERT INTO usage_quotas (quota_key, window_start, used) VALUES (?, ?, ?) "
+                "ON CONFLICT (quota_key, window_start) DO UPDATE SET used = used + excluded.used",
+                (key, window, tokens)
+            )
+            used = self._conn.execute(
+                "SELECT used FROM usage_quotas WHERE quota_key = ? AND window_start = ?", (key, window)
+            ).fetchone()[0]
+            self._conn.execute("DELETE FROM usage_quotas WHERE quota_key = ? AND window_start < ?", (key, window))
+        return window, used
+
+    def get_usage(self, key: str, period: float) -> Tuple[float, int]:
+        window = self._usage_window(period)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT used FROM usage_quotas WHERE quota_key = ? AND window_start = ?", (key, window)
+            ).fetchone()
+        return window, row[0] if row else 0
+
+
+class RespError(Exception):
+    """Errore restituito dal server Redis."""
+
+
+class RespClient:
+    """
+    Client minimo del protocollo RESP di Redis: invia comandi come array di stringhe e
+    decodifica le risposte. Una connessione per thread, riaperta se il server la chiude.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", timeout: float = 5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.lstrip("/") or 0)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._local.sock = sock
+        self._local.reader = sock.makefile("rb")
+        if self.password:
+            self._call("AUTH", self.password)
+        if self.db:
+            self._call("SELECT", self.db)
+
+    def _close(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is not None:
+            self._local.reader.close()
+            sock.close()
+        self._local.sock = None
+
+    def _send(self, *args):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._local.sock.sendall(b"".join(parts))
+
+    def _call(self, *args):
+        self._send(*args)
+        return self._read_reply()
+
+    def _read_reply(self):
+        line = self._local.reader.readline()
+        if not line:
+            raise ConnectionError("Connessione chiusa dal server Redis")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RespError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = self._local.reader.read(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            return None if length < 0 else [self._read_reply() for _ in range(length)]
+        raise RespError(f"Risposta non valida dal server: {line!r}")
+
+    def execute(self, *args, idempotent: bool = True):
+        """
+        Esegue un comando e restituisce la risposta (bytes, int, str, lista o None).
+
+        Se la connessione è caduta (es. server riavviato) si riprova una volta con una nuova.
+        Se però l'errore arriva dopo l'invio, il server potrebbe aver già eseguito il comando:
+        in quel caso si riprova solo se 'idempotent'. Un SET NX ripetuto, ad esempio, troverebbe
+        il lock appena preso e lo considererebbe di un altro; un INCRBY conterebbe due volte.
+        """
+        if getattr(self._local, "sock", None) is None:
+            self._connect()
+        try:
+            self._send(*args)
+        except (ConnectionError, OSError):
+            self._close()
+            self._connect()
+            return self._call(*args)
+        try:
+            return self._read_reply()
+        except (ConnectionError, OSError):
+            self._close()
+            if not idempotent:
+                raise
+            self._connect()
+            return self._call(*args)
+
+
+class RedisSessionBackend(SessionBackend):
+    """
+    Stato delle sessioni su Redis: una chiave per sessione con scadenza 'ttl' (le sessioni
+    abbandonate spariscono da sole) e il lock con SET NX PX, il lock standard di Redis.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", ttl: int = 7 * 24 * 3600, prefix: str = "chatbot"):
+        self.client = RespClient(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:session:{session_id}"
+
+    def _lock_key(self, session_id: str) -> str:
+        return f"{self.prefix}:lock:{session_id}"
+
+    def _usage_key(self, key: str, window: float) -> str:
+        return f"{self.prefix}:quota:{key}:{int(window)}"
+
+    def load(self, session_id: str) -> Optional[Dict]:
+        data = self.client.execute("GET", self._key(session_id))
+        return json.loads(data) if data is not None else None
+
+    def save(self, session_id: str, state: Dict):
+        self.client.execute("SET", self._key(session_id), json.dumps(state, ensure_ascii=False), "EX", self.ttl)
+
+    def delete(self, session_id: str):
+        self.client.execute("DEL", self._key(session_id))
+
+    def _acquire(self, session_id: str, token: str, lease: float) -> bool:
+        reply = self.client.execute("SET", self._lock_key(session_id), token, "NX", "PX", int(lease * 1000),
+                                    idempotent=False)
+        return reply == "OK"
+
+    def _release(self, session_id: str, token: str):
+        # GET e DEL non sono atomici (servirebbe uno script Lua): il lock però viene rilasciato
+        # solo da chi lo tiene, quindi può sparire nel mezzo solo se il lease è già scaduto
+        if self.client.execute("GET", self._lock_key(session_id)) == token.encode():
+            self.client.execute("DEL", self._lock_key(session_id))
+
+    def add_usage(self, key: str, tokens: int, period: float, window: Optional[float] = None) -> Tuple[float, int]:
+        # un contatore per finestra: INCRBY è atomico (e restituisce il nuovo totale) e la chiave scade con la finestra
+        window = self._usage_window(period) if window is None else window
+        usage_key = self._usage_key(key, window)
+        used = self.client.execute("INCRBY", usage_key, int(tokens), idempotent=False)
+        self.client.execute("EXPIRE", usage_key, int(period) + 60)
+        return window, int(used)
+
+    def get_usage(self, key: str, period: float) -> Tuple[float, int]:
+        window = self._usage_window(period)
+        used = self.client.execute("GET", self._usage_key(key, window))
+        return window, int(used) if used is not None else 0
+
+
+def get_session_backend(kind: Optional[str] = None) -> SessionBackend:
+    """
+    Crea il backend indicato da 'kind' o dalla variabile d'ambiente SESSION_BACKEND
+    ('sqlite', il default, oppure 'redis'); il file SQLite è SESSION_DB e
+    l'indirizzo di Redis è REDIS_URL.
+    """
+    kind = kind or os.getenv("SESSION_BACKEND", "sqlite")
+    if kind == "redis":
+        return RedisSessionBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if kind == "sqlite":
+        return SQLiteSessionBackend(os.getenv("SESSION_DB", "./memory/sessions.db"))
+    raise ValueError(f"Backend di sessione sconosciuto: {kind}")
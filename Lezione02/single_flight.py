@@ -0,0 +1,258 @@
+"""
+Coalescenza delle richieste identiche in corso ("single flight").
+
+Quando più utenti (o un doppio invio di Streamlit) mandano nello stesso momento lo stesso
+prompt allo stesso modello, ognuno farebbe la propria chiamata all'API, pagandola. Con
+SingleFlight la prima richiesta (il "leader") chiama l'LLM e le altre con la stessa chiave
+attendono la sua risposta, o in streaming ricevono gli stessi frammenti man mano che arrivano.
+
+Un errore del leader viene rilanciato a tutte le richieste in attesa, tranne quelli che
+riguardano solo il leader ('retry_on', es. il rifiuto del suo rate limiter): allora chi
+attendeva riprova, diventando a sua volta leader se nessuno lo precede. Chi attende più di
+'timeout' secondi (per la risposta, o per il frammento successivo in streaming) riceve
+CoalescedRequestTimeout. La coalescenza vale solo per le richieste contemporanee: una
+richiesta che arriva a chiamata conclusa ne avvia una nuova (per le risposte già date
+c'è la cache delle risposte).
+"""
+import asyncio
+import hashlib
+import json
+import threading
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Type
+
+ErrorTypes = Tuple[Type[BaseException], ...]
+
+
+class CoalescedRequestTimeout(TimeoutError):
+    """La richiesta identica in corso non ha risposto entro il tempo di attesa."""
+
+
+def model_params(llm) -> Dict:
+    """Parametri del modello che, insieme al prompt, identificano una richiesta."""
+    if hasattr(llm, "models"):
+        # ModelRouter: la risposta dipende da tutti i modelli che il router può scegliere
+        return {name: model_params(model) for name, model in llm.models}
+    get_params = getattr(llm, "_get_invocation_params", None)
+    if get_params is not None:
+        return get_params()
+    return {"llm": f"{type(llm).__name__}@{id(llm)}"}
+
+
+class _Call:
+    """Una chiamata in corso: il risultato (o l'errore) e i frammenti già ricevuti in streaming."""
+
+    __slots__ = ("cond", "done", "result", "error", "chunks", "waiters")
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.done = False
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.chunks: List[Any] = []
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Registro delle chiamate all'LLM in corso, indicizzate per chiave (vedi make_key).
+    Un'istanza va condivisa da tutte le sessioni del processo (get_shared_single_flight).
+    """
+
+    def __init__(self, timeout: float = 60.0):
+        self.timeout = timeout
+        self._calls: Dict[str, _Call] = {}
+        # per le chiamate asincrone il lavoro condiviso è un task del loop asyncio
+        self._tasks: Dict[Tuple[int, str], asyncio.Future] = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+
+    @staticmethod
+    def make_key(llm, prompt: str, mode: str = "invoke") -> str:
+        """
+        Chiave di una richiesta: il prompt finale (in forma di testo), i parametri del modello
+        e la modalità ('invoke' o 'stream'), perché una risposta completa e uno stream non
+        si possono scambiare.
+        """
+        params = json.dumps(model_params(llm), sort_keys=True, default=str)
+        return hashlib.sha256(f"{params}\x00{mode}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    def _join(self, key: str) -> Tuple[_Call, bool]:
+        """Restituisce la chiamata in corso per la chiave (creandola) e True se si è il leader."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.coalesced += 1
+                return call, False
+            call = self._calls[key] = _Call()
+            self.leaders += 1
+            return call, True
+
+    def _finish(self, key: str, call: _Call, result=None, error: Optional[BaseException] = None):
+        with self._lock:
+            # da qui le nuove richieste con la stessa chiave avviano una nuova chiamata
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        with call.cond:
+            call.result, call.error, call.done = result, error, True
+            call.cond.notify_all()
+
+    def _timeout(self) -> CoalescedRequestTimeout:
+        with self._lock:
+            self.timeouts += 1
+        return CoalescedRequestTimeout(f"Nessuna risposta dalla richiesta identica in corso entro {self.timeout} s")
+
+    def do(self, key: str, fn: Callable[[], Any], retry_on: ErrorTypes = ()) -> Tuple[Any, bool]:
+        """
+        Esegue 'fn' se non c'è una chiamata in corso con la stessa chiave, altrimenti ne
+        attende il risultato. Restituisce (risultato, condiviso): 'condiviso' è True se
+        il risultato è di un'altra richiesta, quindi questa non ha speso token.
+        Se il leader fallisce con un errore di tipo 'retry_on', chi attendeva riprova.
+        """
+        while True:
+            call, leader = self._join(key)
+            if leader:
+                try:
+                    result = fn()
+                except BaseException as e:
+                    self._finish(key, call, error=e)
+                    raise
+                self._finish(key, call, result=result)
+                return result, False
+
+            with call.cond:
+                if not call.cond.wait_for(lambda: call.done, self.timeout):
+                    raise self._timeout()
+            if call.error is None:
+                return call.result, True
+            if not isinstance(call.error, retry_on):
+                raise call.error
+
+    def stream(self, key: str, fn: Callable[[], Iterator], retry_on: ErrorTypes = ()) -> Tuple[Iterator, bool]:
+        """
+        Come do(), per lo streaming: restituisce (frammenti, condiviso). Il leader riceve
+        lo stream dell'LLM; chi si accoda riceve prima i frammenti già arrivati e poi
+        gli altri man mano che il leader li riceve.
+        Se il leader fallisce con un errore di tipo 'retry_on' prima del primo frammento,
+        chi attendeva riprova e, se diventa leader, riceve lo stream del proprio 'fn':
+        'condiviso' è già stato restituito, quindi è l'esecuzione di 'fn' a dire al
+        chiamante che la richiesta ha speso token.
+        """
+        call, leader = self._join(key)
+        if leader:
+            return self._lead_stream(key, call, fn), False
+        return self._follow_stream(call, key, fn, retry_on), True
+
+    def _lead_stream(self, key: str, call: _Call, fn: Callable[[], Iterator]) -> Iterator:
+        upstream = None
+        try:
+            upstream = iter(fn())
+            for chunk in upstream:
+                with call.cond:
+                    call.chunks.append(chunk)
+                    call.cond.notify_all()
+                yield chunk
+        except GeneratorExit:
+            # il leader ha smesso di leggere (es. rerun di Streamlit): se qualcuno attende,
+            # lo stream viene completato in background, altrimenti si chiude subito
+            with self._lock:
+                abandoned = call.waiters == 0
+                if abandoned and self._calls.get(key) is call:
+                    del self._calls[key]
+            if abandoned:
+                if hasattr(upstream, "close"):
+                    upstream.close()
+            else:
+                threading.Thread(target=self._drain, args=(key, call, upstream), daemon=True).start()
+            raise
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call)
+
+    def _drain(self, key: str, call: _Call, upstream: Iterator):
+        try:
+            for chunk in upstream:
+                with call.cond:
+                    call.chunks.append(chunk)
+                    call.cond.notify_all()
+        except Exception as e:
+            self._finish(key, call, error=e)
+            return
+        self._finish(key, call)
+
+    def _follow_stream(self, call: _Call, key: str, fn: Callable[[], Iterator], retry_on: ErrorTypes) -> Iterator:
+        position = 0
+        while True:
+            with call.cond:
+                if not call.cond.wait_for(lambda: len(call.chunks) > position or call.done, self.timeout):
+                    raise self._timeout()
+                chunks, done = call.chunks[position:], call.done
+            position += len(chunks)
+            yield from chunks
+            # a chiamata conclusa non arrivano altri frammenti: quelli letti sono tutti
+            if done:
+                if call.error is None:
+                    return
+                if position or not isinstance(call.error, retry_on):
+                    raise call.error
+                call, leader = self._join(key)
+                if leader:
+                    yield from self._lead_stream(key, call, fn)
+                    return
+
+    async def ado(self, key: str, fn: Callable[[], Awaitable], retry_on: ErrorTypes = ()) -> Tuple[Any, bool]:
+        """Versione asincrona di do(): la chiamata condivisa è un task del loop corrente."""
+        loop = asyncio.get_running_loop()
+        task_key = (id(loop), key)
+        while True:
+            with self._lock:
+                task = self._tasks.get(task_key)
+                leader = task is None or task.done()
+                if leader:
+                    task = self._tasks[task_key] = loop.create_task(fn())
+                    task.add_done_callback(lambda done: self._forget_task(task_key, done))
+                    self.leaders += 1
+                else:
+                    self.coalesced += 1
+
+            # 'shield': se una richiesta viene annullata, la chiamata prosegue per le altre
+            if leader:
+                return await asyncio.shield(task), False
+            try:
+                return await asyncio.wait_for(asyncio.shield(task), self.timeout), True
+            except asyncio.TimeoutError:
+                raise self._timeout() from None
+            except retry_on:
+                continue
+
+    def _forget_task(self, task_key: Tuple[int, str], task: asyncio.Future):
+        with self._lock:
+            if self._tasks.get(task_key) is task:
+                del self._tasks[task_key]
+
+    def get_stats(self) -> Dict[str, int]:
+        """Chiamate avviate, richieste servite da una chiamata già in corso e attese scadute."""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls) + len(self._tasks),
+                "leaders": self.leaders,
+                "coalesced": self.coalesced,
+                "timeouts": self.timeouts
+            }
+
+
+# registro condiviso dal processo: coalescono solo le richieste che lo usano tutte.
+_shared_single_flight: Optional[SingleFlight] = None
+_shared_single_flight_lock = threading.Lock()
+
+
+def get_shared_single_flight(timeout: float = 60.0) -> SingleFlight:
+    """Restituisce il registro delle chiamate in corso condiviso dal processo."""
+    global _shared_single_flight
+    with _shared_single_flight_lock:
+        if _shared_single_flight is None:
+            _shared_single_flight = SingleFlight(timeout)
+        return _shared_single_flight
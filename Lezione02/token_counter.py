@@ -0,0 +1,56 @@
+import logging
+from functools import lru_cache
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# encoding usato per i modelli che tiktoken non conosce (quello della famiglia gpt-4o)
+DEFAULT_ENCODING = "o200k_base"
+
+
+@lru_cache(maxsize=None)
+def _get_encoding(model: str):
+    """
+    Carica (una sola volta per modello) il tokenizer BPE di tiktoken.
+    Restituisce None se i file del tokenizer non sono disponibili, ad esempio
+    al primo avvio su una macchina senza accesso alla rete.
+    """
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(DEFAULT_ENCODING)
+    except Exception as e:
+        logger.warning("Tokenizer per '%s' non disponibile, uso una stima: %s", model, e)
+        return None
+
+
+class TokenCounter:
+    """
+    Conta i token di un testo con il tokenizer locale del modello (tiktoken),
+    cioè con lo stesso conteggio che userà l'API, senza doverla chiamare.
+    I conteggi dei testi già visti (es. il system prompt) vengono memorizzati in cache.
+    """
+
+    def __init__(self, model: str = "gpt-4o-mini", cache_size: int = 4096):
+        self.model = model
+        self.count = lru_cache(maxsize=cache_size)(self._count)
+
+    @property
+    def _encoding(self):
+        # il tokenizer viene caricato solo al primo conteggio (e poi resta in cache)
+        return _get_encoding(self.model)
+
+    @property
+    def is_exact(self) -> bool:
+        """False se il tokenizer non è disponibile e i conteggi sono solo stimati."""
+        return self._encoding is not None
+
+    def _count(self, text: str) -> int:
+        encoding = self._encoding
+        if encoding is None:
+            # stima di ripiego: in media un token corrisponde a circa 4 caratteri
+            return max(1, len(text) // 4) if text else 0
+        # 'disallowed_special=()' tratta eventuali token speciali nel testo come testo normale
+        return len(encoding.encode(text, disallowed_special=()))
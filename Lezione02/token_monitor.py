@@ -1,33 +1,91 @@
+import json
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Optional
+from usage_log import get_usage_writer
+
+# listino dei modelli, in dollari per 1M di token
+# (i token di input letti dalla cache del provider costano la metà)
+MODEL_PRICING = {
+    "gpt-4o-mini": {
+        "input_cost_per_1m_tokens": 0.15,
+        "cached_input_cost_per_1m_tokens": 0.075,
+        "output_cost_per_1m_tokens": 0.60
+    },
+    "gpt-4o": {
+        "input_cost_per_1m_tokens": 2.50,
+        "cached_input_cost_per_1m_tokens": 1.25,
+        "output_cost_per_1m_tokens": 10.00
+    }
+}
+
+# voce delle risposte arrivate dalla cache (o da una richiesta identica già in corso):
+# non hanno chiamato nessun modello, quindi non vengono attribuite a uno di essi
+CACHE_MODEL = "cache"
 
 class TokenMonitor:
     """Classe per monitorare l'utilizzo dei token e i costi delle API OpenAI"""
-    def __init__(self, log_file: str = "token_usage.json"):
+    def __init__(self, log_file: Optional[str] = "token_usage.jsonl", response_cache=None,
+                 default_model: str = "gpt-4o-mini", pricing: Optional[Dict[str, Dict[str, float]]] = None):
+        """
+        Args:
+            log_file (str): Il file JSON Lines in cui vengono aggiunti i record di ogni interazione
+                (None per non salvare nulla su disco).
+            response_cache (ResponseCache): La cache delle risposte di cui riportare le statistiche.
+            default_model (str): Il modello a cui attribuire le interazioni che non indicano il proprio.
+            pricing (Dict): Il listino per modello (per default MODEL_PRICING).
+        """
         self.log_file = log_file
+        # cache delle risposte (opzionale) di cui riportare le statistiche nel riassunto
+        self.response_cache = response_cache
+        self.default_model = default_model
+        
+        # i record delle interazioni vengono scritti su disco a blocchi da un writer condiviso,
+        # quindi in memoria restano solo i totali: l'occupazione non cresce con la sessione
+        self.writer = get_usage_writer(log_file) if log_file else None
 
         # 'session_data' è un dizionario che aggrega tutte le informazioni della sessione corrente
+        start_time = datetime.now()
         self.session_data = {
-            "start_time": datetime.now().isoformat(),
+            "session_id": f"session_{start_time.strftime('%Y%m%d_%H%M%S_%f')}",
+            "start_time": start_time.isoformat(),
             "total_input_tokens": 0,
             "total_output_tokens": 0,
+            "total_cached_input_tokens": 0,
+            "total_prefix_tokens": 0,
             "total_cost": 0.0,
-            "interactions": [] # lista per memorizzare i dettagli di ogni singola interazione
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "total_interactions": 0,
+            "models": {} # interazioni e costo per modello
         }
         
-        # prezzi per gpt-4o-mini
-        self.pricing = {
-            "input_cost_per_1m_tokens": 2.50,   # $0.15 per 1M token di input
-            "output_cost_per_1m_tokens": 10.00  # $0.60 per 1M token di output
-        }
+        # un listino per ogni modello che il router può usare
+        self.pricing = pricing or MODEL_PRICING
     
-    def calculate_cost(self, input_tokens: int, output_tokens: int) -> float:
+    def get_pricing(self, model: Optional[str] = None) -> Dict[str, float]:
+        """
+        Restituisce il listino del modello. I nomi con versione restituiti dall'API
+        (es. 'gpt-4o-mini-2024-07-18') usano il listino del nome più lungo che ne è prefisso.
+        """
+        model = model or self.default_model
+        if model in self.pricing:
+            return self.pricing[model]
+        prefixes = [name for name in self.pricing if model.startswith(name)]
+        if prefixes:
+            return self.pricing[max(prefixes, key=len)]
+        return self.pricing[self.default_model]
+    
+    def calculate_cost(self, input_tokens: int, output_tokens: int, cached_input_tokens: int = 0, model: Optional[str] = None) -> float:
         """Calcola il costo per una singola interazione"""
-        input_cost = (input_tokens / 1_000_000) * self.pricing["input_cost_per_1m_tokens"]
-        output_cost = (output_tokens / 1_000_000) * self.pricing["output_cost_per_1m_tokens"]
-        return input_cost + output_cost
+        pricing = self.get_pricing(model)
+        # 'cached_input_tokens' è la parte dei token di input servita dalla cache del prompt del provider
+        uncached_input_tokens = input_tokens - cached_input_tokens
+        input_cost = (uncached_input_tokens / 1_000_000) * pricing["input_cost_per_1m_tokens"]
+        cached_input_cost = (cached_input_tokens / 1_000_000) * pricing["cached_input_cost_per_1m_tokens"]
+        output_cost = (output_tokens / 1_000_000) * pricing["output_cost_per_1m_tokens"]
+        return input_cost + cached_input_cost + output_cost
     
-    def log_interaction(self, question: str, response: str, usage_metadata: Dict) -> Dict:
+    def log_interaction(self, question: str, response: str, usage_metadata: Dict, cache_hit: bool = False) -> Dict:
         """
         Registra una singola interazione, calcola il costo e aggiorna i totali della sessione.
         Viene chiamato dopo ogni risposta dell'LLM.
@@ -35,33 +93,56 @@ class TokenMonitor:
         Args:
             question (str): Il messaggio dell'utente.
             response (str): La risposta generata dall'AI.
-            usage_metadata (Dict): Un dizionario fornito dall'API che contiene i conteggi dei token.
+            usage_metadata (Dict): Un dizionario fornito dall'API che contiene i conteggi dei token
+                ('prompt_tokens', 'completion_tokens' e, se disponibili, 'cached_prompt_tokens',
+                'prefix_tokens' e 'model').
+            cache_hit (bool): True se la risposta è arrivata dalla cache, senza chiamare l'API.
         
         Returns:
             Dict: Un dizionario con i dettagli dell'interazione appena registrata.
         """
         # estrae il numero di token di input e output dai metadati
-        input_tokens = usage_metadata.get('prompt_tokens', 0)
-        output_tokens = usage_metadata.get('completion_tokens', 0)
-        cost = self.calculate_cost(input_tokens, output_tokens)
+        # (una risposta dalla cache non ha consumato token, quindi non ha costo)
+        input_tokens = 0 if cache_hit else usage_metadata.get('prompt_tokens', 0)
+        output_tokens = 0 if cache_hit else usage_metadata.get('completion_tokens', 0)
+        cached_input_tokens = 0 if cache_hit else usage_metadata.get('cached_prompt_tokens', 0)
+        # token iniziali del prompt identici alla richiesta precedente: quelli che la cache
+        # del prompt del provider può servire (vedi la modalità a messaggi strutturati)
+        prefix_tokens = 0 if cache_hit else usage_metadata.get('prefix_tokens', 0)
+        model = CACHE_MODEL if cache_hit else usage_metadata.get('model') or self.default_model
+        cost = 0.0 if cache_hit else self.calculate_cost(input_tokens, output_tokens, cached_input_tokens, model)
         
         # crea un record dettagliato per questa specifica interazione
         interaction = {
+            "session_id": self.session_data["session_id"],
             "timestamp": datetime.now().isoformat(),
+            "model": model,
             "question": question,
             "response_length": len(response),
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
+            "cached_input_tokens": cached_input_tokens,
+            "prefix_tokens": prefix_tokens,
+            "usage_source": usage_metadata.get('source', 'api'), # 'api', 'tokenizer' o 'estimate'
+            "cache_hit": cache_hit,
             "cost_usd": round(cost, 6) # arrotonda il costo a 6 cifre decimali
         }
         
-        # aggiunge il record alla lista di interazioni della sessione
-        self.session_data["interactions"].append(interaction)
+        # aggiunge il record al log su disco (in modo bufferizzato)
+        if self.writer is not None:
+            self.writer.write(interaction)
         
         # aggiorna i contatori totali della sessione
         self.session_data["total_input_tokens"] += input_tokens
         self.session_data["total_output_tokens"] += output_tokens
+        self.session_data["total_cached_input_tokens"] += cached_input_tokens
+        self.session_data["total_prefix_tokens"] += prefix_tokens
         self.session_data["total_cost"] += cost
+        self.session_data["cache_hits" if cache_hit else "cache_misses"] += 1
+        self.session_data["total_interactions"] += 1
+        model_data = self.session_data["models"].setdefault(model, {"interactions": 0, "cost": 0.0})
+        model_data["interactions"] += 1
+        model_data["cost"] += cost
         
         return interaction
     
@@ -69,17 +150,39 @@ class TokenMonitor:
         """Restituisce un riassunto della sessione corrente"""
         total_tokens = self.session_data["total_input_tokens"] + self.session_data["total_output_tokens"]
         
-        return {
-            "total_interactions": len(self.session_data["interactions"]),
+        summary = {
+            "total_interactions": self.session_data["total_interactions"],
             "total_tokens": total_tokens,
             "input_tokens": self.session_data["total_input_tokens"],
             "output_tokens": self.session_data["total_output_tokens"],
+            "cached_input_tokens": self.session_data["total_cached_input_tokens"],
+            "prefix_tokens": self.session_data["total_prefix_tokens"],
             "total_cost_usd": round(self.session_data["total_cost"], 6),
             "average_cost_per_interaction": round(
-                self.session_data["total_cost"] / max(len(self.session_data["interactions"]), 1), 6
-            )
+                self.session_data["total_cost"] / max(self.session_data["total_interactions"], 1), 6
+            ),
+            "cache_hits": self.session_data["cache_hits"],
+            "cache_misses": self.session_data["cache_misses"],
+            "models": {
+                model: {"interactions": data["interactions"], "cost_usd": round(data["cost"], 6)}
+                for model, data in self.session_data["models"].items()
+            }
         }
+        
+        # le eviction dipendono dalla cache (condivisa tra le sessioni), non dalla singola sessione
+        if self.response_cache is not None:
+            summary["cache_evictions"] = self.response_cache.get_stats()["evictions"]
+        
+        return summary
+    
+    def get_state(self) -> Dict:
+        """Totali della sessione in un dizionario serializzabile in JSON (vedi session_backend.py)."""
+        return json.loads(json.dumps(self.session_data))
+    
+    def set_state(self, state: Dict):
+        """Riprende i totali di una sessione salvata con get_state(), anche da un altro processo."""
+        self.session_data = json.loads(json.dumps(state))
     
     def reset_session(self):
         """Resetta i contatori per iniziare a monitorare una nuova sessione."""
-        self.__init__() # richiama il costruttore per resettare lo stato a quello iniziale
\ No newline at end of file
+        self.__init__(self.log_file, self.response_cache, self.default_model, self.pricing) # richiama il costruttore per resettare lo stato a quello iniziale
\ No newline at end of file
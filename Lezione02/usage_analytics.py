@@ -0,0 +1,483 @@
+"""
+Analisi dei log di utilizzo scritti da TokenMonitor (token_usage.jsonl), anche di milioni di record.
+
+I record JSON Lines vengono convertiti in colonne NumPy (istante, modello, sessione, token,
+costo): le analisi sono operazioni vettoriali sulle colonne (bincount, percentile,
+argpartition) invece di cicli Python sui dizionari.
+
+La conversione legge il file a blocchi di righe, quindi non tiene mai in memoria tutti
+i dizionari insieme, e salva le colonne in una cartella accanto al log
+('token_usage.jsonl.columns/', un file .npy per colonna). Alle letture successive le colonne
+vengono aperte in memory map e si convertono solo le righe aggiunte nel frattempo: il log
+viene scritto solo in append (vedi usage_log.py), quindi basta ricordare fin dove è stato letto.
+
+Ogni sessione di TokenMonitor corrisponde a una conversazione (l'app la ricomincia con
+"Nuova Conversazione", l'API ne ha una per sessione): per questo i costi "per conversazione"
+sono quelli per session_id.
+
+    python usage_analytics.py token_usage.jsonl --since 7d --bucket day --top 10
+"""
+import argparse
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# colonne numeriche e loro tipo; 'model' e 'session' sono codici nei rispettivi vocabolari
+NUMERIC_COLUMNS = {
+    "timestamp": np.int64,  # microsecondi dal 1970 (ora locale, come in TokenMonitor)
+    "model": np.int32,
+    "session": np.int32,
+    "input_tokens": np.int64,
+    "output_tokens": np.int64,
+    "cached_input_tokens": np.int64,
+    "cost_usd": np.float64,
+    "cache_hit": np.bool_,
+}
+TOKEN_FIELDS = ("input_tokens", "output_tokens", "cached_input_tokens")
+
+# ampiezza degli intervalli di tempo, in microsecondi
+BUCKETS = {"hour": 3600 * 10**6, "day": 86400 * 10**6, "week": 7 * 86400 * 10**6}
+
+CACHE_SUFFIX = ".columns"
+CACHE_VERSION = 1
+DEFAULT_CHUNK_LINES = 100_000
+TITLE_LENGTH = 80
+
+
+class _Vocabulary:
+    """Nomi distinti di una colonna di testo (modelli, sessioni) e loro codice numerico."""
+
+    def __init__(self, names: Optional[List[str]] = None):
+        self.names: List[str] = list(names or [])
+        self.index: Dict[str, int] = {name: i for i, name in enumerate(self.names)}
+
+    def code(self, name: str) -> int:
+        code = self.index.get(name)
+        if code is None:
+            code = self.index[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+
+def _parse_chunk(lines: List[bytes], models: _Vocabulary, sessions: _Vocabulary,
+                 titles: List[str]) -> Dict[str, np.ndarray]:
+    """Converte un blocco di righe JSON in colonne; le righe non valide vengono saltate."""
+    try:
+        # un solo json.loads per tutto il blocco, come array: molto più veloce di una chiamata per riga
+        parsed = json.loads(b"[" + b",".join(lines) + b"]")
+    except ValueError:
+        # c'è una riga non valida: si ripiega sulla lettura riga per riga per saltare solo quella
+        parsed = []
+        for line in lines:
+            try:
+                parsed.append(json.loads(line))
+            except ValueError:
+                continue
+    records = [record for record in parsed if isinstance(record, dict) and record.get("timestamp")]
+
+    session_codes = np.empty(len(records), dtype=np.int32)
+    for i, record in enumerate(records):
+        code = session_codes[i] = sessions.code(str(record.get("session_id", "")))
+        if code == len(titles):
+            # la prima domanda della sessione serve da titolo nella classifica delle conversazioni
+            titles.append(str(record.get("question", ""))[:TITLE_LENGTH])
+
+    count = len(records)
+    return {
+        # NumPy converte direttamente le stringhe ISO 8601 in datetime64, senza datetime.fromisoformat
+        "timestamp": np.array([record["timestamp"] for record in records], dtype="datetime64[us]").astype(np.int64),
+        "model": np.fromiter((models.code(str(record.get("model", ""))) for record in records), np.int32, count),
+        "session": session_codes,
+        **{
+            field: np.fromiter((record.get(field) or 0 for record in records), np.int64, count)
+            for field in TOKEN_FIELDS
+        },
+        "cost_usd": np.fromiter((record.get("cost_usd") or 0.0 for record in records), np.float64, count),
+        "cache_hit": np.fromiter((bool(record.get("cache_hit")) for record in records), np.bool_, count),
+    }
+
+
+def _read_chunks(path: str, offset: int, chunk_lines: int) -> Iterator[Tuple[List[bytes], int]]:
+    """
+    Legge il file da 'offset' a blocchi di 'chunk_lines' righe complete e restituisce ogni
+    blocco con la posizione a cui finisce. Un'ultima riga senza a capo (il writer la sta
+    ancora scrivendo) viene lasciata alla lettura successiva.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        lines: List[bytes] = []
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            offset += len(line)
+            if line.strip():
+                lines.append(line)
+            if len(lines) >= chunk_lines:
+                yield lines, offset
+                lines = []
+        if lines:
+            yield lines, offset
+
+
+def _empty_columns() -> Dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype=dtype) for name, dtype in NUMERIC_COLUMNS.items()}
+
+
+def _file_signature(path: str) -> str:
+    """Impronta dell'inizio del file: se cambia, il log è stato sostituito e va riletto da capo."""
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.readline()).hexdigest()
+
+
+class UsageTable:
+    """
+    Record di utilizzo in colonne NumPy della stessa lunghezza (vedi NUMERIC_COLUMNS).
+    'models' e 'sessions' traducono i codici delle colonne omonime nei nomi; 'titles[i]'
+    è la prima domanda della sessione i.
+    """
+
+    def __init__(self, columns: Dict[str, np.ndarray], models: List[str], sessions: List[str], titles: List[str]):
+        self.columns = columns
+        self.models = models
+        self.sessions = sessions
+        self.titles = titles
+
+    def __len__(self) -> int:
+        return len(self.columns["timestamp"])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+    @property
+    def total_tokens(self) -> np.ndarray:
+        return self.columns["input_tokens"] + self.columns["output_tokens"]
+
+    @classmethod
+    def empty(cls) -> "UsageTable":
+        return cls(_empty_columns(), [], [], [])
+
+    def between(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> "UsageTable":
+        """I record con istante in [start, end); i vocabolari restano quelli completi."""
+        timestamps = self.columns["timestamp"]
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= np.datetime64(start, "us").astype(np.int64)
+        if end is not None:
+            mask &= timestamps < np.datetime64(end, "us").astype(np.int64)
+        return UsageTable({name: column[mask] for name, column in self.columns.items()},
+                          self.models, self.sessions, self.titles)
+
+    def totals(self) -> Dict[str, float]:
+        cache_hits = int(np.count_nonzero(self.columns["cache_hit"]))
+        return {
+            "interactions": len(self),
+            "sessions": int(np.unique(self.columns["session"]).size),
+            "input_tokens": int(self.columns["input_tokens"].sum()),
+            "output_tokens": int(self.columns["output_tokens"].sum()),
+            "cached_input_tokens": int(self.columns["cached_input_tokens"].sum()),
+            "cost_usd": round(float(self.columns["cost_usd"].sum()), 6),
+            "cache_hit_rate": round(cache_hits / len(self), 4) if len(self) else 0.0,
+        }
+
+    def time_buckets(self, bucket: str = "day") -> List[Dict]:
+        """Interazioni, token e costo per intervallo di tempo ('hour', 'day' o 'week'), in ordine."""
+        if not len(self):
+            return []
+        # gli intervalli settimanali partono dal lunedì (il 1/1/1970 era un giovedì)
+        shift = 3 * BUCKETS["day"] if bucket == "week" else 0
+        keys = (self.columns["timestamp"] + shift) // BUCKETS[bucket]
+        starts, inverse = np.unique(keys, return_inverse=True)
+        # bincount con i pesi somma ogni colonna per intervallo in un solo passaggio
+        sums = {
+            field: np.bincount(inverse, weights=self.columns[field], minlength=len(starts))
+            for field in (*TOKEN_FIELDS, "cost_usd")
+        }
+        counts = np.bincount(inverse, minlength=len(starts))
+        start_times = (starts * BUCKETS[bucket] - shift).astype("datetime64[us]")
+        return [
+            {
+                "start": start_times[i].astype(datetime),
+                "interactions": int(counts[i]),
+                **{field: int(sums[field][i]) for field in TOKEN_FIELDS},
+                "cost_usd": round(float(sums["cost_usd"][i]), 6),
+            }
+            for i in range(len(starts))
+        ]
+
+    def model_percentiles(self, percentiles: Sequence[float] = (50, 95, 99)) -> Dict[str, Dict]:
+        """
+        Per ogni modello: interazioni, costo totale e percentili dei token e del costo
+        di una singola interazione.
+        """
+        result = {}
+        codes = self.columns["model"]
+        if not len(self):
+            return result
+        # ordinando per modello ogni gruppo diventa una fetta contigua delle colonne
+        order = np.argsort(codes, kind="stable")
+        sorted_codes = codes[order]
+        present = np.unique(sorted_codes)
+        bounds = np.searchsorted(sorted_codes, np.append(present, present[-1] + 1))
+        tokens = self.total_tokens[order]
+        costs = self.columns["cost_usd"][order]
+        for i, code in enumerate(present):
+            group = slice(bounds[i], bounds[i + 1])
+            token_values = np.percentile(tokens[group], percentiles)
+            cost_values = np.percentile(costs[group], percentiles)
+            result[self.models[code]] = {
+                "interactions": int(bounds[i + 1] - bounds[i]),
+                "cost_usd": round(float(costs[group].sum()), 6),
+                **{f"tokens_p{q:g}": float(v) for q, v in zip(percentiles, token_values)},
+                **{f"cost_p{q:g}": float(v) for q, v in zip(percentiles, cost_values)},
+            }
+        return result
+
+    def _session_sums(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Codici delle sessioni presenti con interazioni, token e costo di ciascuna."""
+        codes, inverse = np.unique(self.columns["session"], return_inverse=True)
+        counts = np.bincount(inverse, minlength=len(codes))
+        tokens = np.bincount(inverse, weights=self.total_tokens, minlength=len(codes))
+        costs = np.bincount(inverse, weights=self.columns["cost_usd"], minlength=len(codes))
+        return codes, counts, tokens, costs
+
+    def session_percentiles(self, percentiles: Sequence[float] = (50, 95, 99)) -> Dict[str, Dict[str, float]]:
+        """Percentili, tra le sessioni, di interazioni, token e costo totali di una sessione."""
+        if not len(self):
+            return {}
+        _, counts, tokens, costs = self._session_sums()
+        return {
+            name: {f"p{q:g}": float(v) for q, v in zip(percentiles, np.percentile(values, percentiles))}
+            for name, values in (("interactions", counts), ("tokens", tokens), ("cost_usd", costs))
+        }
+
+    def top_sessions(self, n: int = 10) -> List[Dict]:
+        """Le n sessioni (conversazioni) più costose, dalla più costosa."""
+        if not len(self) or n <= 0:
+            return []
+        codes, counts, tokens, costs = self._session_sums()
+        # argpartition trova le n più costose senza ordinare tutte le sessioni
+        top = np.argpartition(-costs, n - 1)[:n] if n < len(costs) else np.arange(len(costs))
+        top = top[np.argsort(-costs[top], kind="stable")]
+        # primo e ultimo istante solo delle sessioni in classifica
+        in_top = np.isin(self.columns["session"], codes[top])
+        timestamps, sessions = self.columns["timestamp"][in_top], self.columns["session"][in_top]
+        result = []
+        for i in top:
+            session_times = timestamps[sessions == codes[i]]
+            result.append({
+                "session_id": self.sessions[codes[i]],
+                "title": self.titles[codes[i]],
+                "interactions": int(counts[i]),
+                "tokens": int(tokens[i]),
+                "cost_usd": round(float(costs[i]), 6),
+                "first": session_times.min().astype("datetime64[us]").astype(datetime),
+                "last": session_times.max().astype("datetime64[us]").astype(datetime),
+            })
+        return result
+
+
+class _ColumnCache:
+    """
+    Colonne di un log salvate in '<log>.columns/': un file .npy per colonna più 'meta.json'
+    con i vocabolari e la posizione del log fino a cui sono state convertite.
+    """
+
+    def __init__(self, log_path: str):
+        self.log_path = log_path
+        self.directory = log_path + CACHE_SUFFIX
+        self.meta_path = os.path.join(self.directory, "meta.json")
+
+    def load(self, signature: str, mmap: bool = True) -> Optional[Tuple[Dict, Dict[str, np.ndarray]]]:
+        """Metadati e colonne salvati, o None se mancano o appartengono a un altro file."""
+        try:
+            with open(self.meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            if meta.get("version") != CACHE_VERSION or meta.get("signature") != signature:
+                return None
+            columns = {
+                name: np.load(os.path.join(self.directory, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                for name in NUMERIC_COLUMNS
+            }
+        except (OSError, ValueError):
+            return None
+        if any(len(column) != meta["rows"] for column in columns.values()):
+            return None
+        return meta, columns
+
+    def save(self, meta: Dict, columns: Dict[str, np.ndarray]):
+        os.makedirs(self.directory, exist_ok=True)
+        for name, column in columns.items():
+            # file temporaneo e rename: chi legge in parallelo vede la colonna vecchia o la nuova
+            tmp = os.path.join(self.directory, f"{name}.tmp.npy")
+            np.save(tmp, column)
+            os.replace(tmp, os.path.join(self.directory, f"{name}.npy"))
+        tmp = self.meta_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, self.meta_path)
+
+
+def load_log(path: str, use_cache: bool = True, chunk_lines: int = DEFAULT_CHUNK_LINES) -> UsageTable:
+    """
+    Carica un log JSON Lines di TokenMonitor in colonne. Con 'use_cache' le colonne vengono
+    salvate accanto al log e, alle chiamate successive, aperte in memory map convertendo
+    solo le righe aggiunte dopo l'ultima lettura.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return UsageTable.empty()
+    signature = _file_signature(path)
+    cache = _ColumnCache(path) if use_cache else None
+    cached = cache.load(signature) if cache else None
+
+    if cached is not None:
+        meta, columns = cached
+        if meta["offset"] == os.path.getsize(path):
+            return UsageTable(columns, meta["models"], meta["sessions"], meta["titles"])
+        parts = [columns]
+        offset, models, sessions, titles = meta["offset"], _Vocabulary(meta["models"]), _Vocabulary(meta["sessions"]), meta["titles"]
+    else:
+        parts, offset, models, sessions, titles = [], 0, _Vocabulary(), _Vocabulary(), []
+
+    for lines, offset in _read_chunks(path, offset, chunk_lines):
+        parts.append(_parse_chunk(lines, models, sessions, titles))
+    columns = {
+        name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtype)
+        for name, dtype in NUMERIC_COLUMNS.items()
+    }
+
+    if cache is not None:
+        meta = {
+            "version": CACHE_VERSION, "signature": signature, "offset": offset, "rows": len(columns["timestamp"]),
+            "models": models.names, "sessions": sessions.names, "titles": titles,
+        }
+        try:
+            cache.save(meta, columns)
+        except OSError:
+            pass  # cartella non scrivibile: le colonne restano solo in memoria
+    return UsageTable(columns, models.names, sessions.names, titles)
+
+
+def load_logs(paths: Iterable[str], use_cache: bool = True, chunk_lines: int = DEFAULT_CHUNK_LINES) -> UsageTable:
+    """Carica e unisce più log (es. di più processi o giorni) in una sola tabella."""
+    tables = [load_log(path, use_cache, chunk_lines) for path in paths]
+    if len(tables) == 1:
+        return tables[0]
+    models, sessions, titles = _Vocabulary(), _Vocabulary(), []
+    parts = []
+    for table in tables:
+        # i codici di ogni log vengono tradotti in quelli dei vocabolari comuni
+        model_map = np.array([models.code(name) for name in table.models], dtype=np.int32)
+        session_map = np.empty(len(table.sessions), dtype=np.int32)
+        for i, name in enumerate(table.sessions):
+            code = session_map[i] = sessions.code(name)
+            if code == len(titles):
+                titles.append(table.titles[i])
+        part = dict(table.columns)
+        if len(table):
+            part["model"], part["session"] = model_map[table["model"]], session_map[table["session"]]
+        parts.append(part)
+    columns = {
+        name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtype)
+        for name, dtype in NUMERIC_COLUMNS.items()
+    }
+    return UsageTable(columns, models.names, sessions.names, titles)
+
+
+def parse_since(value: str, now: Optional[datetime] = None) -> datetime:
+    """Inizio del periodo da una durata ('7d', '12h', '2w') o da una data ISO ('2025-01-31')."""
+    now = now or datetime.now()
+    units = {"h": "hours", "d": "days", "w": "weeks"}
+    if value[-1:] in units and value[:-1].isdigit():
+        return now - timedelta(**{units[value[-1]]: int(value[:-1])})
+    return datetime.fromisoformat(value)
+
+
+def usage_report(table: UsageTable, bucket: str = "day", top: int = 10,
+                 percentiles: Sequence[float] = (50, 95, 99)) -> Dict:
+    """Tutte le analisi della tabella in un dizionario (per la CLI e la dashboard)."""
+    return {
+        "totals": table.totals(),
+        "buckets": table.time_buckets(bucket),
+        "models": table.model_percentiles(percentiles),
+        "sessions": table.session_percentiles(percentiles),
+        "top_sessions": table.top_sessions(top),
+    }
+
+
+def _print_table(rows: List[List], headers: List[str]):
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max(len(header), *(len(row[i]) for row in rows)) for i, header in enumerate(headers)]
+    print("  ".join(header.ljust(width) for header, width in zip(headers, widths)))
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def _print_report(report: Dict, bucket: str):
+    totals = report["totals"]
+    print(f"{totals['interactions']} interazioni in {totals['sessions']} sessioni, "
+          f"{totals['input_tokens'] + totals['output_tokens']} token, ${totals['cost_usd']:.4f} "
+          f"(risposte dalla cache: {totals['cache_hit_rate']:.1%})")
+    if not totals["interactions"]:
+        return
+
+    time_format = "%Y-%m-%d %H:00" if bucket == "hour" else "%Y-%m-%d"
+    print(f"\nPer {({'hour': 'ora', 'day': 'giorno', 'week': 'settimana'})[bucket]}:")
+    _print_table(
+        [[row["start"].strftime(time_format), row["interactions"], row["input_tokens"], row["output_tokens"],
+          f"{row['cost_usd']:.4f}"] for row in report["buckets"]],
+        ["inizio", "interazioni", "input", "output", "costo $"]
+    )
+
+    print("\nPer modello (percentili per interazione):")
+    model_rows = []
+    for model, stats in sorted(report["models"].items(), key=lambda item: -item[1]["cost_usd"]):
+        token_percentiles = " / ".join(f"{value:.0f}" for key, value in stats.items() if key.startswith("tokens_p"))
+        cost_percentiles = " / ".join(f"{value:.6f}" for key, value in stats.items() if key.startswith("cost_p"))
+        model_rows.append([model, stats["interactions"], f"{stats['cost_usd']:.4f}", token_percentiles, cost_percentiles])
+    labels = "/".join(key[len("tokens_"):] for key in next(iter(report["models"].values())) if key.startswith("tokens_p"))
+    _print_table(model_rows, ["modello", "interazioni", "costo $", f"token {labels}", f"costo $ {labels}"])
+
+    print("\nPer sessione (percentili tra le sessioni):")
+    _print_table(
+        [[name, *(f"{value:.6f}" if name == "cost_usd" else f"{value:.0f}" for value in stats.values())]
+         for name, stats in report["sessions"].items()],
+        ["", *next(iter(report["sessions"].values()))]
+    )
+
+    print(f"\nLe {len(report['top_sessions'])} conversazioni più costose:")
+    _print_table(
+        [[row["session_id"], row["first"].strftime("%Y-%m-%d %H:%M"), row["interactions"], row["tokens"],
+          f"{row['cost_usd']:.4f}", row["title"][:40]] for row in report["top_sessions"]],
+        ["sessione", "inizio", "interazioni", "token", "costo $", "prima domanda"]
+    )
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(description="Analisi di token e costi dai log di TokenMonitor")
+    parser.add_argument("logs", nargs="*", default=["token_usage.jsonl"], help="file JSON Lines da analizzare")
+    parser.add_argument("--since", help="inizio del periodo: durata (7d, 12h, 2w) o data ISO")
+    parser.add_argument("--until", help="fine del periodo (data ISO, esclusa)")
+    parser.add_argument("--bucket", choices=sorted(BUCKETS), default="day", help="ampiezza degli intervalli")
+    parser.add_argument("--top", type=int, default=10, help="numero di conversazioni più costose")
+    parser.add_argument("--no-cache", action="store_true", help="non salvare né usare le colonne accanto ai log")
+    parser.add_argument("--json", action="store_true", help="stampa il rapporto in JSON")
+    args = parser.parse_args(argv)
+
+    table = load_logs(args.logs, use_cache=not args.no_cache)
+    start = parse_since(args.since) if args.since else None
+    end = datetime.fromisoformat(args.until) if args.until else None
+    if start or end:
+        table = table.between(start, end)
+    report = usage_report(table, args.bucket, args.top)
+    if args.json:
+        print(json.dumps(report, indent=2, ensure_ascii=False, default=str))
+    else:
+        _print_report(report, args.bucket)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import atexit
+import json
+import os
+import threading
+from typing import Dict, List
+
+# numero di record e secondi dopo i quali il buffer viene scritto su disco
+DEFAULT_MAX_BUFFERED_RECORDS = 50
+DEFAULT_FLUSH_INTERVAL_SECONDS = 5.0
+
+
+class JsonlUsageWriter:
+    """
+    Scrive i record di utilizzo in un file JSON Lines (un oggetto JSON per riga), solo in append.
+
+    I record vengono accumulati in un buffer e scritti a blocchi: quando il buffer raggiunge
+    'max_buffered_records', ogni 'flush_interval' secondi (da un thread in background) e alla
+    chiusura del processo. Ogni blocco viene scritto con una sola operazione e un solo fsync,
+    invece di toccare il disco a ogni messaggio.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_buffered_records: int = DEFAULT_MAX_BUFFERED_RECORDS,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+    ):
+        self.path = path
+        self.max_buffered_records = max_buffered_records
+        self.flush_interval = flush_interval
+
+        self._buffer: List[str] = []
+        self._lock = threading.Lock()
+        # lock separato per la scrittura su file, così chi aggiunge record non attende l'I/O
+        self._file_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, name="usage-log-flush", daemon=True)
+        self._thread.start()
+
+        # garantisce che i record ancora nel buffer vengano scritti all'uscita del processo
+        atexit.register(self.close)
+
+    def write(self, record: Dict):
+        """Aggiunge un record al buffer, scrivendo su disco se la soglia è stata raggiunta."""
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._buffer.append(line)
+            should_flush = len(self._buffer) >= self.max_buffered_records
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Scrive su disco tutti i record presenti nel buffer."""
+        with self._file_lock:
+            with self._lock:
+                lines, self._buffer = self._buffer, []
+            if not lines:
+                return
+
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def close(self):
+        """Ferma il thread di flush e scrive gli ultimi record rimasti nel buffer."""
+        self._stop.set()
+        self.flush()
+
+
+# un solo writer per file nel processo, condiviso da tutte le sessioni che vi scrivono.
+_writers: Dict[str, JsonlUsageWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def get_usage_writer(path: str) -> JsonlUsageWriter:
+    """Restituisce il writer del processo associato al file indicato, creandolo se necessario."""
+    key = os.path.abspath(path)
+    with _writers_lock:
+        writer = _writers.get(key)
+        if writer is None:
+            writer = JsonlUsageWriter(path)
+            _writers[key] = writer
+        return writer